@@ -0,0 +1,51 @@
+import argparse
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from src.lexer import Lexer
+from src.parser import Parser
+
+
+def generate_source(statements):
+    lines = ["extern printf", "", "pub def main()", "  i64 a = 1"]
+    for i in range(statements):
+        kind = i % 4
+        if kind == 0:
+            lines.append("  i64 v%s = (a + %s) * 3 - a / 2" % (i, i))
+        elif kind == 1:
+            lines.append("  printf(\"%%d\\n\", v%s)" % (i - 1))
+        elif kind == 2:
+            lines.append("  a = v%s + 1" % (i - 2))
+        else:
+            lines.append("  if a == %s then a = 2 end" % i)
+    lines.append("end")
+    return "\n".join(lines)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Report the memory held by the AST of a synthetic program.")
+    arg_parser.add_argument("--statements", type=int, default=10000)
+    args = arg_parser.parse_args()
+
+    parser = Parser(Lexer("<synthetic>", generate_source(args.statements)))
+    parser.parse_advance()
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    nodes = []
+    while True:
+        node = parser.parse_statement()
+        if node is None:
+            break
+        nodes.append(node)
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    print("%s statements: %.1f KiB of AST, %.1f KiB per 10k statements" % (args.statements, size / 1024, size / 1024 * 10000 / args.statements))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from src.assembly import AsmWriter
+from src.compiler import Compiler
+from src.lexer import Lexer
+from src.parser import Parser
+
+
+def generate_source(functions):
+    lines = ["extern printf", ""]
+    for i in range(functions):
+        lines.append("def func_%s() : i64" % i)
+        lines.append("  i64 a = %s" % i)
+        lines.append("  i64 b = a + 3")
+        lines.append("  i64 c = b * 2 - 1")
+        lines.append("  i32 d = 7")
+        lines.append("  i32 e = d / 2")
+        lines.append("  if e == 3 then")
+        lines.append("    printf(\"func %s %%d\\n\", c)" % i)
+        lines.append("  else")
+        lines.append("    printf(\"other\\n\")")
+        lines.append("  end")
+        lines.append("  return c")
+        lines.append("end")
+        lines.append("")
+    lines.append("pub def main()")
+    lines.append("  i64 result = func_0()")
+    lines.append("  printf(\"%d\\n\", result)")
+    lines.append("end")
+    return "\n".join(lines)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Measure instructions lowered and written as assembly per second.")
+    arg_parser.add_argument("--functions", type=int, default=5000)
+    arg_parser.add_argument("--repeat", type=int, default=5)
+    args = arg_parser.parse_args()
+
+    source = generate_source(args.functions)
+    best = None
+    instructions = 0
+    for _ in range(args.repeat):
+        parser = Parser(Lexer("<synthetic>", source))
+        parser.parse_advance()
+        compiler = Compiler(parser)
+        compiler.walk_tree()
+        instructions = len(compiler.instructions)
+
+        start = time.perf_counter()
+        with AsmWriter(os.devnull) as writer:
+            compiler.lower(writer)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    print("%s functions, %s instructions" % (args.functions, instructions))
+    print("lowering and writing, best of %s: %.4fs, %.0f instructions/sec" % (args.repeat, best, instructions / best))
+
+
+if __name__ == "__main__":
+    main()
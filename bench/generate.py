@@ -0,0 +1,78 @@
+import argparse
+import random
+import sys
+
+WIDTHS = ["i8", "i16", "i32", "i64"]
+EXTERNS = ["printf", "puts", "putchar"]
+
+
+# Writes a MYL program with the given number of functions. Each function
+# works in one integer width and has an arithmetic chain of chain terms, a
+# when block of when_cases cases and strings string literals passed to
+# extern calls. main calls every function returning i64. The same seed
+# always gives the same program.
+def generate_program(functions, chain=8, strings=4, when_cases=8, seed=0):
+    rng = random.Random(seed)
+    lines = ["extern %s" % name for name in EXTERNS]
+    lines.append("")
+    callable_functions = []
+    for i in range(functions):
+        width = WIDTHS[i % len(WIDTHS)]
+        name = "f%s_%s" % (i, width)
+        lines.append("def %s() : %s" % (name, width))
+        lines.append("  %s a = %s" % (width, rng.randint(1, 100)))
+        lines.append("  %s b = %s" % (width, rng.randint(1, 100)))
+        terms = ["a"]
+        for _ in range(chain - 1):
+            operator = rng.choice("+-*/")
+            operand = rng.choice(["a", "b"] if operator == "/" else ["a", "b", str(rng.randint(1, 9))])
+            terms.append("%s %s" % (operator, operand))
+        lines.append("  %s c = %s" % (width, " ".join(terms)))
+        lines.append("  if c == %s then" % rng.randint(0, 50))
+        lines.append("    printf(\"%s hit %%d\\n\", c)" % name)
+        lines.append("  else")
+        lines.append("    puts(\"%s miss\")" % name)
+        lines.append("  end")
+        for j in range(strings):
+            lines.append("  printf(\"%s string %s\\n\")" % (name, j))
+        if when_cases > 0:
+            lines.append("  when c")
+            for j in range(when_cases - 1):
+                lines.append("    %s => putchar(%s)" % (j, 48 + j % 10))
+            lines.append("    _ => puts(\"%s default\")" % name)
+            lines.append("  end")
+        lines.append("  return c")
+        lines.append("end")
+        lines.append("")
+        if width == "i64":
+            callable_functions.append(name)
+
+    lines.append("pub def main()")
+    for name in callable_functions:
+        lines.append("  i64 r_%s = %s()" % (name, name))
+        lines.append("  printf(\"%%d\\n\", r_%s)" % name)
+    lines.append("end")
+    lines.append("")
+    return "\n".join(lines)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Write a synthetic MYL program of a given size.")
+    arg_parser.add_argument("output", nargs="?", help="file to write, stdout if omitted")
+    arg_parser.add_argument("--functions", type=int, default=1000)
+    arg_parser.add_argument("--chain", type=int, default=8, help="terms per arithmetic chain")
+    arg_parser.add_argument("--strings", type=int, default=4, help="string literals per function")
+    arg_parser.add_argument("--when-cases", type=int, default=8, help="cases per when block, 0 for none")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    args = arg_parser.parse_args()
+
+    source = generate_program(args.functions, args.chain, args.strings, args.when_cases, args.seed)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(source)
+    else:
+        sys.stdout.write(source)
+
+
+if __name__ == "__main__":
+    main()
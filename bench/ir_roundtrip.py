@@ -0,0 +1,63 @@
+import argparse
+import filecmp
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bench.codegen_bench import generate_source
+from src.bytecode import IRReader, save_ir
+from src.compiler import Compiler
+from src.lexer import Lexer
+from src.parser import Parser
+
+
+def compile_source(path, output):
+    parser = Parser(Lexer(path))
+    parser.parse_advance()
+    Compiler(parser).compile(output)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Check that saved instructions lower to the same asm as the source, and time both.")
+    arg_parser.add_argument("--functions", type=int, default=2000)
+    arg_parser.add_argument("sources", nargs="*", help="programs to check besides the generated one")
+    args = arg_parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    generated = os.path.join(directory, "generated.myl")
+    with open(generated, "w") as file:
+        file.write(generate_source(args.functions))
+
+    failed = False
+    for source in args.sources + [generated]:
+        name = os.path.splitext(os.path.basename(source))[0]
+        ir = os.path.join(directory, name + ".mylir")
+        from_source = os.path.join(directory, name + ".source.asm")
+        from_ir = os.path.join(directory, name + ".ir.asm")
+
+        parser = Parser(Lexer(source))
+        parser.parse_advance()
+        start = time.perf_counter()
+        save_ir(parser, ir)
+        saved = time.perf_counter() - start
+
+        start = time.perf_counter()
+        compile_source(source, from_source)
+        direct = time.perf_counter() - start
+
+        start = time.perf_counter()
+        Compiler(IRReader(ir)).compile(from_ir)
+        loaded = time.perf_counter() - start
+
+        same = filecmp.cmp(from_source, from_ir, shallow=False)
+        failed = failed or not same
+        print("%-12s %s, %s bytes of source, %s bytes saved" % (name, "identical" if same else "DIFFERENT", os.path.getsize(source), os.path.getsize(ir)))
+        print("%-12s save %.3fs, compile from source %.3fs, from saved %.3fs" % ("", saved, direct, loaded))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
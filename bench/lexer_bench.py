@@ -0,0 +1,92 @@
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from src.lexer import Lexer
+from src.token import TokenType
+
+
+def generate_source(functions):
+    lines = ["extern printf", ""]
+    for i in range(functions):
+        lines.append("def func_%s() : i64" % i)
+        lines.append("  i64 value_%s = (%s + 2) * 3 - %s / 4" % (i, i, i))
+        lines.append("  i32 other = 12")
+        lines.append("  if value_%s >= 10 && other != 3 then" % i)
+        lines.append("    printf(\"value %%d\\n\", value_%s)" % i)
+        lines.append("  else")
+        lines.append("    printf(\"small\\n\")")
+        lines.append("  end")
+        lines.append("  return value_%s" % i)
+        lines.append("end")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def count_tokens(lexer):
+    count = 0
+    while lexer.next_token().kind != TokenType.TOKEN_EOF:
+        count += 1
+    return count
+
+
+def collect_tokens(lexer):
+    tokens = []
+    while True:
+        token = lexer.next_token()
+        tokens.append(token)
+        if token.kind == TokenType.TOKEN_EOF:
+            return tokens
+
+
+def best_time(repeat, func):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def traced_size(func):
+    tracemalloc.start()
+    result = func()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, result
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Measure lexer throughput in tokens per second.")
+    arg_parser.add_argument("path", nargs="?", help="MYL file to lex. A synthetic program is used if omitted.")
+    arg_parser.add_argument("--functions", type=int, default=5000)
+    arg_parser.add_argument("--repeat", type=int, default=5)
+    args = arg_parser.parse_args()
+
+    if args.path:
+        with open(args.path, "rb") as file:
+            source = file.read().decode("utf-8")
+    else:
+        source = generate_source(args.functions)
+    path = args.path or "<synthetic>"
+
+    best, tokens = best_time(args.repeat, lambda: count_tokens(Lexer(path, source)))
+    print("%s: %s tokens, %s bytes" % (path, tokens, len(source)))
+    print("next_token: best of %s %.4fs, %.0f tokens/sec" % (args.repeat, best, tokens / best))
+
+    best, _ = best_time(args.repeat, lambda: Lexer(path, source).tokenize())
+    print("tokenize:   best of %s %.4fs, %.0f tokens/sec" % (args.repeat, best, tokens / best))
+
+    size, _ = traced_size(lambda: collect_tokens(Lexer(path, source)))
+    print("Token list:  %.1f bytes/token" % (size / (tokens + 1)))
+    size, _ = traced_size(lambda: Lexer(path, source).tokenize())
+    print("TokenBuffer: %.1f bytes/token" % (size / (tokens + 1)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from src.lexer import Lexer
+from src.parser import Parser
+
+OPERATORS = ["+", "-", "*", "/", "==", "!=", "<", "<=", ">", ">=", "&&", "||"]
+
+
+def generate_expression(rand, depth):
+    if depth <= 0 or rand.random() < 0.2:
+        return rand.choice(["a", "b", "12", "7", "get()"])
+    if rand.random() < 0.15:
+        return "(%s)" % generate_expression(rand, depth - 1)
+    if rand.random() < 0.1:
+        return "-%s" % generate_expression(rand, depth - 1)
+    return "%s %s %s" % (generate_expression(rand, depth - 1), rand.choice(OPERATORS), generate_expression(rand, depth - 1))
+
+
+def generate_source(statements, depth):
+    rand = random.Random(0)
+    lines = ["pub def main()", "  i64 a = 1", "  i64 b = 2"]
+    for i in range(statements):
+        lines.append("  i64 v%s = %s" % (i, generate_expression(rand, depth)))
+    lines.append("end")
+    return "\n".join(lines)
+
+
+def parse_all(source):
+    parser = Parser(Lexer("<synthetic>", source))
+    start = time.perf_counter()
+    parser.parse_advance()
+    statements = 0
+    while parser.parse_statement() is not None:
+        statements += 1
+    return len(parser.tokens), time.perf_counter() - start
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Measure parser throughput on expression heavy input.")
+    arg_parser.add_argument("--statements", type=int, default=20000)
+    arg_parser.add_argument("--depth", type=int, default=6)
+    arg_parser.add_argument("--repeat", type=int, default=5)
+    args = arg_parser.parse_args()
+
+    source = generate_source(args.statements, args.depth)
+    best = None
+    tokens = 0
+    for _ in range(args.repeat):
+        tokens, elapsed = parse_all(source)
+        best = elapsed if best is None else min(best, elapsed)
+
+    print("%s statements, %s tokens, %s bytes" % (args.statements, tokens, len(source)))
+    print("parse (excluding lexing), best of %s: %.4fs, %.0f tokens/sec" % (args.repeat, best, tokens / best))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bench.generate import generate_program
+from src.compiler import Compiler
+from src.lexer import Lexer
+from src.parser import Parser
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+
+# Workloads by name: keyword arguments of generate_program.
+WORKLOADS = {
+    "small": {"functions": 200},
+    "large": {"functions": 2000},
+    "arithmetic": {"functions": 1000, "chain": 40, "strings": 0, "when_cases": 0},
+    "strings": {"functions": 500, "chain": 2, "strings": 40, "when_cases": 0},
+    "when": {"functions": 500, "chain": 2, "strings": 0, "when_cases": 60},
+}
+
+
+def parsed(source):
+    parser = Parser(Lexer("<bench>", source))
+    parser.parse_advance()
+    return parser
+
+
+# Each stage is a pair: a setup run outside the clock, and the work that
+# is timed, given what setup returned.
+def stage_lex(source):
+    return lambda: None, lambda _: Lexer("<bench>", source).tokenize()
+
+
+def stage_parse(source):
+    return lambda: parsed(source), lambda parser: list(parser.statements())
+
+
+def stage_eval(source):
+    def setup():
+        return list(parsed(source).statements())
+
+    def run(statements):
+        compiler = Compiler(None)
+        for statement in statements:
+            compiler.evaluate(statement)
+    return setup, run
+
+
+def stage_compile(source):
+    return lambda: None, lambda _: Compiler(parsed(source)).compile(os.devnull)
+
+
+STAGES = {"lex": stage_lex, "parse": stage_parse, "eval": stage_eval, "compile": stage_compile}
+
+
+def measure(stage, source, repeat):
+    setup, run = stage(source)
+    best = None
+    for _ in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        run(state)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    # Traced separately, tracemalloc would skew the timings.
+    state = setup()
+    tracemalloc.start()
+    run(state)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def machine():
+    return "%s/%s/python %s" % (platform.node(), platform.machine(), platform.python_version())
+
+
+def load_baselines(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Measure compiler throughput on generated workloads and compare with stored baselines.")
+    arg_parser.add_argument("--workloads", nargs="*", default=list(WORKLOADS), choices=list(WORKLOADS))
+    arg_parser.add_argument("--stages", nargs="*", default=list(STAGES), choices=list(STAGES))
+    arg_parser.add_argument("--repeat", type=int, default=5)
+    arg_parser.add_argument("--baselines", default=BASELINES)
+    arg_parser.add_argument("--threshold", type=float, default=0.25, help="fraction slower or larger than the baseline that fails")
+    arg_parser.add_argument("--update", action="store_true", help="store these results as the baseline of this machine")
+    args = arg_parser.parse_args()
+
+    baselines = load_baselines(args.baselines)
+    # Throughput only compares on the machine it was measured on.
+    baseline = baselines.get(machine(), {})
+    results = {}
+    regressions = []
+    print("%-11s %-8s %14s %12s %10s" % ("workload", "stage", "lines/sec", "peak MiB", "vs base"))
+    for workload in args.workloads:
+        source = generate_program(**WORKLOADS[workload])
+        lines = source.count("\n")
+        results[workload] = {}
+        for stage in args.stages:
+            seconds, peak = measure(STAGES[stage], source, args.repeat)
+            result = {"lines_per_sec": lines / seconds, "peak_bytes": peak}
+            results[workload][stage] = result
+
+            base = baseline.get(workload, {}).get(stage)
+            change = ""
+            if base is not None:
+                speed = result["lines_per_sec"] / base["lines_per_sec"] - 1
+                growth = result["peak_bytes"] / base["peak_bytes"] - 1 if base["peak_bytes"] else 0
+                change = "%+.1f%%" % (speed * 100)
+                if speed < -args.threshold:
+                    regressions.append("%s %s: %.0f lines/sec, baseline %.0f" % (workload, stage, result["lines_per_sec"], base["lines_per_sec"]))
+                if growth > args.threshold:
+                    regressions.append("%s %s: peak %.1f MiB, baseline %.1f MiB" % (workload, stage, peak / 2 ** 20, base["peak_bytes"] / 2 ** 20))
+            print("%-11s %-8s %14.0f %12.1f %10s" % (workload, stage, result["lines_per_sec"], peak / 2 ** 20, change))
+
+    if args.update:
+        # Only the stages measured are replaced, the others keep theirs.
+        stored = baselines.setdefault(machine(), {})
+        for workload, stages in results.items():
+            stored.setdefault(workload, {}).update(stages)
+        with open(args.baselines, "w") as file:
+            json.dump(baselines, file, indent=1, sort_keys=True)
+        print("Stored baseline for %s in %s." % (machine(), args.baselines))
+    elif not baseline:
+        print("No baseline for %s yet, store one with --update." % machine())
+
+    if regressions:
+        print("Regressions beyond %.0f%%:" % (args.threshold * 100))
+        for regression in regressions:
+            print("  %s" % regression)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
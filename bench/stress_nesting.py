@@ -0,0 +1,76 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from src.assembly import AsmWriter
+from src.compiler import Compiler
+from src.lexer import Lexer
+from src.parser import Parser
+
+
+def wrap_main(body):
+    return "pub def main()\n%s\nend\n" % body
+
+
+# The expressions start from a variable, so folding cannot collapse them
+# into a single literal before they are evaluated.
+def left_parens(depth):
+    return wrap_main("  i64 y = 2\n  i64 x = %sy%s" % ("(" * depth, " + 1)" * depth))
+
+
+def right_parens(depth):
+    return wrap_main("  i64 y = 2\n  i64 x = %sy%s" % ("y + (" * depth, ")" * depth))
+
+
+def long_chain(depth):
+    return wrap_main("  i64 y = 2\n  i64 x = y%s" % (" + 1" * depth))
+
+
+# Negations alternate with nots, since folding drops a double negation.
+def unary_chain(depth):
+    return wrap_main("  i64 y = 2\n  i64 x = %sy" % ("-!" * depth)[:depth])
+
+
+def nested_blocks(depth):
+    return wrap_main("%s  i64 x = 1\n%s" % ("do\n" * depth, "end\n" * depth))
+
+
+def nested_ifs(depth):
+    return wrap_main("  i64 x = 1\n%s  x = 2\n%s" % ("if x == 1 then\n" * depth, "end\n" * depth))
+
+
+CASES = [left_parens, right_parens, long_chain, unary_chain, nested_blocks, nested_ifs]
+
+
+def compile_source(source, path):
+    parser = Parser(Lexer("<stress>", source))
+    parser.parse_advance()
+    compiler = Compiler(parser)
+    # Not streamed, so the instructions are still there to be counted.
+    compiler.walk_tree()
+    with AsmWriter(path) as writer:
+        compiler.lower(writer)
+    return len(compiler.instructions)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Compile deeply nested programs to check nothing recurses on the Python stack.")
+    arg_parser.add_argument("--depth", type=int, default=100000)
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "stress.asm")
+        for case in CASES:
+            source = case(args.depth)
+            start = time.perf_counter()
+            instructions = compile_source(source, path)
+            elapsed = time.perf_counter() - start
+            print("%-14s depth %s: %s instructions in %.3fs" % (case.__name__, args.depth, instructions, elapsed))
+
+
+if __name__ == "__main__":
+    main()
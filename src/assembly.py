@@ -0,0 +1,172 @@
+import io
+import os
+
+from src.stats import NULL_STATS
+
+# Placeholders in Fragment.lines for the frame setup and teardown, expanded
+# once the frame size of the function is known, and for the return itself so
+# the end of a function can tell whether it already returned.
+PROLOGUE = object()
+EPILOGUE = object()
+RETURN = object()
+
+
+class Fragment:
+
+    def __init__(self, name=None, public=False):
+        self.name = name
+        self.public = public
+        self.lines = []
+        self.append = self.lines.append
+        self.frame_size = 0
+        # Callee saved registers the function uses, pushed by the prologue.
+        self.saved = []
+        self.marks = []
+
+    @property
+    def last_was_ret(self):
+        return len(self.lines) > 0 and self.lines[-1] is RETURN
+
+    def mark(self, placeholder):
+        self.marks.append(len(self.lines))
+        self.lines.append(placeholder)
+
+    def save(self, register):
+        if register not in self.saved:
+            self.saved.append(register)
+
+    def open_frame(self):
+        self.mark(PROLOGUE)
+
+    def ret(self):
+        self.mark(EPILOGUE)
+        self.mark(RETURN)
+
+    # Takes rewritten lines, e.g. from the peephole optimizer, finding the
+    # placeholders among them again.
+    def replace_lines(self, lines):
+        self.lines = lines
+        self.append = lines.append
+        self.marks = [index for index, line in enumerate(lines) if line is PROLOGUE or line is EPILOGUE or line is RETURN]
+
+    # Expands the placeholders for good, e.g. before the fragment is sent to
+    # another process, where they would no longer be the same objects.
+    def resolve(self):
+        lines = []
+        for chunk in self.render():
+            lines.extend(chunk)
+        self.lines = lines
+        self.append = lines.append
+        self.marks = []
+
+    def render(self):
+        pushes = [" push %s\n" % register for register in self.saved]
+        pops = [" pop %s\n" % register for register in reversed(self.saved)]
+        if self.frame_size:
+            # Pad the frame so the pushes leave rsp aligned as it was.
+            frame = hex(self.frame_size + 8 * (len(self.saved) % 2))
+            prologue = [" push rbp\n", " mov rbp, rsp\n"] + pushes + [" sub rsp, %s\n" % frame]
+            epilogue = [" add rsp, %s\n" % frame] + pops + [" leave\n"]
+        else:
+            prologue = pushes
+            epilogue = pops
+        expansions = {PROLOGUE: prologue, EPILOGUE: epilogue, RETURN: [" ret\n"]}
+        lines = self.lines
+        start = 0
+        # Hand out the runs of plain lines between placeholders as slices.
+        for index in self.marks:
+            yield lines[start:index]
+            yield expansions[lines[index]]
+            start = index + 1
+        yield lines[start:]
+
+
+# Writes the program as it is lowered. Functions are written as soon as they
+# are finished, each preceded by the constants it added to the data section.
+# Given a file instead of a path, e.g. an io.StringIO, it writes there and
+# leaves the file open.
+class AsmWriter:
+
+    def __init__(self, path, buffer_size=1 << 16, file=None, stats=NULL_STATS):
+        self.path = path
+        self.stats = stats
+        self.lines = 1
+        self.owns_file = file is None
+        self.file = io.open(path, "w", buffering=buffer_size) if file is None else file
+        self.file.write("SECTION .text\n")
+        self.data = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        # Don't leave a half written program behind for the assembler.
+        if exc_type is not None and self.owns_file and self.path != os.devnull:
+            os.remove(self.path)
+
+    def extern(self, name):
+        self.file.write("extern %s\n" % name)
+
+    def add_data(self, line):
+        self.data.append(line)
+
+    def flush_data(self):
+        if self.data:
+            self.lines += len(self.data) + 3
+            self.file.write("\nSECTION .data\n")
+            self.file.writelines(self.data)
+            self.file.write("SECTION .text\n")
+            self.data = []
+
+    def write_fragment(self, fragment):
+        previous = self.stats.switch("write")
+        self.flush_data()
+        self.file.write("\n")
+        if fragment.public:
+            self.file.write("global %s\n" % fragment.name)
+        if fragment.name is not None:
+            self.file.write("%s:\n" % fragment.name)
+        for chunk in fragment.render():
+            self.lines += len(chunk)
+            self.file.writelines(chunk)
+        self.stats.switch(previous)
+
+    def close(self):
+        self.flush_data()
+        self.stats.count("asm lines", self.lines)
+        if self.owns_file:
+            self.file.close()
+
+
+# Stands in for AsmWriter in a worker process. Finished fragments are kept to
+# be sent back and written in order by the main process.
+class FragmentCollector:
+
+    def __init__(self):
+        self.fragments = []
+
+    def add_data(self, line):
+        raise Exception("Constants must be pooled before a function is handed to a worker.")
+
+    def write_fragment(self, fragment):
+        fragment.resolve()
+        self.fragments.append(fragment)
+
+
+# Stands in for AsmWriter when code is lowered only to be measured. Counts
+# the bytes of the functions written, leaving out constants and externs.
+class SizeCounter:
+
+    def __init__(self):
+        self.size = 0
+
+    def extern(self, name):
+        pass
+
+    def add_data(self, line):
+        pass
+
+    def write_fragment(self, fragment):
+        for chunk in fragment.render():
+            self.size += sum(len(line) for line in chunk)
@@ -0,0 +1,361 @@
+from concurrent.futures import ProcessPoolExecutor
+from src.compiler import Compiler
+from src.lexer import Lexer
+from src.parser import Parser
+from src.peephole import Peephole
+from src.ssa import PassManager
+from src.stats import NULL_STATS, Stats
+from src.token import TOKEN_TYPES
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+
+# Bump when the compiler changes the code it generates, so modules built by
+# an older version are compiled again.
+BUILD_VERSION = 8
+
+
+# Runs the external assembler and linker. The commands are argument lists
+# with {input} and {output} in place of the file names. {input} stands for
+# every input file when there are several, as when linking.
+class Toolchain:
+
+    def __init__(self, assembler=("nasm", "-fwin64", "{input}", "-o", "{output}"), linker=("gcc", "-o", "{output}", "{input}")):
+        self.assembler = list(assembler)
+        self.linker = list(linker)
+        self.versions = None
+
+    # Identifies the tools so a cached output is not reused after an
+    # upgrade. Asked once per run.
+    def version(self):
+        if self.versions is None:
+            self.versions = "\n".join(self.tool_version(command[0]) for command in (self.assembler, self.linker))
+        return self.versions
+
+    def tool_version(self, tool):
+        flag = "-v" if os.path.basename(tool).startswith("nasm") else "--version"
+        try:
+            result = subprocess.run([tool, flag], capture_output=True, text=True)
+        except OSError:
+            return "%s missing" % tool
+        lines = (result.stdout or result.stderr).splitlines()
+        return lines[0] if lines else tool
+
+    def command(self, template, sources, output):
+        if isinstance(sources, str):
+            sources = [sources]
+        command = []
+        for part in template:
+            if part == "{input}":
+                command.extend(sources)
+            else:
+                command.append(part.format(output=output))
+        return command
+
+    def run(self, template, sources, output):
+        command = self.command(template, sources, output)
+        try:
+            subprocess.run(command, check=True)
+        except OSError as error:
+            raise Exception("Could not run %s: %s" % (command[0], error.strerror))
+
+    def assemble(self, asm, obj):
+        self.run(self.assembler, asm, obj)
+
+    def link(self, objs, exe):
+        self.run(self.linker, objs, exe)
+
+
+# Stands in for nasm and gcc where they are not installed. The outputs only
+# record what they were made from, which is enough to exercise the build
+# cache. Counts how often each step runs.
+class StubToolchain(Toolchain):
+
+    def __init__(self):
+        super().__init__(("stub-as", "{input}", "{output}"), ("stub-ld", "{input}", "{output}"))
+        self.assembled = 0
+        self.linked = 0
+
+    def version(self):
+        return "stub 1"
+
+    def run(self, template, sources, output):
+        digest = hashlib.sha256()
+        for source in self.command(["{input}"], sources, output):
+            with open(source, "rb") as file:
+                digest.update(file.read())
+        with open(output, "w") as file:
+            file.write("%s %s\n" % (template[0], digest.hexdigest()))
+
+    def assemble(self, asm, obj):
+        super().assemble(asm, obj)
+        self.assembled += 1
+
+    def link(self, objs, exe):
+        super().link(objs, exe)
+        self.linked += 1
+
+
+# Objects and executables stored under the hash of everything that went
+# into making them: the input bytes, the command line with the file names
+# left out, and the tool versions.
+class BuildCache:
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, sources, template, version):
+        digest = hashlib.sha256()
+        for source in [sources] if isinstance(sources, str) else sources:
+            with open(source, "rb") as file:
+                for block in iter(lambda: file.read(1 << 16), b""):
+                    digest.update(block)
+            digest.update(b"\0")
+        digest.update(("\0%s\0%s" % (" ".join(template), version)).encode("utf-8"))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    # Copies the stored output for key to destination, if there is one.
+    def fetch(self, key, destination):
+        path = self.path(key)
+        if not os.path.exists(path):
+            self.misses += 1
+            return False
+        shutil.copyfile(path, destination)
+        shutil.copymode(path, destination)
+        self.hits += 1
+        return True
+
+    def store(self, key, output):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = "%s.%s.tmp" % (path, os.getpid())
+        shutil.copyfile(output, temp)
+        shutil.copymode(output, temp)
+        os.replace(temp, path)
+
+    def stats(self):
+        return "%s hits, %s misses" % (self.hits, self.misses)
+
+    # Adds the counts of a copy of this cache used in another process.
+    def merge(self, other):
+        self.hits += other.hits
+        self.misses += other.misses
+
+
+def step(run, template, sources, output, toolchain, cache):
+    if cache is None:
+        run(sources, output)
+        return
+    key = cache.key(sources, template, toolchain.version())
+    if not cache.fetch(key, output):
+        run(sources, output)
+        cache.store(key, output)
+
+
+# A source file of the program. Its pub functions are what the modules that
+# include it can call.
+class Module:
+
+    def __init__(self, path):
+        self.path = path
+        base = os.path.splitext(path)[0]
+        self.asm = base + ".asm"
+        self.obj = base + ".obj"
+        self.digest = None
+        self.include_names = []
+        self.interface = {}
+        # Include name as written to the module it resolved to.
+        self.includes = {}
+        self.key = None
+
+    # Lexes the module for what other modules need from it.
+    def scan(self):
+        with open(self.path, "rb") as file:
+            source = file.read()
+        self.digest = hashlib.sha256(source).hexdigest()
+        parser = Parser(Lexer(self.path, source.decode("utf-8")))
+        self.include_names = parser.include_names()
+        self.interface = parser.function_signatures(public_only=True)
+
+    def resolve_include(self, name):
+        path = os.path.join(os.path.dirname(self.path), name)
+        if not os.path.splitext(path)[1]:
+            path += ".myl"
+        return os.path.normpath(path)
+
+    # Everything the generated code of the module depends on: its source, the
+    # pub functions of the modules it includes and the compiler options.
+    def compute_key(self, options=""):
+        digest = hashlib.sha256(("%s\0%s\0%s" % (BUILD_VERSION, options, self.digest)).encode("utf-8"))
+        for name in sorted(self.includes):
+            interface = sorted((function, kind_value(kind)) for function, kind in self.includes[name].interface.items())
+            digest.update(("\0%s\0%s" % (name, json.dumps(interface))).encode("utf-8"))
+        self.key = digest.hexdigest()
+
+
+def kind_value(kind):
+    return None if kind is None else int(kind)
+
+
+# Builds the program whose main module is at root. Every module reachable
+# through include statements is compiled to an object of its own, and the
+# objects are linked once. A manifest next to the root module remembers each
+# module's mtime, hash and interface, so unchanged modules are neither lexed
+# nor compiled again.
+class ProgramBuild:
+
+    def __init__(self, root, toolchain, build_cache=None, function_cache=None, jobs=1, stats=NULL_STATS, peephole=None, passes=None):
+        self.root = os.path.normpath(root)
+        self.toolchain = toolchain
+        self.build_cache = build_cache
+        self.function_cache = function_cache
+        self.jobs = jobs
+        self.stats = stats
+        self.peephole = peephole
+        self.passes = passes
+        self.manifest_path = os.path.splitext(self.root)[0] + ".build.json"
+        self.manifest = {}
+        self.modules = {}
+        self.compiled = 0
+        self.reused = 0
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as file:
+                self.manifest = json.load(file)
+        except (OSError, ValueError):
+            self.manifest = {}
+
+    def save_manifest(self, order):
+        manifest = {}
+        for module in order:
+            stat = os.stat(module.path)
+            manifest[module.path] = {
+                "mtime": stat.st_mtime_ns,
+                "size": stat.st_size,
+                "digest": module.digest,
+                "includes": module.include_names,
+                "interface": {function: kind_value(kind) for function, kind in module.interface.items()},
+                "key": module.key,
+            }
+        temp = "%s.%s.tmp" % (self.manifest_path, os.getpid())
+        with open(temp, "w", encoding="utf-8") as file:
+            json.dump(manifest, file, indent=1)
+        os.replace(temp, self.manifest_path)
+
+    # Returns the module at path, scanning it only when it changed since it
+    # was recorded in the manifest.
+    def module(self, path):
+        module = self.modules.get(path)
+        if module is not None:
+            return module
+        module = Module(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            raise Exception("Cannot find module %s." % path)
+        entry = self.manifest.get(path)
+        if entry is not None and entry["mtime"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+            module.digest = entry["digest"]
+            module.include_names = entry["includes"]
+            module.interface = {function: None if kind is None else TOKEN_TYPES[kind] for function, kind in entry["interface"].items()}
+        else:
+            module.scan()
+        self.modules[path] = module
+        return module
+
+    # Returns the modules with every module after the ones it includes.
+    def resolve(self):
+        order = []
+        root = self.module(self.root)
+        stack = [(root, iter(root.include_names))]
+        visiting = {root.path}
+        done = set()
+        while stack:
+            module, names = stack[-1]
+            name = next(names, None)
+            if name is None:
+                stack.pop()
+                visiting.discard(module.path)
+                done.add(module.path)
+                order.append(module)
+                continue
+            child = self.module(module.resolve_include(name))
+            module.includes[name] = child
+            if child.path in visiting:
+                cycle = [entry[0].path for entry in stack] + [child.path]
+                raise Exception("Include cycle: %s." % " -> ".join(cycle[cycle.index(child.path):]))
+            if child.path not in done:
+                visiting.add(child.path)
+                stack.append((child, iter(child.include_names)))
+        options = ";".join(optimizer.options() for optimizer in (self.peephole, self.passes) if optimizer is not None)
+        for module in order:
+            module.compute_key(options)
+        return order
+
+    def up_to_date(self, module):
+        entry = self.manifest.get(module.path)
+        return entry is not None and entry["key"] == module.key and os.path.exists(module.asm) and os.path.exists(module.obj)
+
+    # Each module gets optimizers of its own, so what they did is counted in
+    # the stats of the module once.
+    def task(self, module, jobs, stats):
+        includes = {name: included.interface for name, included in module.includes.items()}
+        peephole = None if self.peephole is None else Peephole(self.peephole.patterns)
+        passes = None if self.passes is None else PassManager(self.passes.passes)
+        return module.path, module.asm, module.obj, includes, jobs, self.toolchain, self.build_cache, self.function_cache, stats, peephole, passes
+
+    def run(self, exe):
+        with self.stats.phase("scan"):
+            self.load_manifest()
+            order = self.resolve()
+        stale = [module for module in order if not self.up_to_date(module)]
+        self.reused = len(order) - len(stale)
+        self.compiled = len(stale)
+        # Modules only need the interfaces of what they include, which are
+        # known by now, so they can all be compiled at once. With a single
+        # module the jobs go to its functions instead.
+        # The stats of each worker start empty, and are added up below.
+        if len(stale) > 1 and self.jobs > 1:
+            measured = self.stats is not NULL_STATS
+            with ProcessPoolExecutor(self.jobs) as executor:
+                results = list(executor.map(compile_module, [self.task(module, 1, Stats(sizes=self.stats.sizes) if measured else NULL_STATS) for module in stale]))
+        else:
+            results = [compile_module(self.task(module, self.jobs, self.stats)) for module in stale]
+        # Caches used in worker processes were copies, add up their counts.
+        for build_cache, function_cache, stats in results:
+            if build_cache is not None and build_cache is not self.build_cache:
+                self.build_cache.merge(build_cache)
+            if function_cache is not None and function_cache is not self.function_cache:
+                self.function_cache.merge(function_cache)
+            if stats is not self.stats:
+                self.stats.merge(stats)
+        self.save_manifest(order)
+        with self.stats.phase("link"):
+            step(self.toolchain.link, self.toolchain.linker, [module.obj for module in order], exe, self.toolchain, self.build_cache)
+        self.stats.count("modules compiled", self.compiled)
+        self.stats.count("modules reused", self.reused)
+
+
+# Compiles one module to asm and assembles it. Runs in a worker process of
+# ProgramBuild.run when several modules are built at once, and returns the
+# caches and stats used so their counts can be added up.
+def compile_module(task):
+    path, asm, obj, includes, jobs, toolchain, build_cache, function_cache, stats, peephole, passes = task
+    with stats.phase("lex"):
+        parser = Parser(Lexer(path))
+        parser.parse_advance()
+    stats.count("tokens", len(parser.tokens))
+    compiler = Compiler(parser, function_cache, includes, stats, peephole, passes)
+    compiler.compile(asm, jobs)
+    with stats.phase("assemble"):
+        step(toolchain.assemble, toolchain.assembler, asm, obj, toolchain, build_cache)
+    return build_cache, function_cache, stats
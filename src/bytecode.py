@@ -0,0 +1,219 @@
+from array import array
+import argparse
+import mmap
+import struct
+import sys
+
+from src.compiler import Compiler, Instruction, Opcode
+from src.token import TOKEN_TYPES
+
+# Layout of a saved instruction stream, all integers little endian:
+#
+#   header        MAGIC, then the number of strings, functions, units and
+#                 instructions and the operand width in bytes as u32
+#   string ends   u32 per string, its end offset in the string blob
+#   functions     i32 name, i32 return kind or -1, i32 unit or -1 per known
+#                 function, in the order the compiler learned them
+#   units         u32 first instruction, u32 count per top level statement
+#   operands      string index per instruction, u16 when there are few
+#                 enough strings and u32 otherwise
+#   opcodes       u8 per instruction
+#   string blob   utf-8 text of every operand, each stored once
+#
+# Everything before the opcodes is aligned to its own width, so a loader
+# can view the file through memoryview.cast without copying it.
+MAGIC = b"MYLIR\x00\x00\x04"
+HEADER = struct.Struct("<8s5I")
+
+OPCODES = {opcode.value: opcode for opcode in Opcode}
+
+
+def words(values, typecode="I"):
+    packed = array(typecode, values)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+# Records the instructions of each top level statement as the front end
+# produces them, with the functions the compiler knows of at the end.
+class IRBuilder:
+
+    def __init__(self):
+        self.strings = {}
+        self.operands = array("I")
+        self.opcodes = bytearray()
+        self.units = []
+
+    def intern(self, value):
+        index = self.strings.get(value)
+        if index is None:
+            index = self.strings[value] = len(self.strings)
+        return index
+
+    def add_unit(self, instructions):
+        self.units.append((len(self.opcodes), len(instructions)))
+        intern = self.intern
+        for instr in instructions:
+            self.opcodes.append(instr.opcode)
+            self.operands.append(intern(instr.value))
+
+    def write(self, path, functions):
+        names = list(self.strings)
+        defined = {}
+        for unit, (start, count) in enumerate(self.units):
+            if count > 0 and self.opcodes[start] in (Opcode.START_PROC, Opcode.START_PUB_PROC):
+                defined[names[self.operands[start]]] = unit
+        table = []
+        for name, function in functions.items():
+            table.extend((self.intern(name), -1 if function.kind is None else int(function.kind), defined.get(name, -1)))
+
+        blob = bytearray()
+        ends = []
+        for value in self.strings:
+            blob += value.encode("utf-8")
+            ends.append(len(blob))
+        width = 2 if len(self.strings) <= 0xFFFF else 4
+        with open(path, "wb") as file:
+            file.write(HEADER.pack(MAGIC, len(self.strings), len(functions), len(self.units), len(self.opcodes), width))
+            file.write(words(ends))
+            file.write(words(table, "i"))
+            file.write(words([value for unit in self.units for value in unit]))
+            file.write(words(self.operands, "H" if width == 2 else "I"))
+            file.write(self.opcodes)
+            file.write(blob)
+
+
+# Runs the front end over the program of parser and saves what it produced.
+def save_ir(parser, path, includes=None):
+    compiler = Compiler(parser, includes=includes)
+    compiler.load_signatures()
+    builder = IRBuilder()
+    for node in parser.statements():
+        compiler.evaluate(node)
+        builder.add_unit(compiler.instructions)
+        compiler.instructions = []
+    builder.write(path, compiler.functions)
+
+
+# A saved instruction stream, mapped into memory. It stands in for the
+# parser of a Compiler, so Compiler(IRReader(path)).compile(asm) lowers it
+# without lexing or parsing anything.
+class IRReader:
+
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.map)
+        magic, strings, functions, units, instructions, width = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise Exception("%s is not a saved instruction stream of this version." % path)
+        offset = HEADER.size
+
+        def section(count, typecode="I"):
+            nonlocal offset
+            size = count * array(typecode).itemsize
+            values = view[offset:offset + size].cast(typecode)
+            offset += size
+            if sys.byteorder == "big":
+                values = array(typecode, values)
+                values.byteswap()
+            return values
+
+        ends = section(strings)
+        self.function_table = section(functions * 3, "i")
+        self.units = section(units * 2)
+        self.operands = section(instructions, "H" if width == 2 else "I")
+        self.opcodes = view[offset:offset + instructions]
+        offset += instructions
+        blob = view[offset:]
+        self.strings = []
+        start = 0
+        for end in ends:
+            self.strings.append(str(blob[start:end], "utf-8"))
+            start = end
+        self.next_unit = 0
+
+    def __len__(self):
+        return len(self.units) // 2
+
+    def function_signatures(self):
+        table = self.function_table
+        return {self.strings[table[i]]: None if table[i + 1] == -1 else TOKEN_TYPES[table[i + 1]] for i in range(0, len(table), 3)}
+
+    # Maps each function defined in the stream to the unit holding it.
+    def function_index(self):
+        table = self.function_table
+        return {self.strings[table[i]]: table[i + 2] for i in range(0, len(table), 3) if table[i + 2] != -1}
+
+    def unit(self, index):
+        start = self.units[index * 2]
+        count = self.units[index * 2 + 1]
+        strings = self.strings
+        operands = self.operands
+        opcodes = self.opcodes
+        return [Instruction(OPCODES[opcodes[i]], None, strings[operands[i]]) for i in range(start, start + count)]
+
+    def parse_statement(self):
+        if self.next_unit == len(self):
+            return None
+        self.next_unit += 1
+        return SavedUnit(self.unit(self.next_unit - 1))
+
+    def statements(self):
+        while True:
+            statement = self.parse_statement()
+            if statement is None:
+                return
+            yield statement
+
+    # Saved code has no source to key a function cache by.
+    def function_span(self):
+        return None
+
+
+# A top level statement read back from a saved stream.
+class SavedUnit:
+    __slots__ = ("instructions",)
+
+    def __init__(self, instructions):
+        self.instructions = instructions
+
+    def eval(self, compiler):
+        compiler.instructions.extend(self.instructions)
+
+
+def main():
+    from src.lexer import Lexer
+    from src.parser import Parser
+
+    arg_parser = argparse.ArgumentParser(description="Save the instructions of a MYL program, or lower saved ones.")
+    commands = arg_parser.add_subparsers(dest="command", required=True)
+    save_parser = commands.add_parser("save", help="run the front end and save its instructions")
+    save_parser.add_argument("source")
+    save_parser.add_argument("output")
+    compile_parser = commands.add_parser("compile", help="lower saved instructions to asm")
+    compile_parser.add_argument("ir")
+    compile_parser.add_argument("output")
+    dump_parser = commands.add_parser("dump", help="list saved instructions by function")
+    dump_parser.add_argument("ir")
+    args = arg_parser.parse_args()
+
+    if args.command == "save":
+        parser = Parser(Lexer(args.source))
+        parser.parse_advance()
+        save_ir(parser, args.output)
+    elif args.command == "compile":
+        reader = IRReader(args.ir)
+        Compiler(reader).compile(args.output)
+    else:
+        reader = IRReader(args.ir)
+        names = {unit: name for name, unit in reader.function_index().items()}
+        for index in range(len(reader)):
+            print("%s:" % names.get(index, "<top level>"))
+            for instr in reader.unit(index):
+                print("  %-22s %s" % (instr.opcode.name, instr.value))
+
+
+if __name__ == "__main__":
+    main()
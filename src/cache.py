@@ -0,0 +1,122 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import re
+
+# Bump when the layout of an entry or the generated code changes, so stale
+# entries are missed instead of spliced.
+CACHE_VERSION = 8
+
+CONSTANT_NAME = re.compile(r"\b(str|float)@(\d+)")
+
+
+# Keeps the lowered code of each function on disk, keyed by its source, the
+# signatures of the functions it calls and the options it was compiled
+# with. Entries are evicted least recently used first once the directory
+# grows past max_bytes.
+class FunctionCache:
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.name.endswith(".json"))
+
+    def key(self, source, callees, options=""):
+        digest = hashlib.sha256()
+        digest.update(("%s\n%s\n" % (CACHE_VERSION, options)).encode("utf-8"))
+        digest.update(source.encode("utf-8"))
+        for name, kind in sorted(callees.items()):
+            digest.update(("\n%s:%s" % (name, kind)).encode("utf-8"))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, "%s.json" % key)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        # The modification time doubles as the last use for eviction.
+        os.utime(path)
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        path = self.path(key)
+        temp = "%s.%s.tmp" % (path, os.getpid())
+        with open(temp, "w", encoding="utf-8") as file:
+            json.dump(entry, file)
+        self.size += os.path.getsize(temp)
+        os.replace(temp, path)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        entries = sorted((entry for entry in os.scandir(self.directory) if entry.name.endswith(".json")), key=lambda entry: entry.stat().st_mtime)
+        self.size = sum(entry.stat().st_size for entry in entries)
+        # Drop to three quarters of the budget so every put after a full
+        # cache does not rescan the directory.
+        target = self.max_bytes * 3 // 4
+        for entry in entries:
+            if self.size <= target:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except OSError:
+                continue
+            self.size -= size
+            self.evictions += 1
+
+    def stats(self):
+        return "%s hits, %s misses, %s evictions" % (self.hits, self.misses, self.evictions)
+
+    # Adds the counts of a copy of this cache used in another process.
+    def merge(self, other):
+        self.hits += other.hits
+        self.misses += other.misses
+        self.evictions += other.evictions
+
+
+# FunctionCache kept in memory, for a compiler that stays resident. Holds
+# at most max_entries functions, dropping the least recently used first.
+class MemoryFunctionCache(FunctionCache):
+
+    def __init__(self, max_entries=100000):
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+
+# Renames the constants of a fragment from the names given to them in one
+# build to their position in strings and floats, and back.
+def relocate(text, strings, floats):
+    names = {"str": strings, "float": floats}
+    return CONSTANT_NAME.sub(lambda match: "%s@%s" % (match.group(1), names[match.group(1)][match.group(2)]), text)
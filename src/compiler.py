@@ -1,5 +1,11 @@
-from token import *
+from collections import Counter, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from src.assembly import AsmWriter, Fragment, FragmentCollector, SizeCounter
+from src.cache import relocate
+from src.stats import NULL_STATS
+from src.token import *
 import ctypes
+import operator
 
 
 class Opcode(enum.IntEnum):
@@ -31,9 +37,14 @@ class Opcode(enum.IntEnum):
     CMP = 25
     IF = 26
     ENDIF = 27
-    JMPEQ = 28
+    JMPFALSE = 28
     JMP = 29
     ELSE = 30
+    STORE_VAR = 31
+    SET = 32
+    SELECT = 33
+    CHOOSE = 34
+    CHOSEN = 35
 
 
 class StackValueType(enum.IntEnum):
@@ -49,6 +60,73 @@ class StackValueType(enum.IntEnum):
     REGISTER64 = 9
     FLOAT_VAR = 10
     FLOAT_CONST = 11
+    # The outcome of a comparison in the flags, with its condition code
+    # as the value.
+    FLAGS = 12
+
+
+VAR_SIZES = {
+    StackValueType.INT8_VAR: "byte",
+    StackValueType.INT16_VAR: "word",
+    StackValueType.INT32_VAR: "dword",
+    StackValueType.INT64_VAR: "qword",
+    StackValueType.FLOAT_VAR: "dword",
+}
+
+VALUE_BITS = {
+    StackValueType.INT8_VAR: 8,
+    StackValueType.INT16_VAR: 16,
+    StackValueType.INT32_VAR: 32,
+    StackValueType.INT64_VAR: 64,
+    StackValueType.REGISTER8: 8,
+    StackValueType.REGISTER16: 16,
+    StackValueType.REGISTER32: 32,
+    StackValueType.REGISTER64: 64,
+    StackValueType.STRING_CONST: 64,
+}
+
+ACCUMULATORS = {8: "al", 16: "ax", 32: "eax", 64: "rax"}
+# The width of the variable each store declares, and of each return kind.
+STORE_BITS = {Opcode.STORE_INT8: 8, Opcode.STORE_INT16: 16, Opcode.STORE_INT32: 32, Opcode.STORE_INT64: 64}
+KIND_BITS = {TokenType.TOKEN_INT8: 8, TokenType.TOKEN_INT16: 16, TokenType.TOKEN_INT32: 32, TokenType.TOKEN_INT64: 64}
+# rbx by width, for a second operand next to the accumulator.
+SCRATCH = {8: "bl", 16: "bx", 32: "ebx", 64: "rbx"}
+RBX = set(SCRATCH.values())
+
+# The condition code of each comparison operator. Integers are signed.
+CONDITIONS = {
+    TokenType.TOKEN_ISEQ: "e",
+    TokenType.TOKEN_ISNEQ: "ne",
+    TokenType.TOKEN_ISL: "l",
+    TokenType.TOKEN_ISLE: "le",
+    TokenType.TOKEN_ISG: "g",
+    TokenType.TOKEN_ISGE: "ge",
+}
+# The condition holding where another does not.
+INVERSE_CONDITIONS = {"e": "ne", "ne": "e", "l": "ge", "ge": "l", "g": "le", "le": "g"}
+# The condition holding with the operands of the comparison swapped.
+SWAPPED_CONDITIONS = {"e": "e", "ne": "ne", "l": "g", "g": "l", "le": "ge", "ge": "le"}
+CONDITION_TESTS = {
+    "e": operator.eq,
+    "ne": operator.ne,
+    "l": operator.lt,
+    "le": operator.le,
+    "g": operator.gt,
+    "ge": operator.ge,
+}
+
+
+# Marks an exhausted eval generator in Compiler.evaluate.
+FINISHED = object()
+
+
+# Variable and register kinds holding an integer of each width.
+INTEGER_WIDTHS = {
+    8: (StackValueType.INT8_VAR, StackValueType.REGISTER8),
+    16: (StackValueType.INT16_VAR, StackValueType.REGISTER16),
+    32: (StackValueType.INT32_VAR, StackValueType.REGISTER32),
+    64: (StackValueType.INT64_VAR, StackValueType.REGISTER64),
+}
 
 
 class StackValue:
@@ -66,12 +144,20 @@ class Instruction:
         self.state = state
 
 
+# operand is where the variable lives, a stack slot or a register.
 class Variable:
-    def __init__(self, name, ptr, kind, cur_value):
+    def __init__(self, name, ptr, kind, cur_value, operand):
         self.name = name
         self.ptr = ptr
         self.kind = kind
         self.cur_value = cur_value
+        self.operand = operand
+
+
+# Raised for errors in the program being compiled, as opposed to bugs in the
+# compiler.
+class CompileError(Exception):
+    pass
 
 
 class Function:
@@ -81,27 +167,70 @@ class Function:
         self.has_return_value = False
 
 
+# Bookkeeping that lives for the whole lowering pass over the instructions.
+class CodegenState:
+    def __init__(self):
+        self.strings = {}
+        self.floats = {}
+        self.string_count = 0
+        self.float_count = 0
+        self.calling_stack_offset = 0
+        self.function = None
+        # The fragment of the function lowered last.
+        self.finished = None
+
+
 class Compiler:
 
-    def __init__(self, parser):
+    def __init__(self, parser, cache=None, includes=None, stats=NULL_STATS, peephole=None, passes=None):
         self.parser = parser
+        self.cache = cache
+        self.stats = stats
+        # Optimizes each function once it is lowered, if given.
+        self.peephole = peephole
+        # Runs over the SSA form of each function before it is lowered, if
+        # given.
+        self.passes = passes
+        # The pub functions of each module this one includes, by the name
+        # used in the include statement, with their return kinds.
+        self.includes = includes if includes is not None else {}
         self.instructions = []
         self.stack = []
-        self.state = ""
         self.vars = {}
         self.stack_offset = 0
         self.var_address_ptr = 0
+        # Whether the function being lowered calls any, so needs shadow space.
+        self.makes_calls = False
+        # The width of the values the arms of each ternary left, by the
+        # label ending it, see compile_choose.
+        self.chosen = {}
+        # The index of the instruction being lowered.
+        self.position = 0
         self.registers_64bit = ["r9", "r8", "rdx", "rcx"]
         self.registers_32bit = ["r9d", "r8d", "edx", "ecx"]
         self.functions = {}
-        self.code = ["SECTION .text\n"]
-        self.setup = []
-        self.data = []
+        # The function whose definition is being evaluated.
+        self.function = None
+        self.code = Fragment()
+        self.writer = None
         self.labels = 0
         self.last_type = None
+        self.codegen = CodegenState()
+        self.handlers = self.build_handlers()
+        # Imported here, the pass works on the nodes of src.parser, which
+        # imports this module, as the allocator does on its opcodes.
+        from src.fold import Folder
+        from src.regalloc import NO_ALLOCATION, RegisterAllocator
+        self.folder = Folder(self.functions)
+        self.allocator = RegisterAllocator(self.functions)
+        self.allocation = NO_ALLOCATION
+        # Counters of the optimizations made in worker processes.
+        self.worker_counts = Counter()
+        # Lowers functions only to measure them, see asm_size.
+        self.scratch = None
 
     def error(self, message):
-        raise Exception(message)
+        raise CompileError(message)
 
     def add(self, instr):
         self.instructions.append(instr)
@@ -147,19 +276,7 @@ class Compiler:
         self.code.append(" movss %s, %s\n" % (a, b))
 
     def pop_stack(self) -> StackValue:
-        stack_value = self.stack.pop()
-
-        if stack_value.kind == StackValueType.INT8_VAR:
-            return StackValue(StackValueType.INT8_VAR, "byte [rsp - %s]" % stack_value.value, stack_value.ptr)
-        elif stack_value.kind == StackValueType.INT16_VAR:
-            return StackValue(StackValueType.INT16_VAR, "word [rsp - %s]" % stack_value.value, stack_value.ptr)
-        elif stack_value.kind == StackValueType.INT32_VAR:
-            return StackValue(StackValueType.INT32_VAR, "dword [rsp - %s]" % stack_value.value, stack_value.ptr)
-        elif stack_value.kind == StackValueType.INT64_VAR:
-            return StackValue(StackValueType.INT64_VAR, "qword [rsp - %s]" % stack_value.value, stack_value.ptr)
-        elif stack_value.kind == StackValueType.FLOAT_VAR:
-            return StackValue(StackValueType.FLOAT_VAR, "dword [rsp - %s]" % stack_value.value, stack_value.ptr)
-        return stack_value
+        return self.stack.pop()
 
     def emit_mov(self, register="?"):
         stack_value = self.pop_stack()
@@ -200,64 +317,121 @@ class Compiler:
 
     def emit_var(self, name, byte_amount, stack_kind, var_kind):
         stack_value = self.pop_stack()
-        self.var_address_ptr += byte_amount
 
         if stack_value.kind == StackValueType.INT_CONST:
             value = stack_value.value
             stack_value.value = ctypes.c_int64(int(value)).value
 
-        self.stack_offset += 8
+        dest = self.allocation.register(name, VALUE_BITS[stack_kind]) if byte_amount > 1 and stack_kind != StackValueType.FLOAT_VAR else None
+        if dest is None:
+            self.var_address_ptr += byte_amount
+            self.stack_offset += 8
+            dest = "%s [rsp - %s]" % (var_kind, self.var_address_ptr)
         if "FLOAT" in stack_kind.name:
-            self.movss("%s [rsp - %s]" % (var_kind, self.var_address_ptr), stack_value.value)
+            if stack_value.kind == StackValueType.FLOAT_VAR:
+                self.movss("xmm0", stack_value.value)
+                stack_value.value = "xmm0"
+            self.movss(dest, stack_value.value)
+        elif stack_value.kind in VAR_SIZES:
+            # Initialized from another variable, e.g. once folding reduced
+            # x * 1 to x, in memory or in a register.
+            bits = VALUE_BITS[stack_kind]
+            if VALUE_BITS[stack_value.kind] != bits:
+                self.error("Cannot initialize the I%s variable %s with a value of a different width." % (bits, name))
+            if "[" in dest and "[" in stack_value.value:
+                # Memory to memory moves do not exist.
+                self.mov(ACCUMULATORS[bits], stack_value.value)
+                self.mov(dest, ACCUMULATORS[bits])
+            else:
+                self.mov(dest, stack_value.value)
         else:
-            self.mov("%s [rsp - %s]" % (var_kind, self.var_address_ptr), stack_value.value)
+            self.mov(dest, stack_value.value)
+
+        self.vars[name] = Variable(name, self.var_address_ptr, stack_kind, stack_value, dest)
+
+    def emit_assign(self, name):
+        var = self.vars.get(name)
+        if var is None:
+            self.error("Variable %s is assigned before it is declared." % name)
+
+        stack_value = self.pop_stack()
+        dest = var.operand
 
-        self.vars[name] = Variable(name, self.var_address_ptr, stack_kind, stack_value)
+        if stack_value.kind == StackValueType.INT_CONST:
+            self.mov(dest, ctypes.c_int64(int(stack_value.value)).value)
+        elif stack_value.kind == StackValueType.FLOAT_VAR or stack_value.kind == StackValueType.FLOAT_CONST:
+            if var.kind != StackValueType.FLOAT_VAR:
+                self.error("Cannot assign a float to %s." % name)
+            if stack_value.kind == StackValueType.FLOAT_VAR:
+                self.movss("xmm0", stack_value.value)
+            self.movss(dest, "xmm0")
+        else:
+            bits = VALUE_BITS[var.kind]
+            if VALUE_BITS.get(stack_value.kind) != bits:
+                self.error("Cannot assign a value of a different width to the I%s variable %s." % (bits, name))
+            if stack_value.kind in VAR_SIZES and "[" in dest and "[" in stack_value.value:
+                # Memory to memory moves do not exist, go through the accumulator.
+                self.mov(ACCUMULATORS[bits], stack_value.value)
+                self.mov(dest, ACCUMULATORS[bits])
+            else:
+                self.mov(dest, stack_value.value)
+
+    def evaluate(self, node):
+        node = self.folder.fold(node)
+        frames = []
+        nodes = 1
+        frame = node.eval(self)
+        if frame is not None:
+            frames.append(frame)
+        while frames:
+            child = next(frames[-1], FINISHED)
+            if child is FINISHED:
+                frames.pop()
+                continue
+            nodes += 1
+            frame = child.eval(self)
+            if frame is not None:
+                frames.append(frame)
+        self.stats.count("ast nodes", nodes)
 
     def walk_tree(self):
-        while True:
-            node = self.parser.parse_statement()
-            if node is None:
-                break
-            node.eval(self)
+        for node in self.parser.statements():
+            self.evaluate(node)
+
+    # Loads a into first and b into second. When b already sits in first,
+    # e.g. a call result on the right hand side, it is moved out of the way
+    # before a overwrites it.
+    def load_operands(self, first, second, a, b):
+        # rbx is callee saved, see Fragment.save.
+        if second in RBX:
+            self.code.save("rbx")
+        if b.value == first:
+            self.mov(second, b.value)
+            self.mov(first, a.value)
+        else:
+            self.mov(first, a.value)
+            self.mov(second, b.value)
 
     def add_int_consts(self, a, b):
         self.stack.append(StackValue(StackValueType.INT_CONST, str(int(a.value) + int(b.value))))
 
-    def get_register_for_type(self, value):
-        if value.kind == StackValueType.INT8_VAR:
-            return "al"
-        elif value.kind == StackValueType.INT16_VAR:
-            return "ax"
-        elif value.kind == StackValueType.INT32_VAR:
-            return self.pop_register(32)
-        elif value.kind == StackValueType.INT64_VAR:
-            return self.pop_register(64)
-        elif value.kind == StackValueType.INT_CONST:
-            return value.value
-        raise Exception("Unsupported kind.")
-
     def add_i8(self, a, b):
-        self.mov("ah", a.value)
-        self.mov("dh", b.value)
+        self.load_operands("ah", "dh", a, b)
         self.code.append(" add ah, dh\n")
         self.stack.append(StackValue(StackValueType.REGISTER8, "ah"))
 
     def add_i16(self, a, b):
-        self.mov("ax", a.value)
-        self.mov("dx", b.value)
+        self.load_operands("ax", "dx", a, b)
         self.code.append(" add ax, dx\n")
         self.stack.append(StackValue(StackValueType.REGISTER16, "ax"))
 
     def add_i32(self, a, b):
-        self.mov("eax", a.value)
-        self.mov("edx", b.value)
+        self.load_operands("eax", "edx", a, b)
         self.code.append(" add eax, edx\n")
         self.stack.append(StackValue(StackValueType.REGISTER32, "eax"))
 
     def add_i64(self, a, b):
-        self.mov("rax", a.value)
-        self.mov("rdx", b.value)
+        self.load_operands("rax", "rdx", a, b)
         self.code.append(" add rax, rdx\n")
         self.stack.append(StackValue(StackValueType.REGISTER64, "rax"))
 
@@ -265,26 +439,22 @@ class Compiler:
         self.stack.append(StackValue(StackValueType.INT_CONST, str(int(a.value) - int(b.value))))
 
     def sub_i8(self, a, b):
-        self.mov("ah", a.value)
-        self.mov("dh", b.value)
+        self.load_operands("ah", "dh", a, b)
         self.code.append(" sub ah, dh\n")
         self.stack.append(StackValue(StackValueType.REGISTER8, "ah"))
 
     def sub_i16(self, a, b):
-        self.mov("ax", a.value)
-        self.mov("dx", b.value)
+        self.load_operands("ax", "dx", a, b)
         self.code.append(" sub ax, dx\n")
         self.stack.append(StackValue(StackValueType.REGISTER16, "ax"))
 
     def sub_i32(self, a, b):
-        self.mov("eax", a.value)
-        self.mov("edx", b.value)
+        self.load_operands("eax", "edx", a, b)
         self.code.append(" sub eax, edx\n")
         self.stack.append(StackValue(StackValueType.REGISTER32, "eax"))
 
     def sub_i64(self, a, b):
-        self.mov("rax", a.value)
-        self.mov("rdx", b.value)
+        self.load_operands("rax", "rdx", a, b)
         self.code.append(" sub rax, rdx\n")
         self.stack.append(StackValue(StackValueType.REGISTER64, "rax"))
 
@@ -292,409 +462,790 @@ class Compiler:
         self.stack.append(StackValue(StackValueType.INT_CONST, str(int(a.value) * int(b.value))))
 
     def mul_i8(self, a, b):
-        self.mov("al", a.value)
-        self.mov("bl", b.value)
+        self.load_operands("al", "bl", a, b)
         self.code.append(" imul bl\n")
         self.stack.append(StackValue(StackValueType.REGISTER8, "al"))
 
     def mul_i16(self, a, b):
-        self.mov("ax", a.value)
-        self.mov("bx", b.value)
+        self.load_operands("ax", "bx", a, b)
         self.code.append(" imul bx\n")
         self.stack.append(StackValue(StackValueType.REGISTER16, "ax"))
 
     def mul_i32(self, a, b):
-        self.mov("eax", a.value)
-        self.mov("ebx", b.value)
+        self.load_operands("eax", "ebx", a, b)
         self.code.append(" imul ebx\n")
         self.stack.append(StackValue(StackValueType.REGISTER32, "eax"))
 
     def mul_i64(self, a, b):
-        self.mov("rax", a.value)
-        self.mov("rdx", b.value)
+        self.load_operands("rax", "rdx", a, b)
         self.code.append(" imul rdx\n")
         self.stack.append(StackValue(StackValueType.REGISTER64, "rax"))
 
     def div_int_consts(self, a, b):
-        self.stack.append(StackValue(StackValueType.INT_CONST, str(int(a.value) / int(b.value))))
+        if int(b.value) == 0:
+            self.error("Division by zero.")
+        self.stack.append(StackValue(StackValueType.INT_CONST, str(truncating_division(int(a.value), int(b.value)))))
 
     def div_i8(self, a, b):
-        self.mov("al", a.value)
+        self.load_operands("al", "bl", a, b)
         self.code.append(" cbw\n")
-        self.mov("bl", b.value)
         self.code.append(" idiv bl\n")
         self.stack.append(StackValue(StackValueType.REGISTER8, "al"))
 
     def div_i16(self, a, b):
-        self.mov("ax", a.value)
+        self.load_operands("ax", "bx", a, b)
         self.code.append(" cwd\n")
-        self.mov("bx", b.value)
         self.code.append(" idiv bx\n")
         self.stack.append(StackValue(StackValueType.REGISTER16, "ax"))
 
     def div_i32(self, a, b):
-        self.mov("eax", a.value)
+        self.load_operands("eax", "ebx", a, b)
         self.code.append(" cdq\n")
-        self.mov("ebx", b.value)
         self.code.append(" idiv ebx\n")
         self.stack.append(StackValue(StackValueType.REGISTER32, "eax"))
 
     def div_i64(self, a, b):
-        self.mov("rax", a.value)
-        self.code.append(" cdq\n")
-        self.mov("rbx", b.value)
+        self.load_operands("rax", "rbx", a, b)
+        self.code.append(" cqo\n")
         self.code.append(" idiv rbx\n")
         self.stack.append(StackValue(StackValueType.REGISTER64, "rax"))
 
-    def emit_cmp(self, a, b):
-        register_a = self.get_register_for_type(a)
-        register_b = self.get_register_for_type(b)
-
-        self.mov(register_a, a.value)
-        self.mov(register_b, b.value)
-        self.code.append(" cmp %s, %s\n" % (register_a, register_b))
-
-    def compile_div_op(self, a, b):
-        if a.kind == StackValueType.INT_CONST:
-            if b.kind == StackValueType.INT_CONST:
-                self.div_int_consts(a, b)
-            elif b.kind == StackValueType.INT8_VAR:
-                self.div_i8(a, b)
-            elif b.kind == StackValueType.INT16_VAR:
-                self.div_i16(a, b)
-            elif b.kind == StackValueType.INT32_VAR:
-                self.div_i32(a, b)
-            elif b.kind == StackValueType.INT64_VAR:
-                self.div_i64(a, b)
-        elif a.kind == StackValueType.REGISTER8 or a.kind == StackValueType.INT8_VAR:
-            if b.kind == StackValueType.INT_CONST or b.kind == StackValueType.INT8_VAR or b.kind == StackValueType.REGISTER8:
-                self.div_i8(a, b)
-            else:
-                self.error("An I8 can only be divided by another I8 or Int Constant.")
-        elif a.kind == StackValueType.REGISTER16 or a.kind == StackValueType.INT16_VAR:
-            if b.kind == StackValueType.INT_CONST or b.kind == StackValueType.INT16_VAR or b.kind == StackValueType.REGISTER16:
-                self.div_i16(a, b)
-            else:
-                self.error("An I16 can only be divided by another I16 or Int Constant.")
-        elif a.kind == StackValueType.REGISTER32 or a.kind == StackValueType.INT32_VAR:
-            if b.kind == StackValueType.INT_CONST or b.kind == StackValueType.INT32_VAR or b.kind == StackValueType.REGISTER32:
-                self.div_i32(a, b)
-            else:
-                self.error("An I32 can only be divided by another I32 or Int Constant.")
-        elif a.kind == StackValueType.REGISTER64 or a.kind == StackValueType.INT64_VAR:
-            if b.kind == StackValueType.INT_CONST or b.kind == StackValueType.INT64_VAR or b.kind == StackValueType.REGISTER64:
-                self.div_i64(a, b)
-            else:
-                self.error("An I64 can only be divided by another I64 or Int Constant.")
-
-    def compile_sub_op(self, a, b):
-        if a.kind == StackValueType.INT_CONST:
-            if b.kind == StackValueType.INT_CONST:
-                self.sub_int_consts(a, b)
-            elif b.kind == StackValueType.INT8_VAR:
-                self.sub_i8(a, b)
-            elif b.kind == StackValueType.INT16_VAR:
-                self.sub_i16(a, b)
-            elif b.kind == StackValueType.INT32_VAR:
-                self.sub_i32(a, b)
-            elif b.kind == StackValueType.INT64_VAR:
-                self.sub_i64(a, b)
-        elif a.kind == StackValueType.REGISTER8 or a.kind == StackValueType.INT8_VAR:
-            if b.kind == StackValueType.INT_CONST or b.kind == StackValueType.INT8_VAR or b.kind == StackValueType.REGISTER8:
-                self.sub_i8(a, b)
-            else:
-                self.error("An I8 can only be subtracted by another I8 or Int Constant.")
-        elif a.kind == StackValueType.REGISTER16 or a.kind == StackValueType.INT16_VAR:
-            if b.kind == StackValueType.INT_CONST or b.kind == StackValueType.INT16_VAR or b.kind == StackValueType.REGISTER16:
-                self.sub_i16(a, b)
-            else:
-                self.error("An I16 can only be subtracted by another I16 or Int Constant.")
-        elif a.kind == StackValueType.REGISTER32 or a.kind == StackValueType.INT32_VAR:
-            if b.kind == StackValueType.INT_CONST or b.kind == StackValueType.INT32_VAR or b.kind == StackValueType.REGISTER32:
-                self.sub_i32(a, b)
-            else:
-                self.error("An I32 can only be subtracted by another I32 or Int Constant.")
-        elif a.kind == StackValueType.REGISTER64 or a.kind == StackValueType.INT64_VAR:
-            if b.kind == StackValueType.INT_CONST or b.kind == StackValueType.INT64_VAR or b.kind == StackValueType.REGISTER64:
-                self.sub_i64(a, b)
-            else:
-                self.error("An I64 can only be subtracted by another I64 or Int Constant.")
-
-    def compile_add_op(self, a, b):
-        if a.kind == StackValueType.INT_CONST:
-            if b.kind == StackValueType.INT_CONST:
-                self.add_int_consts(a, b)
-            elif b.kind == StackValueType.INT8_VAR:
-                self.add_i8(a, b)
-            elif b.kind == StackValueType.INT16_VAR:
-                self.add_i16(a, b)
-            elif b.kind == StackValueType.INT32_VAR:
-                self.add_i32(a, b)
-            elif b.kind == StackValueType.INT64_VAR:
-                self.add_i64(a, b)
-
-        elif a.kind == StackValueType.REGISTER8 or a.kind == StackValueType.INT8_VAR:
-            if b.kind == StackValueType.INT_CONST or b.kind == StackValueType.INT8_VAR or b.kind == StackValueType.REGISTER8:
-                self.add_i8(a, b)
-            else:
-                self.error("An I8 can only be added to another I8 or Int Constant.")
-
-        elif a.kind == StackValueType.REGISTER16 or a.kind == StackValueType.INT16_VAR:
-            if b.kind == StackValueType.INT_CONST or b.kind == StackValueType.INT16_VAR or b.kind == StackValueType.REGISTER16:
-                self.add_i16(a, b)
-            else:
-                self.error("An I16 can only be added to another I16 or Int Constant.")
-
-        elif a.kind == StackValueType.REGISTER32 or a.kind == StackValueType.INT32_VAR:
-            if b.kind == StackValueType.INT_CONST or b.kind == StackValueType.INT32_VAR or b.kind == StackValueType.REGISTER32:
-                self.add_i32(a, b)
-            else:
-                self.error("An I32 can only be added to another I32 or Int Constant.")
-
-        elif a.kind == StackValueType.REGISTER64 or a.kind == StackValueType.INT64_VAR:
-            if b.kind == StackValueType.INT_CONST or b.kind == StackValueType.INT64_VAR or b.kind == StackValueType.REGISTER64:
-                self.add_i64(a, b)
-            else:
-                self.error("An I64 can only be added to another I64 or Int Constant.")
-
-    def compile_mul_op(self, a, b):
+    # Compares a with b and returns the condition code holding where the
+    # comparison does, with the width compared in. A constant can only be
+    # the right hand operand, so one on the left swaps the operands and the
+    # condition.
+    def emit_cmp(self, a, b, condition):
         if a.kind == StackValueType.INT_CONST:
-            if b.kind == StackValueType.INT_CONST:
-                self.mul_int_consts(a, b)
-            elif b.kind == StackValueType.INT8_VAR:
-                self.mul_i8(a, b)
-            elif b.kind == StackValueType.INT16_VAR:
-                self.mul_i16(a, b)
-            elif b.kind == StackValueType.INT32_VAR:
-                self.mul_i32(a, b)
-            elif b.kind == StackValueType.INT64_VAR:
-                self.mul_i64(a, b)
-        elif a.kind == StackValueType.REGISTER8 or a.kind == StackValueType.INT8_VAR:
-            if b.kind == StackValueType.INT_CONST or b.kind == StackValueType.INT8_VAR or b.kind == StackValueType.REGISTER8:
-                self.mul_i8(a, b)
-            else:
-                self.error("An I8 can only be multiplied by another I8 or Int Constant.")
-        elif a.kind == StackValueType.REGISTER16 or a.kind == StackValueType.INT16_VAR:
-            if b.kind == StackValueType.INT_CONST or b.kind == StackValueType.INT16_VAR or b.kind == StackValueType.REGISTER16:
-                self.mul_i16(a, b)
-            else:
-                self.error("An I16 can only be multiplied by another I16 or Int Constant.")
-        elif a.kind == StackValueType.REGISTER32 or a.kind == StackValueType.INT32_VAR:
-            if b.kind == StackValueType.INT_CONST or b.kind == StackValueType.INT32_VAR or b.kind == StackValueType.REGISTER32:
-                self.mul_i32(a, b)
-            else:
-                self.error("An I32 can only be multiplied by another I32 or Int Constant.")
-        elif a.kind == StackValueType.REGISTER64 or a.kind == StackValueType.INT64_VAR:
-            if b.kind == StackValueType.INT_CONST or b.kind == StackValueType.INT64_VAR or b.kind == StackValueType.REGISTER64:
-                self.mul_i64(a, b)
-            else:
-                self.error("An I64 can only be multiplied by another I64 or Int Constant.")
+            a, b = b, a
+            condition = SWAPPED_CONDITIONS[condition]
+        bits = self.common_bits(a, b, "compared")
+        left = a.value
+        right = b.value
+        if b.kind == StackValueType.INT_CONST:
+            right = ctypes.c_int64(int(right)).value
+            if not -2 ** 31 <= right < 2 ** 31:
+                # The immediate of cmp is 32 bits, sign extended.
+                self.code.save("rbx")
+                self.mov("rbx", right)
+                right = "rbx"
+        elif "[" in left and "[" in right:
+            # Memory to memory compares do not exist, go through the accumulator.
+            self.mov(ACCUMULATORS[bits], left)
+            left = ACCUMULATORS[bits]
+        self.code.append(" cmp %s, %s\n" % (left, right))
+        return condition, bits
+
+    # The width two integers are worked on in together, that of the one that
+    # is not a constant, None for two constants.
+    def common_bits(self, a, b, verb):
+        for value in (a, b):
+            if value.kind != StackValueType.INT_CONST and (value.kind not in VALUE_BITS or value.kind == StackValueType.STRING_CONST):
+                self.error("A %s cannot be %s." % (value.kind.name, verb))
+        bits_a = VALUE_BITS.get(a.kind)
+        bits_b = VALUE_BITS.get(b.kind)
+        if bits_a is not None and bits_b is not None and bits_a != bits_b:
+            self.error("An I%s and an I%s cannot be %s." % (bits_a, bits_b, verb))
+        return bits_a or bits_b
+
+    def compare_consts(self, a, b, condition):
+        a = ctypes.c_int64(int(a.value)).value
+        b = ctypes.c_int64(int(b.value)).value
+        return StackValue(StackValueType.INT_CONST, str(int(CONDITION_TESTS[condition](a, b))))
+
+    # The condition code under which an integer holds, comparing it to 0
+    # unless it is the flags of a comparison already.
+    def test_condition(self, value):
+        if value.kind == StackValueType.FLAGS:
+            return value.value
+        if value.kind not in VALUE_BITS or value.kind == StackValueType.STRING_CONST:
+            self.error("A %s cannot be a condition." % value.kind.name)
+        if "[" in value.value:
+            self.code.append(" cmp %s, 0\n" % value.value)
+        else:
+            self.code.append(" test %s, %s\n" % (value.value, value.value))
+        return "ne"
 
+    # NASM local labels, scoped by the label of the function they are in,
+    # so a function's code does not depend on the functions before it.
     def gen_label(self):
-        label = "L%s" % self.labels
+        label = ".L%s" % self.labels
         self.labels += 1
         return label
 
-    def compile(self, path):
-        self.walk_tree()
-        file = open(path, "w")
-
-        setup_stack_idx = 0
-        strings = {}
-        floats = {}
-        string_count = 0
-        float_count = 0
-        calling_stack_offset = 0
-        function = None
-
-        for ip in range(0, len(self.instructions)):
-            instr = self.instructions[ip]
-
-            if instr.opcode == Opcode.START_PROC:
-                self.vars.clear()
-                self.stack_offset = 0
-                self.var_address_ptr = 0
-                self.code.append("%s:\n" % instr.value)
-                function = self.functions[instr.value]
-
-            elif instr.opcode == Opcode.START_PUB_PROC:
-                self.code.append("%s:\n" % instr.value)
-                self.setup.append("global %s\n" % instr.value)
-                function = self.functions[instr.value]
-
-            elif instr.opcode == Opcode.SETUP_STACK:
-                setup_stack_idx = len(self.code)
-                self.code.append(" push rbp\n")
-                self.mov("rbp", "rsp")
-                self.code.append(" sub rsp, #\n")
-
-            elif instr.opcode == Opcode.CLOSE_STACK:
-                if self.stack_offset <= 0:
-                    for i in range(0, 3):
-                        self.code.pop(setup_stack_idx)
-                    continue
-                sub_idx = setup_stack_idx + 2
-                self.code[sub_idx] = self.code[sub_idx].replace("#", "%s" % hex(32 + self.stack_offset))
-                self.code.append(" add rsp, %s\n" % hex(32 + self.stack_offset))
-                self.code.append(" leave\n")
-
-            elif instr.opcode == Opcode.MOV_INT_CONST:
-                self.stack.append(StackValue(StackValueType.INT_CONST, instr.value))
-
-            elif instr.opcode == Opcode.MOV_FLOAT_CONST:
-                float_name = ""
-                if instr.value not in floats:
-                    float_name = "float%s" % float_count
-                    self.data.append("%s: dd %s\n" % (float_name, instr.value))
-                    floats[instr.value] = float_name
-                    float_count += 1
-                else:
-                    float_name = floats[instr.value]
-                self.movss("xmm0", "dword [%s]" % float_name)
-                self.stack.append(StackValue(StackValueType.FLOAT_CONST, "xmm0"))
-
-            elif instr.opcode == Opcode.MOV_UNSIGNED_INT_CONST:
-                self.stack.append(StackValue(StackValueType.INT_CONST, int("-%s" % instr.value) + 2 ** 32))
-
-            elif instr.opcode == Opcode.NOT:
-                stack_value = int(self.pop_stack().value)
-                self.stack.append(
-                    StackValue(StackValueType.INT_CONST, str(0 if stack_value < 0 or stack_value > 0 else 1)))
-
-            elif instr.opcode == Opcode.ADD:
-                b = self.pop_stack()
-                a = self.pop_stack()
-                print("%s %s" % (a.value, b.value))
-                self.compile_add_op(a, b)
+    def begin_function(self, name, public):
+        self.vars.clear()
+        self.stack_offset = 0
+        self.var_address_ptr = 0
+        self.makes_calls = False
+        self.chosen.clear()
+        self.code = Fragment(name, public)
+        self.codegen.function = self.functions[name]
+        self.allocation = self.allocator.allocation(name)
+        for register in self.allocation.saved:
+            self.code.save(register)
+
+    def compile_start_proc(self, instr):
+        self.begin_function(instr.value, False)
+
+    def compile_start_pub_proc(self, instr):
+        self.begin_function(instr.value, True)
+
+    def compile_setup_stack(self, instr):
+        self.code.open_frame()
+
+    def compile_close_stack(self, instr):
+        # Variables kept in registers take no stack, but a function that calls
+        # still sets up the frame with the shadow space, even once the passes
+        # removed all of its variables.
+        self.code.frame_size = 32 + self.stack_offset if self.stack_offset or self.makes_calls else 0
+
+    def compile_mov_int_const(self, instr):
+        self.stack.append(StackValue(StackValueType.INT_CONST, instr.value))
+
+    # Returns the data section name of a float constant, passing its
+    # definition to add_data the first time the value is seen.
+    def pool_float(self, value, add_data):
+        floats = self.codegen.floats
+        float_name = floats.get(value)
+        if float_name is None:
+            float_name = "float@%s" % self.codegen.float_count
+            add_data("%s: dd %s\n" % (float_name, value))
+            floats[value] = float_name
+            self.codegen.float_count += 1
+        return float_name
+
+    def pool_string(self, value, add_data):
+        strings = self.codegen.strings
+        string = strings.get(value)
+        if string is None:
+            string = "str@%s" % self.codegen.string_count
+            add_data("%s: db `%s`, 0\n" % (string, value))
+            strings[value] = string
+            self.codegen.string_count += 1
+        return string
+
+    def compile_mov_float_const(self, instr):
+        float_name = self.pool_float(instr.value, self.writer.add_data)
+        self.movss("xmm0", "dword [%s]" % float_name)
+        self.stack.append(StackValue(StackValueType.FLOAT_CONST, "xmm0"))
+
+    def compile_mov_unsigned_int_const(self, instr):
+        self.stack.append(StackValue(StackValueType.INT_CONST, int("-%s" % instr.value) + 2 ** 32))
+
+    def compile_negate(self, instr):
+        stack_value = self.pop_stack()
+        if stack_value.kind == StackValueType.INT_CONST:
+            self.stack.append(StackValue(StackValueType.INT_CONST, str(-int(stack_value.value))))
+            return
+        register = self.load_accumulator(stack_value, "negated")
+        self.code.append(" neg %s\n" % register)
 
-            elif instr.opcode == Opcode.JMPEQ:
-                self.code.append(" je %s\n" % instr.value)
+    def compile_not(self, instr):
+        stack_value = self.pop_stack()
+        if stack_value.kind == StackValueType.INT_CONST:
+            value = int(stack_value.value)
+            self.stack.append(StackValue(StackValueType.INT_CONST, str(0 if value < 0 or value > 0 else 1)))
+            return
+        register = self.load_accumulator(stack_value, "negated")
+        self.code.append(" test %s, %s\n" % (register, register))
+        self.code.append(" sete al\n")
+        if register != "al":
+            # Writing eax clears the upper half of rax as well.
+            self.code.append(" movzx %s, al\n" % ("eax" if register == "rax" else register))
+
+    # Loads an integer into the accumulator of its width and leaves the
+    # accumulator on the stack in its place.
+    def load_accumulator(self, stack_value, verb):
+        bits = VALUE_BITS.get(stack_value.kind)
+        if bits is None or stack_value.kind == StackValueType.STRING_CONST:
+            self.error("A %s cannot be %s." % (stack_value.kind.name, verb))
+        register = ACCUMULATORS[bits]
+        self.mov(register, stack_value.value)
+        self.stack.append(StackValue(INTEGER_WIDTHS[bits][1], register))
+        return register
 
-            elif instr.opcode == Opcode.JMP:
+    def compile_arithmetic(self, instr):
+        b = self.pop_stack()
+        a = self.pop_stack()
+        emitter = ARITHMETIC.get((instr.opcode, a.kind, b.kind))
+        if emitter is None:
+            self.arithmetic_error(instr.opcode, a, b)
+        emitter(self, a, b)
+
+    def arithmetic_error(self, opcode, a, b):
+        verb = ARITHMETIC_VERBS[opcode]
+        for bits, kinds in INTEGER_WIDTHS.items():
+            if a.kind in kinds or (a.kind == StackValueType.INT_CONST and b.kind in kinds):
+                self.error("An I%s can only be %s another I%s or Int Constant." % (bits, verb, bits))
+        self.error("A %s cannot be %s a %s." % (a.kind.name, verb, b.kind.name))
+
+    # Jumps to the label where the condition on the stack does not hold, so
+    # the code for where it does follows without a jump of its own.
+    def compile_jmpfalse(self, instr):
+        value = self.pop_stack()
+        if value.kind == StackValueType.INT_CONST:
+            if int(value.value) == 0:
                 self.code.append(" jmp %s\n" % instr.value)
+            return
+        condition = self.test_condition(value)
+        self.code.append(" j%s %s\n" % (INVERSE_CONDITIONS[condition], instr.value))
+
+    def compile_jmp(self, instr):
+        self.code.append(" jmp %s\n" % instr.value)
+
+    def compile_label(self, instr):
+        self.code.append("%s:\n" % instr.value)
+
+    # Leaves the flags of the comparison for the branch or select taking
+    # them. Two constants compare to a constant.
+    def compile_cmp(self, instr):
+        b = self.pop_stack()
+        a = self.pop_stack()
+        if a.kind == StackValueType.INT_CONST and b.kind == StackValueType.INT_CONST:
+            self.stack.append(self.compare_consts(a, b, instr.value))
+            return
+        condition, _ = self.emit_cmp(a, b, instr.value)
+        self.stack.append(StackValue(StackValueType.FLAGS, condition))
+
+    # A comparison used as a value: 1 where it holds and 0 where it does
+    # not, in the width of its operands.
+    def compile_set(self, instr):
+        b = self.pop_stack()
+        a = self.pop_stack()
+        if a.kind == StackValueType.INT_CONST and b.kind == StackValueType.INT_CONST:
+            self.stack.append(self.compare_consts(a, b, instr.value))
+            return
+        condition, bits = self.emit_cmp(a, b, instr.value)
+        register = ACCUMULATORS[bits]
+        self.code.append(" set%s al\n" % condition)
+        if bits > 8:
+            # Writing eax clears the upper half of rax as well.
+            self.movzx("eax" if bits == 64 else register, "al")
+        self.stack.append(StackValue(INTEGER_WIDTHS[bits][1], register))
+
+    # The width the instruction after this one takes a value in: the width
+    # of the variable or the return value it is stored in, else 64. Only
+    # needed for a value picked from two constants, which fit any width.
+    def taken_bits(self):
+        following = self.instructions[self.position + 1] if self.position + 1 < len(self.instructions) else None
+        if following is None:
+            return 64
+        if following.opcode == Opcode.STORE_VAR:
+            var = self.vars.get(following.value)
+            return VALUE_BITS.get(var.kind, 64) if var is not None else 64
+        if following.opcode == Opcode.RETURN:
+            return KIND_BITS.get(self.codegen.function.kind, 64)
+        return STORE_BITS.get(following.opcode, 64)
+
+    # The value of a ternary, one of two literals or variables picked by a
+    # cmov on the condition, without a branch. Two constants are picked in
+    # the width they are taken in. cmov has no byte form, bytes are picked
+    # as 32 bit values.
+    def compile_select(self, instr):
+        else_value = self.pop_stack()
+        then_value = self.pop_stack()
+        condition = self.pop_stack()
+        if condition.kind == StackValueType.INT_CONST:
+            self.stack.append(then_value if int(condition.value) != 0 else else_value)
+            return
+        bits = self.common_bits(then_value, else_value, "selected") or self.taken_bits()
+        condition = self.test_condition(condition)
+        wide = 32 if bits == 8 else bits
+        self.load_selected(ACCUMULATORS[wide], else_value)
+        source = then_value.value
+        if then_value.kind == StackValueType.INT_CONST or then_value.kind == StackValueType.INT8_VAR:
+            # rbx is callee saved, see Fragment.save.
+            self.code.save("rbx")
+            source = SCRATCH[wide]
+            self.load_selected(source, then_value)
+        self.code.append(" cmov%s %s, %s\n" % (condition, ACCUMULATORS[wide], source))
+        self.stack.append(StackValue(INTEGER_WIDTHS[bits][1], ACCUMULATORS[bits]))
+
+    # Leaves the value of one arm of a ternary in the accumulator, at the
+    # end of the branch computing it. A constant is loaded whole, so it
+    # holds in the width of the other arm too.
+    def compile_choose(self, instr):
+        value = self.pop_stack()
+        bits = self.common_bits(value, value, "selected")
+        if bits is None:
+            self.mov("rax", ctypes.c_int64(int(value.value)).value)
+            return
+        other = self.chosen.setdefault(instr.value, bits)
+        if other != bits:
+            self.error("An I%s and an I%s cannot be selected." % (other, bits))
+        self.mov(ACCUMULATORS[bits], value.value)
 
-            elif instr.opcode == Opcode.IF:
-                self.code.append("%s:\n" % instr.value)
-
-            elif instr.opcode == Opcode.ELSE:
-                self.code.append("%s:\n" % instr.value)
-
-            elif instr.opcode == Opcode.ENDIF:
-                self.code.append("%s:\n" % instr.value)
-
-            elif instr.opcode == Opcode.SUB:
-                b = self.pop_stack()
-                a = self.pop_stack()
-                self.compile_sub_op(a, b)
-
-            elif instr.opcode == Opcode.MUL:
-                b = self.pop_stack()
-                a = self.pop_stack()
-                self.compile_mul_op(a, b)
-
-            elif instr.opcode == Opcode.DIV:
-                b = self.pop_stack()
-                a = self.pop_stack()
-                self.compile_div_op(a, b)
-
-            elif instr.opcode == Opcode.CMP:
-                b = self.pop_stack()
-                a = self.pop_stack()
-                self.emit_cmp(a, b)
-                self.reset_registers()
-
-            elif instr.opcode == Opcode.RETURN:
-                if self.stack:
-                    if function.kind is None:
-                        self.error("Function has no returning value.")
-                    if function.kind == TokenType.TOKEN_INT64:
-                        self.emit_mov("rax")
-                    elif function.kind == TokenType.TOKEN_INT32:
-                        self.emit_mov("eax")
-                    elif function.kind == TokenType.TOKEN_INT16:
-                        self.emit_mov("ax")
-                    elif function.kind == TokenType.TOKEN_INT8:
-                        self.emit_mov("al")
-                    function.has_return_value = True
-                else:
-                    self.code.append(" ret\n")
-
-            elif instr.opcode == Opcode.STORE_INT8:
-                self.emit_var(instr.value, 1, StackValueType.INT8_VAR, "byte")
-
-            elif instr.opcode == Opcode.STORE_INT16:
-                self.emit_var(instr.value, 2, StackValueType.INT16_VAR, "word")
-
-            elif instr.opcode == Opcode.STORE_INT32:
-                self.emit_var(instr.value, 4, StackValueType.INT32_VAR, "dword")
-
-            elif instr.opcode == Opcode.STORE_FLOAT64:
-                self.emit_var(instr.value, 4, StackValueType.FLOAT_VAR, "dword")
-
-            elif instr.opcode == Opcode.STORE_INT64:
-                self.emit_var(instr.value, 8, StackValueType.INT64_VAR, "qword")
+    # The value of a ternary whose arms left it in rax, in their width.
+    def compile_chosen(self, instr):
+        bits = self.chosen.pop(instr.value, None) or self.taken_bits()
+        self.stack.append(StackValue(INTEGER_WIDTHS[bits][1], ACCUMULATORS[bits]))
 
-            elif instr.opcode == Opcode.LOAD_STRING:
-                if instr.value not in strings:
-                    string = "str%s" % string_count
-                    self.data.append("%s: db `%s`, 0\n" % (string, instr.value))
-                    strings[instr.value] = string
-                    self.stack.append(StackValue(StackValueType.STRING_CONST, string))
-                    string_count += 1
+    def load_selected(self, register, value):
+        if value.kind == StackValueType.INT8_VAR:
+            self.code.append(" movsx %s, %s\n" % (register, value.value))
+        elif value.kind == StackValueType.INT_CONST:
+            self.mov(register, ctypes.c_int64(int(value.value)).value)
+        else:
+            self.mov(register, value.value)
+
+    def compile_return(self, instr):
+        if self.stack:
+            function = self.codegen.function
+            if function.kind is None:
+                self.error("Function has no returning value.")
+            if function.kind == TokenType.TOKEN_INT64:
+                self.emit_mov("rax")
+            elif function.kind == TokenType.TOKEN_INT32:
+                self.emit_mov("eax")
+            elif function.kind == TokenType.TOKEN_INT16:
+                self.emit_mov("ax")
+            elif function.kind == TokenType.TOKEN_INT8:
+                self.emit_mov("al")
+        self.code.ret()
+
+    def compile_store_int8(self, instr):
+        self.emit_var(instr.value, 1, StackValueType.INT8_VAR, "byte")
+
+    def compile_store_int16(self, instr):
+        self.emit_var(instr.value, 2, StackValueType.INT16_VAR, "word")
+
+    def compile_store_int32(self, instr):
+        self.emit_var(instr.value, 4, StackValueType.INT32_VAR, "dword")
+
+    def compile_store_int64(self, instr):
+        self.emit_var(instr.value, 8, StackValueType.INT64_VAR, "qword")
+
+    def compile_store_float64(self, instr):
+        self.emit_var(instr.value, 4, StackValueType.FLOAT_VAR, "dword")
+
+    def compile_store_var(self, instr):
+        self.emit_assign(instr.value)
+
+    def compile_load_string(self, instr):
+        string = self.pool_string(instr.value, self.writer.add_data)
+        self.stack.append(StackValue(StackValueType.STRING_CONST, string))
+
+    def compile_extern(self, instr):
+        self.writer.extern(instr.value)
+
+    def compile_call(self, instr):
+        self.code.append(" call %s\n" % instr.value)
+        self.makes_calls = True
+
+        if instr.value in self.functions and self.functions[instr.value].kind is not None:
+            kind = self.functions[instr.value].kind
+            if kind == TokenType.TOKEN_INT8:
+                self.stack.append(StackValue(StackValueType.REGISTER8, "al"))
+            elif kind == TokenType.TOKEN_INT16:
+                self.stack.append(StackValue(StackValueType.REGISTER16, "ax"))
+            elif kind == TokenType.TOKEN_INT32:
+                self.stack.append(StackValue(StackValueType.REGISTER32, "eax"))
+            elif kind == TokenType.TOKEN_INT64:
+                self.stack.append(StackValue(StackValueType.REGISTER64, "rax"))
+
+        self.reset_registers()
+        self.codegen.calling_stack_offset = 0
+
+    def compile_load_var(self, instr):
+        var = self.vars[instr.value]
+        self.stack.append(StackValue(var.kind, var.operand, var.ptr))
+
+    def compile_push_argument(self, instr):
+        register = self.emit_mov()
+
+        # Move the arguments on the stack.
+        if register == "rax" or register == "eax":
+            self.mov("[rsp + %s]" % hex(32 + self.codegen.calling_stack_offset), register)
+            self.codegen.calling_stack_offset += 8
+
+    def compile_end_proc(self, instr):
+        # If the function already ended on a return, don't emit ret again.
+        if not self.code.last_was_ret:
+            self.code.ret()
+        if self.peephole is not None:
+            self.peephole.optimize(self.code)
+        self.writer.write_fragment(self.code)
+        self.codegen.finished = self.code
+        self.code = Fragment()
+
+    def compile_unknown(self, instr):
+        self.error("No code generation for opcode %s." % instr.opcode.name)
+
+    # Builds the handler table indexed by opcode value.
+    def build_handlers(self):
+        handlers = {
+            Opcode.START_PROC: self.compile_start_proc,
+            Opcode.START_PUB_PROC: self.compile_start_pub_proc,
+            Opcode.END_PROC: self.compile_end_proc,
+            Opcode.MOV_INT_CONST: self.compile_mov_int_const,
+            Opcode.MOV_UNSIGNED_INT_CONST: self.compile_mov_unsigned_int_const,
+            Opcode.NEGATE: self.compile_negate,
+            Opcode.NOT: self.compile_not,
+            Opcode.RETURN: self.compile_return,
+            Opcode.STORE_INT8: self.compile_store_int8,
+            Opcode.STORE_INT16: self.compile_store_int16,
+            Opcode.STORE_INT32: self.compile_store_int32,
+            Opcode.STORE_INT64: self.compile_store_int64,
+            Opcode.SETUP_STACK: self.compile_setup_stack,
+            Opcode.CLOSE_STACK: self.compile_close_stack,
+            Opcode.LOAD_VAR: self.compile_load_var,
+            Opcode.CALL: self.compile_call,
+            Opcode.EXTERN: self.compile_extern,
+            Opcode.LOAD_STRING: self.compile_load_string,
+            Opcode.PUSH_ARGUMENT: self.compile_push_argument,
+            Opcode.ADD: self.compile_arithmetic,
+            Opcode.SUB: self.compile_arithmetic,
+            Opcode.MUL: self.compile_arithmetic,
+            Opcode.DIV: self.compile_arithmetic,
+            Opcode.STORE_FLOAT64: self.compile_store_float64,
+            Opcode.MOV_FLOAT_CONST: self.compile_mov_float_const,
+            Opcode.CMP: self.compile_cmp,
+            Opcode.IF: self.compile_label,
+            Opcode.ENDIF: self.compile_label,
+            Opcode.JMPFALSE: self.compile_jmpfalse,
+            Opcode.JMP: self.compile_jmp,
+            Opcode.ELSE: self.compile_label,
+            Opcode.STORE_VAR: self.compile_store_var,
+            Opcode.SET: self.compile_set,
+            Opcode.SELECT: self.compile_select,
+            Opcode.CHOOSE: self.compile_choose,
+            Opcode.CHOSEN: self.compile_chosen,
+        }
+        return [handlers.get(opcode, self.compile_unknown) for opcode in sorted(Opcode)]
+
+    def lower_instructions(self):
+        self.allocator.allocate(self.instructions)
+        handlers = self.handlers
+        for self.position, instr in enumerate(self.instructions):
+            handlers[instr.opcode](instr)
+        self.stats.count_opcodes(self.instructions)
+
+    # Runs the passes over the function just evaluated, before its constants
+    # are pooled, so the ones only dead code used are left out. With stats
+    # on, what they removed is recorded per function, and in bytes of asm
+    # if sizes are measured too.
+    def run_passes(self):
+        instructions = self.instructions
+        if self.passes is None or not instructions or instructions[0].opcode not in (Opcode.START_PROC, Opcode.START_PUB_PROC):
+            return
+        self.stats.switch("passes")
+        self.instructions = self.passes.run(instructions, self.functions)
+        if self.stats is not NULL_STATS:
+            self.stats.switch("report")
+            removed = {"instructions": len(instructions) - len(self.instructions)}
+            if self.stats.sizes:
+                try:
+                    removed["bytes"] = self.asm_size(instructions) - self.asm_size(self.instructions)
+                except CompileError:
+                    # Code the passes removed may not compile at all, e.g.
+                    # a branch never taken that initializes a variable from
+                    # one of another width.
+                    removed["bytes"] = None
+            self.stats.record("dead code removed", instructions[0].value, removed)
+        self.stats.switch("lower")
+
+    # The bytes of asm instructions lower to, before the peephole, lowered
+    # on the side so nothing is written or pooled.
+    def asm_size(self, instructions):
+        if self.scratch is None:
+            self.scratch = Compiler(None)
+        scratch = self.scratch
+        # Copies, so nothing lowering on the side does is seen by the real
+        # lowering.
+        for name, function in self.functions.items():
+            if name not in scratch.functions:
+                scratch.functions[name] = Function(name, function.kind)
+        scratch.codegen.strings = dict(self.codegen.strings)
+        scratch.codegen.floats = dict(self.codegen.floats)
+        scratch.stack = []
+        scratch.writer = SizeCounter()
+        scratch.instructions = instructions
+        scratch.lower_instructions()
+        return scratch.writer.size
+
+    def lower(self, writer):
+        self.writer = writer
+        self.lower_instructions()
+        if self.code.lines:
+            writer.write_fragment(self.code)
+
+    # Evaluates and lowers one top level statement at a time, so a function
+    # is written out and its AST and instructions freed as soon as its end is
+    # parsed. Return kinds are read from the signatures up front, since a
+    # call can come before the definition it refers to.
+    def stream(self, writer):
+        self.writer = writer
+        self.load_signatures()
+        stats = self.stats
+        for node, key, cached in self.top_level():
+            if cached is not None:
+                self.write_function(*cached)
+                continue
+            stats.switch("eval")
+            self.evaluate(node)
+            stats.switch("lower")
+            self.run_passes()
+            if key is None:
+                self.lower_instructions()
+            else:
+                _, strings, floats, data = self.pool_constants(self.instructions)
+                for line in data:
+                    writer.add_data(line)
+                self.lower_instructions()
+                self.store(key, self.codegen.finished, strings, floats)
+            self.instructions.clear()
+        if self.code.lines:
+            writer.write_fragment(self.code)
+
+    # Makes the pub functions of an included module callable from this one.
+    # They are defined in the other module's object and resolved at link
+    # time.
+    def include(self, name):
+        interface = self.includes.get(name)
+        if interface is None:
+            self.error("Module %s is not part of the build." % name)
+        for function, kind in interface.items():
+            self.functions[function] = Function(function, kind)
+            self.add(Instruction(Opcode.EXTERN, None, function))
+
+    def load_signatures(self):
+        for name, kind in self.parser.function_signatures().items():
+            self.functions[name] = Function(name, kind)
+
+    # Yields (node, key, cached) for every top level statement. A function
+    # found in the cache is skipped without parsing and comes back as cached,
+    # a (fragment, data lines) pair. key is set for functions that missed,
+    # so they can be stored once lowered.
+    def top_level(self):
+        parser = self.parser
+        stats = self.stats
+        while True:
+            key = None
+            span = None
+            if self.cache is not None:
+                stats.switch("cache")
+                span = parser.function_span()
+            if span is not None:
+                key = self.function_key(*span)
+                entry = self.cache.get(key)
+                if entry is not None:
+                    parser.skip_past(span[1])
+                    yield None, key, self.splice(entry)
+                    continue
+            stats.switch("parse")
+            node = parser.parse_statement()
+            if node is None:
+                return
+            yield node, key, None
+
+    # A function's code depends on its own source, on the return kinds of
+    # what it calls and on the optimizations applied. Names that are not
+    # functions of this program are externs.
+    def function_key(self, first, last):
+        callees = {}
+        for name in self.parser.called_names(first, last):
+            function = self.functions.get(name)
+            callees[name] = "extern" if function is None else function.kind
+        return self.cache.key(self.parser.source_span(first, last), callees, self.options())
+
+    def options(self):
+        return ";".join(optimizer.options() for optimizer in (self.peephole, self.passes) if optimizer is not None)
+
+    # Rebuilds a cached function, pooling its constants in this build and
+    # renaming them in the code to match.
+    def splice(self, entry):
+        data = []
+        strings = {str(i): self.pool_string(value, data.append).partition("@")[2] for i, value in enumerate(entry["strings"])}
+        floats = {str(i): self.pool_float(value, data.append).partition("@")[2] for i, value in enumerate(entry["floats"])}
+        fragment = Fragment(entry["name"], entry["public"])
+        fragment.append(relocate(entry["code"], strings, floats))
+        return fragment, data
+
+    # Stores a lowered function with its constants numbered by first use
+    # within it, so the entry does not depend on the rest of the program.
+    def store(self, key, fragment, strings, floats):
+        fragment.resolve()
+        local_strings = {name.partition("@")[2]: str(i) for i, name in enumerate(strings.values())}
+        local_floats = {name.partition("@")[2]: str(i) for i, name in enumerate(floats.values())}
+        self.cache.put(key, {
+            "name": fragment.name,
+            "public": fragment.public,
+            "code": relocate("".join(fragment.lines), local_strings, local_floats),
+            "strings": list(strings),
+            "floats": list(floats),
+        })
+
+    def write_function(self, fragment, data):
+        for line in data:
+            self.writer.add_data(line)
+        self.writer.write_fragment(fragment)
+
+    # Like stream, but functions are lowered by a pool of worker processes,
+    # batch_size functions per task. Their constants are pooled here in
+    # instruction order before they are handed out, and the fragments are
+    # written back in source order, so the output matches stream's exactly.
+    def stream_parallel(self, writer, jobs, batch_size=32):
+        self.writer = writer
+        self.load_signatures()
+        signatures = {name: function.kind for name, function in self.functions.items()}
+        pending = deque()
+        batch = []
+        stats = self.stats
+        with ProcessPoolExecutor(jobs, initializer=start_worker, initargs=(signatures, self.peephole)) as executor:
+            for node, key, cached in self.top_level():
+                if cached is not None:
+                    if batch:
+                        pending.append(self.submit_batch(executor, batch))
+                        batch = []
+                    # Queue the hit behind the functions before it.
+                    future = Future()
+                    future.set_result(([cached[0]], Counter()))
+                    pending.append((future, [(None, None, cached[1], None)]))
+                    continue
+                stats.switch("eval")
+                self.evaluate(node)
+                stats.switch("lower")
+                self.run_passes()
+                instructions = self.instructions
+                if instructions and instructions[0].opcode in (Opcode.START_PROC, Opcode.START_PUB_PROC):
+                    # Lowered in a worker, so counted here.
+                    stats.count_opcodes(instructions)
+                    batch.append(self.pool_constants(instructions) + (key,))
+                    self.instructions = []
+                    if len(batch) == batch_size:
+                        pending.append(self.submit_batch(executor, batch))
+                        batch = []
+                    # Bound the work in flight so memory stays flat.
+                    if len(pending) > 2 * jobs:
+                        self.write_batch(pending.popleft())
                 else:
-                    string = strings[instr.value]
-                    self.stack.append(StackValue(StackValueType.STRING_CONST, string))
-
-            elif instr.opcode == Opcode.EXTERN:
-                self.setup.append("extern %s\n" % instr.value)
-
-            elif instr.opcode == Opcode.CALL:
-                self.code.append(" call %s\n" % instr.value)
-
-                if instr.value in self.functions and self.functions[instr.value].kind is not None:
-                    kind = self.functions[instr.value].kind
-                    if kind == TokenType.TOKEN_INT8:
-                        self.stack.append(StackValue(StackValueType.REGISTER8, "al"))
-                    elif kind == TokenType.TOKEN_INT16:
-                        self.stack.append(StackValue(StackValueType.REGISTER16, "ax"))
-                    elif kind == TokenType.TOKEN_INT32:
-                        self.stack.append(StackValue(StackValueType.REGISTER32, "eax"))
-                    elif kind == TokenType.TOKEN_INT64:
-                        self.stack.append(StackValue(StackValueType.REGISTER64, "rax"))
-
-                self.reset_registers()
-                calling_stack_offset = 0
-
-            elif instr.opcode == Opcode.LOAD_VAR:
-                var = self.vars[instr.value]
-                self.stack.append(StackValue(var.kind, var.ptr, var.ptr))
-
-            elif instr.opcode == Opcode.PUSH_ARGUMENT:
-                register = self.emit_mov()
-
-                # Move the arguments on the stack.
-                if register == "rax" or register == "eax":
-                    self.mov("[rsp + %s]" % hex(32 + calling_stack_offset), register)
-                    calling_stack_offset += 8
-
-            elif instr.opcode == Opcode.END_PROC:
-
-                # Check if the function requires a return value.
-                if function.kind is not None and not function.has_return_value:
-                    self.error("Function %s requires a return value." % function.name)
-
-                # If the last code was 'ret', don't emit ret again.
-                if "ret" not in self.code[len(self.code) - 1]:
-                    self.code.append(" ret\n")
-
-        file.writelines(self.setup)
-        file.write("\n")
-
-        if len(self.data) > 0:
-            file.write("SECTION .data\n")
-            file.writelines(self.data)
-            file.write("\n")
-
-        file.writelines(self.code)
-        file.write("\n")
-        file.close()
+                    # Anything outside a function writes to the output
+                    # directly, so whatever came before it goes first.
+                    if batch:
+                        pending.append(self.submit_batch(executor, batch))
+                        batch = []
+                    while pending:
+                        self.write_batch(pending.popleft())
+                    self.lower_instructions()
+                    instructions.clear()
+            if batch:
+                pending.append(self.submit_batch(executor, batch))
+            while pending:
+                self.write_batch(pending.popleft())
+        if self.code.lines:
+            writer.write_fragment(self.code)
+
+    # Pools the constants of one function and returns its instructions along
+    # with the pool entries they use and the data lines that are new.
+    def pool_constants(self, instructions):
+        strings = {}
+        floats = {}
+        data = []
+        for instr in instructions:
+            if instr.opcode == Opcode.LOAD_STRING:
+                strings[instr.value] = self.pool_string(instr.value, data.append)
+            elif instr.opcode == Opcode.MOV_FLOAT_CONST:
+                floats[instr.value] = self.pool_float(instr.value, data.append)
+        return instructions, strings, floats, data
+
+    def submit_batch(self, executor, batch):
+        future = executor.submit(lower_functions, [(instructions, strings, floats) for instructions, strings, floats, _, _ in batch])
+        return future, [(strings, floats, data, key) for _, strings, floats, data, key in batch]
+
+    def write_batch(self, task):
+        future, functions = task
+        fragments, counts = future.result()
+        self.worker_counts.update(counts)
+        for fragment, (strings, floats, data, key) in zip(fragments, functions):
+            self.write_function(fragment, data)
+            if key is not None:
+                self.store(key, fragment, strings, floats)
+
+    def compile(self, path, jobs=1):
+        with self.stats.phase("lower"), AsmWriter(path, stats=self.stats) as writer:
+            if jobs > 1:
+                self.stream_parallel(writer, jobs)
+            else:
+                self.stream(writer)
+        self.stats.count("strings pooled", self.codegen.string_count)
+        self.stats.count("floats pooled", self.codegen.float_count)
+        counts = self.counts()
+        counts.update(self.worker_counts)
+        for name, amount in counts.items():
+            self.stats.count(name, amount)
+
+    # What the optimizations did in this process, by the name of the counter.
+    def counts(self):
+        counts = Counter({
+            "nodes folded": self.folder.folded,
+            "variables in registers": self.allocator.allocated,
+            "variables spilled": self.allocator.spilled,
+        })
+        if self.peephole is not None:
+            for pattern in self.peephole.patterns:
+                counts["peephole %s" % pattern] = self.peephole.hits[pattern]
+        if self.passes is not None:
+            counts.update(self.passes.counts)
+        return counts
+
+
+# The compiler of a worker process in Compiler.stream_parallel.
+worker = None
+
+
+def start_worker(signatures, peephole):
+    global worker
+    worker = Compiler(None, peephole=peephole)
+    for name, kind in signatures.items():
+        worker.functions[name] = Function(name, kind)
+
+
+# Lowers a batch of functions whose constants were pooled by the main
+# process and returns their fragments, with the counters of the
+# optimizations made on them.
+def lower_functions(batch):
+    collector = FragmentCollector()
+    worker.writer = collector
+    if worker.peephole is not None:
+        worker.peephole.hits = Counter()
+    worker.allocator.allocated = worker.allocator.spilled = 0
+    for instructions, strings, floats in batch:
+        worker.codegen.strings = strings
+        worker.codegen.floats = floats
+        worker.instructions = instructions
+        worker.lower_instructions()
+    return collector.fragments, worker.counts()
+
+
+# Integer division as idiv does it, rounding toward zero.
+def truncating_division(a, b):
+    quotient = abs(a) // abs(b)
+    return quotient if (a < 0) == (b < 0) else -quotient
+
+
+ARITHMETIC_VERBS = {
+    Opcode.ADD: "added to",
+    Opcode.SUB: "subtracted by",
+    Opcode.MUL: "multiplied by",
+    Opcode.DIV: "divided by",
+}
+
+
+# Maps (opcode, left kind, right kind) to the Compiler method emitting it.
+# Pairings missing from the table are rejected by compile_arithmetic.
+def build_arithmetic_table():
+    table = {}
+    for opcode in ARITHMETIC_VERBS:
+        name = opcode.name.lower()
+        table[(opcode, StackValueType.INT_CONST, StackValueType.INT_CONST)] = getattr(Compiler, "%s_int_consts" % name)
+        for bits, kinds in INTEGER_WIDTHS.items():
+            emitter = getattr(Compiler, "%s_i%s" % (name, bits))
+            operands = kinds + (StackValueType.INT_CONST,)
+            for left in operands:
+                for right in operands:
+                    if left != StackValueType.INT_CONST or right != StackValueType.INT_CONST:
+                        table[(opcode, left, right)] = emitter
+    return table
+
+
+ARITHMETIC = build_arithmetic_table()
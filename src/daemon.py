@@ -0,0 +1,109 @@
+import io
+import json
+import os
+import socket
+import socketserver
+import time
+
+from src.assembly import AsmWriter
+from src.build import Module
+from src.cache import MemoryFunctionCache
+from src.compiler import Compiler
+from src.lexer import Lexer
+from src.parser import Parser
+
+
+# Compiles for clients connected to a Unix socket. One request is a line of
+# JSON, e.g. {"command": "compile", "path": ..., "source": ...}, answered by
+# a line of JSON with the asm or the error. Between requests it keeps the
+# interfaces of included modules, checked against their mtime, and the code
+# of every function it lowered.
+class CompileServer:
+
+    def __init__(self, socket_path, max_functions=100000, peephole=None, passes=None):
+        self.socket_path = socket_path
+        self.function_cache = MemoryFunctionCache(max_functions)
+        self.peephole = peephole
+        self.passes = passes
+        self.modules = {}
+        self.requests = 0
+        self.running = False
+
+    # Returns the module at path, scanning it again only when it changed.
+    def module(self, path):
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        cached = self.modules.get(path)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        module = Module(path)
+        module.scan()
+        self.modules[path] = (version, module)
+        return module
+
+    # Compiles one module and returns its asm. source, if given, is used in
+    # place of what is on disk at path, e.g. an unsaved editor buffer.
+    def compile(self, path, source=None):
+        if source is None:
+            with open(path, "rb") as file:
+                source = file.read().decode("utf-8")
+        parser = Parser(Lexer(path, source))
+        requested = Module(path)
+        includes = {name: self.module(requested.resolve_include(name)).interface for name in parser.include_names()}
+        parser.parse_advance()
+        compiler = Compiler(parser, self.function_cache, includes, peephole=self.peephole, passes=self.passes)
+        output = io.StringIO()
+        with AsmWriter(path, file=output) as writer:
+            compiler.stream(writer)
+        return output.getvalue()
+
+    def stats(self):
+        stats = "%s requests, %s modules, function cache %s" % (self.requests, len(self.modules), self.function_cache.stats())
+        if self.peephole is not None:
+            stats += ", peephole %s" % ", ".join("%s %s" % (pattern, self.peephole.hits[pattern]) for pattern in self.peephole.patterns)
+        if self.passes is not None:
+            stats += ", passes %s" % ", ".join("%s %s" % (name, amount) for name, amount in sorted(self.passes.counts.items()))
+        return stats
+
+    def handle(self, request):
+        start = time.perf_counter()
+        self.requests += 1
+        command = request.get("command", "compile")
+        try:
+            if command == "compile":
+                response = {"ok": True, "asm": self.compile(request["path"], request.get("source"))}
+            elif command == "stats":
+                response = {"ok": True, "stats": self.stats()}
+            elif command == "shutdown":
+                self.running = False
+                response = {"ok": True}
+            else:
+                raise Exception("Unknown command %s." % command)
+        except Exception as error:
+            response = {"ok": False, "error": "%s: %s" % (type(error).__name__, error)}
+        response["milliseconds"] = (time.perf_counter() - start) * 1000
+        return response
+
+    def serve(self):
+        if not hasattr(socket, "AF_UNIX"):
+            raise Exception("Serving needs Unix domain sockets, which this platform does not have.")
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        server = socketserver.UnixStreamServer(self.socket_path, RequestHandler)
+        server.compile_server = self
+        self.running = True
+        try:
+            while self.running:
+                server.handle_request()
+        finally:
+            server.server_close()
+            os.remove(self.socket_path)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            response = self.server.compile_server.handle(json.loads(line))
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+            self.wfile.flush()
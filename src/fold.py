@@ -0,0 +1,272 @@
+import operator
+
+from src.compiler import truncating_division
+from src.parser import (AssignStatement, BinaryExpression, BlockStatement, CallProcExpression, CallProcStatement, CaseStatement,
+                        CompareExpression, DefaultCaseStatement, DefStatement, ElseStatement, IfStatement, LiteralExpression,
+                        LogicalExpression, ReturnStatement, TernaryExpression, UnaryExpression, VarStatement, WhenStatement)
+from src.token import Token, TokenType
+
+WIDTHS = {
+    TokenType.TOKEN_INT8: 8,
+    TokenType.TOKEN_INT16: 16,
+    TokenType.TOKEN_INT32: 32,
+    TokenType.TOKEN_INT64: 64,
+}
+
+# The child nodes of each node, in evaluation order, as (slot, holds a list).
+SLOTS = {
+    BinaryExpression: (("left", False), ("right", False)),
+    CompareExpression: (("left", False), ("right", False)),
+    LogicalExpression: (("left", False), ("right", False)),
+    UnaryExpression: (("exp", False),),
+    TernaryExpression: (("condition", False), ("then_exp", False), ("else_exp", False)),
+    CallProcExpression: (("args", True),),
+    CallProcStatement: (("args", True),),
+    VarStatement: (("expression", False),),
+    AssignStatement: (("expression", False),),
+    ReturnStatement: (("expression", False),),
+    IfStatement: (("condition", False), ("then_block", True), ("else_block", False)),
+    ElseStatement: (("block", True),),
+    BlockStatement: (("statements", True),),
+    DefStatement: (("block", True),),
+    WhenStatement: (("cases", True),),
+    CaseStatement: (("statement", False),),
+    DefaultCaseStatement: (("statement", False),),
+}
+
+# The same, last first, as they are pushed on the stack of Folder.fold.
+REVERSED_SLOTS = {kind: tuple(reversed(slots)) for kind, slots in SLOTS.items()}
+
+ARITHMETIC = {
+    TokenType.TOKEN_PLUS: operator.add,
+    TokenType.TOKEN_DASH: operator.sub,
+    TokenType.TOKEN_STAR: operator.mul,
+    TokenType.TOKEN_SLASH: truncating_division,
+}
+
+COMPARISONS = {
+    TokenType.TOKEN_ISEQ: operator.eq,
+    TokenType.TOKEN_ISNEQ: operator.ne,
+    TokenType.TOKEN_ISG: operator.gt,
+    TokenType.TOKEN_ISGE: operator.ge,
+    TokenType.TOKEN_ISL: operator.lt,
+    TokenType.TOKEN_ISLE: operator.le,
+}
+
+
+# Wraps value around to a signed integer of the given width, like the
+# machine does.
+def wrap(value, bits):
+    value &= (1 << bits) - 1
+    return value - (1 << bits) if value >> (bits - 1) else value
+
+
+def integer_value(node):
+    if node.__class__ is LiteralExpression and node.token.kind == TokenType.TOKEN_DIGIT:
+        return int(node.token.data)
+    return None
+
+
+# Folds expressions over literals in a top level statement before it is
+# evaluated, and drops operations that leave their operand as it was, like
+# x + 0. Integers wrap around in the width the expression is stored in: the
+# declared type of the variable it is assigned to, the return type of the
+# function, or i64 for arguments and comparisons. The tree is rewritten in
+# place, without recursion, as deep as it is.
+class Folder:
+
+    def __init__(self, functions):
+        # The functions of the program, for whether a call returns an integer.
+        self.functions = functions
+        # Width of every variable of the function folded, None for floats.
+        self.variables = {}
+        self.return_bits = 64
+        self.folded = 0
+        # Whether a node is an integer and whether it is free of calls, by
+        # id, worked out when an identity needs it. The node is kept along,
+        # so its id is not reused while the entry exists.
+        self.facts = {}
+        self.folders = {
+            BinaryExpression: self.fold_binary,
+            UnaryExpression: self.fold_unary,
+            CompareExpression: self.fold_compare,
+            LogicalExpression: self.fold_logical,
+            TernaryExpression: self.fold_ternary,
+        }
+
+    # Entries on the stack are (node, width, container, slot, folder). A node
+    # is visited with folder None, which pushes its children after it; the
+    # expressions among them come back with their folder once their own
+    # children are done, and what they fold to is put in their slot.
+    def fold(self, root):
+        holder = [root]
+        stack = [(root, 64, holder, 0, None)]
+        folders = self.folders
+        while stack:
+            node, bits, container, slot, folder = stack.pop()
+            if folder is not None:
+                replacement = folder(node, bits)
+                if replacement is not node:
+                    self.folded += 1
+                    if slot.__class__ is str:
+                        setattr(container, slot, replacement)
+                    else:
+                        container[slot] = replacement
+                continue
+            kind = node.__class__
+            slots = REVERSED_SLOTS.get(kind)
+            if slots is None:
+                continue
+            folder = folders.get(kind)
+            if folder is not None:
+                stack.append((node, bits, container, slot, folder))
+            else:
+                self.enter(node)
+            child_bits = self.child_bits(node, bits)
+            push = stack.append
+            for name, is_list in slots:
+                slot_bits = 64 if name == "condition" else child_bits
+                if is_list:
+                    items = getattr(node, name)
+                    for index in range(len(items) - 1, -1, -1):
+                        if items[index].__class__ is not LiteralExpression:
+                            push((items[index], slot_bits, items, index, None))
+                else:
+                    child = getattr(node, name)
+                    if child is not None and child.__class__ is not LiteralExpression:
+                        push((child, slot_bits, node, name, None))
+        self.facts.clear()
+        return holder[0]
+
+    def enter(self, node):
+        kind = node.__class__
+        if kind is DefStatement:
+            self.variables = {}
+            self.return_bits = WIDTHS.get(node.def_type.kind) if node.def_type is not None else None
+        elif kind is VarStatement:
+            self.variables[node.name.data] = WIDTHS.get(node.var_type.kind)
+
+    # The width the children of node are evaluated in.
+    def child_bits(self, node, bits):
+        kind = node.__class__
+        if kind is VarStatement:
+            return WIDTHS.get(node.var_type.kind) or 64
+        if kind is AssignStatement:
+            return self.variables.get(node.name.data) or 64
+        if kind is ReturnStatement:
+            return self.return_bits or 64
+        if kind is BinaryExpression or kind is UnaryExpression or kind is TernaryExpression:
+            return bits
+        return 64
+
+    def literal(self, value):
+        return LiteralExpression(Token(TokenType.TOKEN_DIGIT, str(value)))
+
+    def is_integer(self, node):
+        return self.describe(node)[0]
+
+    def is_pure(self, node):
+        return self.describe(node)[1]
+
+    # Returns (is an integer, is free of calls) for an expression, from the
+    # bottom up without recursion.
+    def describe(self, root):
+        facts = self.facts
+        stack = [root]
+        while stack:
+            node = stack[-1]
+            if id(node) in facts:
+                stack.pop()
+                continue
+            kind = node.__class__
+            if kind is LiteralExpression:
+                token = node.token
+                integer = token.kind == TokenType.TOKEN_DIGIT or (token.kind == TokenType.TOKEN_IDENTIFIER and self.variables.get(token.data) is not None)
+                facts[id(node)] = (node, integer, True)
+            elif kind is CallProcExpression:
+                function = self.functions.get(node.name.data)
+                facts[id(node)] = (node, function is not None and function.kind in WIDTHS, False)
+            elif kind in self.folders:
+                children = [getattr(node, name) for name, _ in SLOTS[kind]]
+                pending = [child for child in children if id(child) not in facts]
+                if pending:
+                    stack.extend(pending)
+                    continue
+                pure = all(facts[id(child)][2] for child in children)
+                if kind is CompareExpression or kind is LogicalExpression:
+                    integer = True
+                else:
+                    # The condition of a ternary does not make its value.
+                    integer = all(facts[id(child)][1] for child in children[-2:])
+                facts[id(node)] = (node, integer, pure)
+            else:
+                facts[id(node)] = (node, False, False)
+            stack.pop()
+        facts = facts[id(root)]
+        return facts[1], facts[2]
+
+    def fold_binary(self, node, bits):
+        left = integer_value(node.left)
+        right = integer_value(node.right)
+        kind = node.operator.kind
+        if left is not None and right is not None:
+            if kind == TokenType.TOKEN_SLASH and right == 0:
+                raise Exception("Division by zero.")
+            return self.literal(wrap(ARITHMETIC[kind](left, right), bits))
+        # The identities only hold for integers, a float or string operand
+        # is left for the compiler to reject.
+        if kind == TokenType.TOKEN_PLUS:
+            if left == 0 and self.is_integer(node.right):
+                return node.right
+            if right == 0 and self.is_integer(node.left):
+                return node.left
+        elif kind == TokenType.TOKEN_DASH or kind == TokenType.TOKEN_SLASH:
+            if right == (0 if kind == TokenType.TOKEN_DASH else 1) and self.is_integer(node.left):
+                return node.left
+        elif kind == TokenType.TOKEN_STAR:
+            if left == 1 and self.is_integer(node.right):
+                return node.right
+            if right == 1 and self.is_integer(node.left):
+                return node.left
+            # A call multiplied by zero still has to be made.
+            if left == 0 and self.is_integer(node.right) and self.is_pure(node.right):
+                return node.left
+            if right == 0 and self.is_integer(node.left) and self.is_pure(node.left):
+                return node.right
+        return node
+
+    def fold_unary(self, node, bits):
+        value = integer_value(node.exp)
+        if node.operator.kind == TokenType.TOKEN_NOT:
+            return node if value is None else self.literal(int(value == 0))
+        if value is not None:
+            return self.literal(wrap(-value, bits))
+        exp = node.exp
+        if exp.__class__ is LiteralExpression and exp.token.kind == TokenType.TOKEN_DECIMAL:
+            data = exp.token.data
+            return LiteralExpression(Token(TokenType.TOKEN_DECIMAL, data[1:] if data.startswith("-") else "-" + data))
+        if exp.__class__ is UnaryExpression and exp.operator.kind == TokenType.TOKEN_DASH and self.is_integer(exp.exp):
+            return exp.exp
+        return node
+
+    def fold_compare(self, node, bits):
+        left = integer_value(node.left)
+        right = integer_value(node.right)
+        if left is None or right is None:
+            return node
+        return self.literal(int(COMPARISONS[node.operator.kind](wrap(left, 64), wrap(right, 64))))
+
+    def fold_logical(self, node, bits):
+        left = integer_value(node.left)
+        right = integer_value(node.right)
+        if left is None or right is None:
+            return node
+        if node.operator.kind == TokenType.TOKEN_AND:
+            return self.literal(int(left != 0 and right != 0))
+        return self.literal(int(left != 0 or right != 0))
+
+    def fold_ternary(self, node, bits):
+        condition = integer_value(node.condition)
+        if condition is None:
+            return node
+        return node.then_exp if condition != 0 else node.else_exp
@@ -1,152 +1,90 @@
-from src.token import TokenType, Token
+import re
+
+from src.token import TokenType, Token, TokenBuffer, KEYWORDS, OPERATORS
+
+# Anything that cannot start a token is skipped in one match. The remaining
+# alternatives slice a whole string, number, name or operator out at once.
+SCANNER = re.compile(r'''
+    (?P<skip>[^\w"()*/+,.=!<>|&:?-]+)
+  | "(?P<string>[^"]*)"
+  | (?P<digit>\d[\d.]*)
+  | (?P<identifier>[^\W\d]\w*)
+  | (?P<operator>==|=>|!=|>=|<=|\|\||&&|[()*/+,.=!<>|&:?-])
+''', re.VERBOSE)
+
+SKIP = SCANNER.groupindex["skip"]
+STRING = SCANNER.groupindex["string"]
+DIGIT = SCANNER.groupindex["digit"]
+IDENTIFIER = SCANNER.groupindex["identifier"]
 
 
 class Lexer:
 
-    def __init__(self, path):
-        self.file = open(path, "rb")
-        self.head = ' '
-        self.peek = ' '
+    def __init__(self, path, source=None):
+        self.path = path
+        if source is None:
+            with open(path, "rb") as file:
+                source = file.read().decode("utf-8")
+        self.source = source
+        self.length = len(source)
+        self.pos = 0
+        self.scanner = None
 
     def error(self, message):
         raise Exception(message)
 
-    def lex_advance(self):
-        if self.file is not None:
-            self.head = self.file.read(1).decode("utf-8")
-        else:
-            self.error("Lexer Issue: File needs to be set before advancing.")
-
-    def peek_char(self):
-        if self.file is not None:
-            self.peek = self.file.read(1).decode("utf-8")
-            self.file.seek(self.file.tell() - 1)
-        else:
-            self.error("Lexer Issue: File needs to be set before advancing.")
-
-    def new_token_advance(self, t, data, advances):
-        for x in range(0, advances):
-            self.lex_advance()
-        return Token(t, data)
+    # Yields (kind, start, end) for every token, the lexeme being
+    # source[start:end]. Callers decide whether to copy it out.
+    def scan(self):
+        keywords = KEYWORDS.get
+        operators = OPERATORS.__getitem__
+        identifier = TokenType.TOKEN_IDENTIFIER
+        pos = self.pos
 
-    def next_identifier(self):
-        identifier = ""
-        while self.head.isalnum() or self.head == '_':
-            identifier += self.head
-            self.lex_advance()
-        if identifier == "def":
-            return Token(TokenType.TOKEN_DEF, identifier)
-        elif identifier == "else":
-            return Token(TokenType.TOKEN_ELSE, identifier)
-        elif identifier == "elif":
-            return Token(TokenType.TOKEN_ELIF, identifier)
-        elif identifier == "if":
-            return Token(TokenType.TOKEN_IF, identifier)
-        elif identifier == "then":
-            return Token(TokenType.TOKEN_THEN, identifier)
-        elif identifier == "end":
-            return Token(TokenType.TOKEN_END, identifier)
-        elif identifier == "i8":
-            return Token(TokenType.TOKEN_INT8, identifier)
-        elif identifier == "i16":
-            return Token(TokenType.TOKEN_INT16, identifier)
-        elif identifier == "i32":
-            return Token(TokenType.TOKEN_INT32, identifier)
-        elif identifier == "i64":
-            return Token(TokenType.TOKEN_INT64, identifier)
-        elif identifier == "f64":
-            return Token(TokenType.TOKEN_FLOAT64, identifier)
-        elif identifier == "double":
-            return Token(TokenType.TOKEN_DOUBLE, identifier)
-        elif identifier == "float":
-            return Token(TokenType.TOKEN_FLOAT, identifier)
-        elif identifier == "extern":
-            return Token(TokenType.TOKEN_EXTERN, identifier)
-        elif identifier == "include":
-            return Token(TokenType.TOKEN_INCLUDE, identifier)
-        elif identifier == "return":
-            return Token(TokenType.TOKEN_RETURN, identifier)
-        elif identifier == "pub":
-            return Token(TokenType.TOKEN_PUB, identifier)
-        elif identifier == "when":
-            return Token(TokenType.TOKEN_WHEN, identifier)
-        elif identifier == "do":
-            return Token(TokenType.TOKEN_DO, identifier)
+        for m in SCANNER.finditer(self.source, pos):
+            if m.start() != pos:
+                self.pos = pos
+                self.error("Lexer Issue: Unterminated string at offset %s." % pos)
+            pos = m.end()
+            group = m.lastindex
 
-        return Token(TokenType.TOKEN_IDENTIFIER, identifier)
+            if group == SKIP:
+                continue
+            self.pos = pos
+            if group == IDENTIFIER:
+                yield keywords(m.group(group), identifier), m.start(), pos
+            elif group == STRING:
+                yield TokenType.TOKEN_STRING, m.start() + 1, pos - 1
+            elif group == DIGIT:
+                yield self.next_digit(m.group(group)), m.start(), pos
+            else:
+                yield operators(m.group(group)), m.start(), pos
 
-    def next_string(self):
-        string = ""
-        self.lex_advance()
+        if pos != self.length:
+            self.pos = pos
+            self.error("Lexer Issue: Unterminated string at offset %s." % pos)
+        self.pos = self.length
+        yield TokenType.TOKEN_EOF, self.length, self.length
 
-        while self.head != '"':
-            string += self.head
-            self.lex_advance()
-        self.lex_advance()
-        return Token(TokenType.TOKEN_STRING, string)
+    def next_token(self):
+        if self.scanner is None:
+            self.scanner = self.scan()
+        kind, start, end = next(self.scanner, (TokenType.TOKEN_EOF, self.length, self.length))
+        return Token(kind, self.source[start:end])
 
-    def next_digit(self):
-        numeral = ""
-        decimals = 0
-        while self.head.isdigit() or self.head == '.':
-            numeral += self.head
-            if self.head == '.':
-                decimals += 1
-            self.lex_advance()
+    def tokenize(self):
+        tokens = TokenBuffer(self.source)
+        kinds = tokens.kinds.append
+        starts = tokens.starts.append
+        lengths = tokens.lengths.append
+        for kind, start, end in self.scan():
+            kinds(kind)
+            starts(start)
+            lengths(end - start)
+        return tokens
 
+    def next_digit(self, numeral):
+        decimals = numeral.count('.')
         if decimals > 1:
             raise Exception("A number cannot have more than 1 decimal point.")
-        return Token(TokenType.TOKEN_DIGIT if decimals == 0 else TokenType.TOKEN_DECIMAL, numeral)
-
-    def next_token(self):
-        while True:
-            if not self.head:
-                return Token(TokenType.TOKEN_EOF, "")
-            if self.head == '"':
-                return self.next_string()
-            elif self.head.isalpha() or self.head == '_':
-                return self.next_identifier()
-            elif self.head.isdigit():
-                return self.next_digit()
-            elif self.head == '(':
-                return self.new_token_advance(TokenType.TOKEN_LEFT_PAREN, "(", 1)
-            elif self.head == ')':
-                return self.new_token_advance(TokenType.TOKEN_RIGHT_PAREN, ")", 1)
-            elif self.head == '*':
-                return self.new_token_advance(TokenType.TOKEN_STAR, "*", 1)
-            elif self.head == '/':
-                return self.new_token_advance(TokenType.TOKEN_SLASH, "/", 1)
-            elif self.head == '-':
-                return self.new_token_advance(TokenType.TOKEN_DASH, "-", 1)
-            elif self.head == '+':
-                return self.new_token_advance(TokenType.TOKEN_PLUS, "+", 1)
-            elif self.head == ',':
-                return self.new_token_advance(TokenType.TOKEN_COMMA, ",", 1)
-            elif self.head == '.':
-                return self.new_token_advance(TokenType.TOKEN_DOT, ".", 1)
-            elif self.head == '=':
-                self.peek_char()
-                return self.new_token_advance(TokenType.TOKEN_ISEQ, "==", 2) if self.peek == '=' else self.new_token_advance(TokenType.TOKEN_EQGT, "=>", 2) if self.peek == '>' else self.new_token_advance(TokenType.TOKEN_EQ, "=", 1)
-            elif self.head == "!":
-                self.peek_char()
-                return self.new_token_advance(TokenType.TOKEN_ISNEQ, "!=", 2) if self.peek == '=' else self.new_token_advance(TokenType.TOKEN_NOT, "!", 1)
-            elif self.head == '>':
-                self.peek_char()
-                return self.new_token_advance(TokenType.TOKEN_ISGE, ">=", 2) if self.peek == '=' else self.new_token_advance(TokenType.TOKEN_ISG, ">", 1)
-            elif self.head == '<':
-                self.peek_char()
-                return self.new_token_advance(TokenType.TOKEN_ISLE, "<=", 2) if self.peek == '=' else self.new_token_advance(TokenType.TOKEN_ISL, "<", 1)
-            elif self.head == '|':
-                self.peek_char()
-                return self.new_token_advance(TokenType.TOKEN_OR, "||", 2) if self.peek == '|' else self.new_token_advance(TokenType.TOKEN_BITWISE_OR, "|", 1)
-            elif self.head == '&':
-                self.peek_char()
-                return self.new_token_advance(TokenType.TOKEN_AND, "&&", 2) if self.peek == '&' else self.new_token_advance(TokenType.TOKEN_BITWISE_AND, "&", 1)
-            elif self.head == ':':
-                return self.new_token_advance(TokenType.TOKEN_COLON, ":", 1)
-            elif self.head == '?':
-                return self.new_token_advance(TokenType.TOKEN_QUESTION, "?", 1)
-            elif self.head == ":":
-                return self.new_token_advance(TokenType.TOKEN_COLON, ":", 1)
-            else:
-                self.lex_advance()
+        return TokenType.TOKEN_DIGIT if decimals == 0 else TokenType.TOKEN_DECIMAL
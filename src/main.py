@@ -1,23 +1,54 @@
-from src.compiler import Compiler
-from src.lexer import *
-from src.parser import *
 import os
-import time
+import sys
+
+# src/token.py would shadow the standard library module of the same name,
+# which logging and concurrent.futures import, when run from this directory.
+sys.path = [entry for entry in sys.path if os.path.abspath(entry or ".") != os.path.dirname(os.path.abspath(__file__))]
 
+from src.build import BuildCache, ProgramBuild, StubToolchain, Toolchain
+from src.cache import FunctionCache
+from src.peephole import PATTERNS, parse_patterns
+from src.ssa import CHECKS, PASSES, parse_passes
+from src.stats import NULL_STATS, Stats
+import argparse
+import time
 
-path = "../test/test.myl"
 
-start_time = time.time()
-lexer = Lexer("%s" % path)
+def main():
+    arg_parser = argparse.ArgumentParser(description="Compile a MYL program.")
+    arg_parser.add_argument("path", nargs="?", default="../test/test.myl")
+    arg_parser.add_argument("--jobs", type=int, default=1, help="compile modules, or the functions of a lone module, in this many processes")
+    arg_parser.add_argument("--cache", help="directory to keep the code of unchanged functions in")
+    arg_parser.add_argument("--cache-size", type=int, default=256, help="size of the cache in MiB")
+    arg_parser.add_argument("--build-cache", help="directory to keep assembled and linked outputs in")
+    arg_parser.add_argument("--toolchain", choices=["nasm", "stub"], default="nasm", help="stub writes placeholder outputs instead of running nasm and gcc")
+    arg_parser.add_argument("--output", default="../run")
+    arg_parser.add_argument("--peephole", default="all", help="peephole patterns to apply: all, none, or a comma separated list of %s" % ", ".join(PATTERNS))
+    arg_parser.add_argument("--passes", default="all", help="passes to run over the SSA form of each function: all, none, or a comma separated list of %s" % ", ".join(PASSES + CHECKS))
+    arg_parser.add_argument("--stats", nargs="?", const="text", choices=["text", "json"], help="report time per phase and counters")
+    arg_parser.add_argument("--stats-memory", action="store_true", help="also trace peak memory, which slows the build down")
+    arg_parser.add_argument("--stats-sizes", action="store_true", help="also measure the bytes of asm the passes removed, which slows the build down")
+    args = arg_parser.parse_args()
 
-parser = Parser(lexer)
-parser.parse_advance()
+    start_time = time.time()
+    toolchain = StubToolchain() if args.toolchain == "stub" else Toolchain()
+    build_cache = BuildCache(args.build_cache) if args.build_cache else None
+    cache = FunctionCache(args.cache, args.cache_size * 1024 * 1024) if args.cache else None
+    stats = Stats(args.stats_memory, args.stats_sizes) if args.stats or args.stats_memory or args.stats_sizes else NULL_STATS
+    program = ProgramBuild(args.path, toolchain, build_cache, cache, args.jobs, stats, parse_patterns(args.peephole), parse_passes(args.passes))
+    program.run(args.output)
 
-compiler = Compiler(parser)
-asm = path.replace(".myl", ".asm")
-obj = asm.replace(".asm", ".obj")
-compiler.compile(asm)
+    print("%s modules compiled, %s reused." % (program.compiled, program.reused))
+    if cache is not None:
+        print("Function cache: %s." % cache.stats())
+    if build_cache is not None:
+        print("Build cache: %s." % build_cache.stats())
+    print("%s took %s seconds to compile." % (args.path, time.time() - start_time))
+    if stats is not NULL_STATS:
+        stats.finish()
+        print(stats.json() if args.stats == "json" else stats.report())
 
-os.system("nasm -fwin64 %s | gcc -o ../run %s" % (asm, obj))
 
-print("%s took %s seconds to compile." % (lexer.file.name, time.time() - start_time))
+# Worker processes import this module, so only compile when run directly.
+if __name__ == "__main__":
+    main()
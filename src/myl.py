@@ -0,0 +1,79 @@
+import os
+import sys
+
+# src/token.py would shadow the standard library module of the same name
+# when run from this directory, see main.py.
+sys.path = [entry for entry in sys.path if os.path.abspath(entry or ".") != os.path.dirname(os.path.abspath(__file__))]
+
+import argparse
+import json
+import socket
+
+# Only the server imports the compiler. The client stays cheap to start,
+# which is the point of keeping a server around.
+DEFAULT_SOCKET = os.environ.get("MYL_SOCKET") or os.path.join(os.environ.get("TMPDIR", "/tmp"), "myl-%s.sock" % os.environ.get("USER", "user"))
+
+
+def request(socket_path, message):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except OSError:
+        raise SystemExit("No compile server at %s, start one with: myl serve" % socket_path)
+    with client, client.makefile("rwb") as stream:
+        stream.write(json.dumps(message).encode("utf-8") + b"\n")
+        stream.flush()
+        return json.loads(stream.readline())
+
+
+def compile_command(args):
+    message = {"command": "compile", "path": os.path.abspath(args.path)}
+    if args.stdin:
+        message["source"] = sys.stdin.read()
+    response = request(args.socket, message)
+    if not response["ok"]:
+        print(response["error"], file=sys.stderr)
+        return 1
+    output = args.output or os.path.splitext(args.path)[0] + ".asm"
+    if output == "-":
+        sys.stdout.write(response["asm"])
+    else:
+        with open(output, "w") as file:
+            file.write(response["asm"])
+    if args.verbose:
+        print("%s compiled in %.2f ms." % (args.path, response["milliseconds"]), file=sys.stderr)
+    return 0
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(prog="myl", description="Compile MYL programs through a resident compile server.")
+    arg_parser.add_argument("--socket", default=DEFAULT_SOCKET)
+    commands = arg_parser.add_subparsers(dest="command", required=True)
+    serve_parser = commands.add_parser("serve", help="run the compile server")
+    serve_parser.add_argument("--peephole", default="all", help="peephole patterns to apply: all, none, or a comma separated list")
+    serve_parser.add_argument("--passes", default="all", help="passes to run over the SSA form of each function: all, none, or a comma separated list")
+    compile_parser = commands.add_parser("compile", help="compile a module to asm")
+    compile_parser.add_argument("path")
+    compile_parser.add_argument("-o", "--output", help="asm file to write, - for stdout")
+    compile_parser.add_argument("--stdin", action="store_true", help="compile the source on stdin, as if it were at path")
+    compile_parser.add_argument("-v", "--verbose", action="store_true")
+    commands.add_parser("stats", help="show what the server has cached")
+    commands.add_parser("stop", help="stop the server")
+    args = arg_parser.parse_args()
+
+    if args.command == "serve":
+        from src.daemon import CompileServer
+        from src.peephole import parse_patterns
+        from src.ssa import parse_passes
+        CompileServer(args.socket, peephole=parse_patterns(args.peephole), passes=parse_passes(args.passes)).serve()
+        return 0
+    if args.command == "compile":
+        return compile_command(args)
+    response = request(args.socket, {"command": "stats" if args.command == "stats" else "shutdown"})
+    if "stats" in response:
+        print(response["stats"])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,16 @@
 from abc import ABC, abstractmethod
+from types import GeneratorType
+import re
 
-from src.compiler import Instruction, Opcode, Function
+from src.compiler import CONDITIONS, Instruction, Opcode, Function
 from src.token import *
 
 
+# eval either emits instructions directly or is a generator that yields
+# child nodes. Compiler.evaluate runs the yielded children in between, so
+# deep trees are walked without growing the Python stack.
 class Node(ABC):
+    __slots__ = ()
 
     @abstractmethod
     def eval(self, compiler):
@@ -12,41 +18,78 @@ class Node(ABC):
 
 
 class LogicalExpression(Node):
+    __slots__ = ("left", "right", "operator")
 
     def __init__(self, left, right, operator):
         self.left = left
         self.right = right
         self.operator = operator
 
+    # Only logical operators between literals are computed, by the Folder.
     def eval(self, compiler):
-        pass
+        compiler.error("Logical operators are not supported in conditions or values.")
 
 
 class TernaryExpression(Node):
+    __slots__ = ("condition", "then_exp", "else_exp")
 
     def __init__(self, condition, then_exp, else_exp):
         self.condition = condition
         self.then_exp = then_exp
         self.else_exp = else_exp
 
+    # Literals and variables take no code to load, so both are loaded and
+    # the condition picks one, see Compiler.compile_select. Otherwise only
+    # the value on the branch taken is computed, and left in the same
+    # place, see Compiler.compile_choose.
     def eval(self, compiler):
-        pass
+        if self.condition.__class__ is CompareExpression:
+            yield from self.condition.compare(compiler)
+        else:
+            yield self.condition
+        if self.then_exp.__class__ is LiteralExpression and self.else_exp.__class__ is LiteralExpression:
+            yield self.then_exp
+            yield self.else_exp
+            compiler.add(Instruction(Opcode.SELECT))
+            return
+
+        else_label = compiler.gen_label()
+        end_label = compiler.gen_label()
+
+        compiler.add(Instruction(Opcode.JMPFALSE, None, else_label))
+        yield self.then_exp
+        compiler.add(Instruction(Opcode.CHOOSE, None, end_label))
+        compiler.add(Instruction(Opcode.JMP, None, end_label))
+        compiler.add(Instruction(Opcode.ELSE, None, else_label))
+        yield self.else_exp
+        compiler.add(Instruction(Opcode.CHOOSE, None, end_label))
+        compiler.add(Instruction(Opcode.ENDIF, None, end_label))
+        compiler.add(Instruction(Opcode.CHOSEN, None, end_label))
 
 
 class CompareExpression(Node):
+    __slots__ = ("left", "right", "operator")
 
     def __init__(self, left, right, operator):
         self.left = left
         self.right = right
         self.operator = operator
 
+    # Leaves the flags of the comparison, for a branch or a ternary to take.
+    def compare(self, compiler):
+        yield self.left
+        yield self.right
+        compiler.add(Instruction(Opcode.CMP, self.operator, CONDITIONS[self.operator.kind]))
+
+    # Used as a value, the comparison is 1 where it holds and 0 elsewhere.
     def eval(self, compiler):
-        self.left.eval(compiler)
-        self.right.eval(compiler)
-        compiler.add(Instruction(Opcode.CMP))
+        yield self.left
+        yield self.right
+        compiler.add(Instruction(Opcode.SET, self.operator, CONDITIONS[self.operator.kind]))
 
 
 class BinaryExpression(Node):
+    __slots__ = ("left", "right", "operator")
 
     def __init__(self, left, right, operator):
         self.left = left
@@ -54,8 +97,8 @@ class BinaryExpression(Node):
         self.operator = operator
 
     def eval(self, compiler):
-        self.left.eval(compiler)
-        self.right.eval(compiler)
+        yield self.left
+        yield self.right
 
         if self.operator.kind == TokenType.TOKEN_PLUS:
             compiler.add(Instruction(Opcode.ADD))
@@ -68,38 +111,39 @@ class BinaryExpression(Node):
 
 
 class UnaryExpression(Node):
+    __slots__ = ("exp", "operator")
 
     def __init__(self, exp, operator):
         self.exp = exp
         self.operator = operator
 
     def eval(self, compiler):
-        compiler.state = self.operator.data
-        self.exp.eval(compiler)
+        yield self.exp
         if self.operator.kind == TokenType.TOKEN_NOT:
             compiler.add(Instruction(Opcode.NOT))
-        compiler.state = ""
+        elif self.operator.kind == TokenType.TOKEN_DASH:
+            compiler.add(Instruction(Opcode.NEGATE))
 
 
 class LiteralExpression(Node):
+    __slots__ = ("token",)
 
     def __init__(self, token):
         self.token = token
 
     def eval(self, compiler):
         if self.token.kind == TokenType.TOKEN_DIGIT:
-            compiler.add(Instruction(Opcode.MOV_INT_CONST, self.token,
-                                     self.token.data if compiler.state != "-" else "-%s" % self.token.data))
+            compiler.add(Instruction(Opcode.MOV_INT_CONST, self.token, self.token.data))
         elif self.token.kind == TokenType.TOKEN_IDENTIFIER and self.token.data != "_":
             compiler.add(Instruction(Opcode.LOAD_VAR, self.token, self.token.data))
         elif self.token.kind == TokenType.TOKEN_STRING:
             compiler.add(Instruction(Opcode.LOAD_STRING, self.token, self.token.data))
         elif self.token.kind == TokenType.TOKEN_DECIMAL:
-            compiler.add(Instruction(Opcode.MOV_FLOAT_CONST, self.token,
-                                     self.token.data if compiler.state != "-" else "-%s" % self.token.data))
+            compiler.add(Instruction(Opcode.MOV_FLOAT_CONST, self.token, self.token.data))
 
 
 class VarStatement(Node):
+    __slots__ = ("var_type", "name", "expression")
 
     def __init__(self, var_type, name, expression):
         self.var_type = var_type
@@ -107,7 +151,7 @@ class VarStatement(Node):
         self.expression = expression
 
     def eval(self, compiler):
-        self.expression.eval(compiler)
+        yield self.expression
         if self.var_type.kind == TokenType.TOKEN_INT8:
             compiler.add(Instruction(Opcode.STORE_INT8, self.var_type, self.name.data))
         elif self.var_type.kind == TokenType.TOKEN_INT16:
@@ -120,58 +164,63 @@ class VarStatement(Node):
             compiler.add(Instruction(Opcode.STORE_FLOAT64, self.var_type, self.name.data))
 
 
+class AssignStatement(Node):
+    __slots__ = ("name", "expression")
+
+    def __init__(self, name, expression):
+        self.name = name
+        self.expression = expression
+
+    def eval(self, compiler):
+        yield self.expression
+        compiler.add(Instruction(Opcode.STORE_VAR, self.name, self.name.data))
+
+
 class ElseStatement(Node):
+    __slots__ = ("block",)
 
     def __init__(self, block):
         self.block = block
 
     def eval(self, compiler):
         for statement in self.block:
-            statement.eval(compiler)
+            yield statement
 
 
 class IfStatement(Node):
+    __slots__ = ("condition", "then_block", "else_block")
 
     def __init__(self, condition, then_block, else_block):
         self.condition = condition
         self.then_block = then_block
         self.else_block = else_block
 
+    # The then block follows the one conditional jump, taken to the else
+    # block or past the then block where the condition does not hold.
     def eval(self, compiler):
-        self.condition.eval(compiler)
-
-        then_label = compiler.gen_label()
-        else_label = ""
-
-        jumped_end = True
+        if self.condition.__class__ is CompareExpression:
+            yield from self.condition.compare(compiler)
+        else:
+            yield self.condition
 
-        if self.else_block:
-            else_label = compiler.gen_label()
+        else_label = compiler.gen_label() if self.else_block else ""
         end_label = compiler.gen_label()
 
-        compiler.add(Instruction(Opcode.JMPEQ, None, then_label))
-
-        if not self.else_block:
-            compiler.add(Instruction(Opcode.JMP, None, end_label))
-        else:
-            jumped_end = False
-            compiler.add(Instruction(Opcode.JMP, None, else_label))
+        compiler.add(Instruction(Opcode.JMPFALSE, None, else_label or end_label))
 
-        compiler.add(Instruction(Opcode.IF, None, then_label))
         for statement in self.then_block:
-            statement.eval(compiler)
-
-        if not jumped_end:
-            compiler.add(Instruction(Opcode.JMP, None, end_label))
+            yield statement
 
         if self.else_block:
+            compiler.add(Instruction(Opcode.JMP, None, end_label))
             compiler.add(Instruction(Opcode.ELSE, None, else_label))
-            self.else_block.eval(compiler)
+            yield self.else_block
 
         compiler.add(Instruction(Opcode.ENDIF, None, end_label))
 
 
 class DefStatement(Node):
+    __slots__ = ("name", "block", "def_type", "public")
 
     def __init__(self, name, block, def_type, public):
         self.name = name
@@ -180,16 +229,24 @@ class DefStatement(Node):
         self.public = public
 
     def eval(self, compiler):
-        compiler.functions[self.name.data] = Function(self.name.data, self.def_type.kind if self.def_type is not None else None)
+        # Labels are local to the function, see Compiler.gen_label.
+        compiler.labels = 0
+        function = Function(self.name.data, self.def_type.kind if self.def_type is not None else None)
+        compiler.functions[self.name.data] = compiler.function = function
         compiler.add(Instruction(Opcode.START_PROC if not self.public else Opcode.START_PUB_PROC, self.def_type, self.name.data))
         compiler.add(Instruction(Opcode.SETUP_STACK))
         for statement in self.block:
-            statement.eval(compiler)
+            yield statement
+        # Checked on the source, before the passes may remove the only
+        # return, e.g. in a branch that is never taken.
+        if function.kind is not None and not function.has_return_value:
+            compiler.error("Function %s requires a return value." % function.name)
         compiler.add(Instruction(Opcode.CLOSE_STACK))
         compiler.add(Instruction(Opcode.END_PROC, self.name, self.name.data))
 
 
 class CallProcStatement(Node):
+    __slots__ = ("name", "args")
 
     def __init__(self, name, args):
         self.name = name
@@ -197,12 +254,13 @@ class CallProcStatement(Node):
 
     def eval(self, compiler):
         for expression in self.args:
-            expression.eval(compiler)
+            yield expression
             compiler.add(Instruction(Opcode.PUSH_ARGUMENT))
         compiler.add(Instruction(Opcode.CALL, self.name, self.name.data))
 
 
 class CallProcExpression(Node):
+    __slots__ = ("name", "args")
 
     def __init__(self, name, args):
         self.name = name
@@ -210,21 +268,23 @@ class CallProcExpression(Node):
 
     def eval(self, compiler):
         for expression in self.args:
-            expression.eval(compiler)
+            yield expression
             compiler.add(Instruction(Opcode.PUSH_ARGUMENT))
         compiler.add(Instruction(Opcode.CALL, self.name, self.name.data))
 
 
 class IncludeStatement(Node):
+    __slots__ = ("name",)
 
     def __init__(self, name):
         self.name = name
 
     def eval(self, compiler):
-        pass
+        compiler.include(self.name.data)
 
 
 class ExternStatement(Node):
+    __slots__ = ("name",)
 
     def __init__(self, name):
         self.name = name
@@ -234,27 +294,31 @@ class ExternStatement(Node):
 
 
 class ReturnStatement(Node):
+    __slots__ = ("expression",)
 
     def __init__(self, expression):
         self.expression = expression
 
     def eval(self, compiler):
         if self.expression:
-            self.expression.eval(compiler)
+            compiler.function.has_return_value = True
+            yield self.expression
         compiler.add(Instruction(Opcode.RETURN))
 
 
 class BlockStatement(Node):
+    __slots__ = ("statements",)
 
     def __init__(self, statements):
         self.statements = statements
 
     def eval(self, compiler):
         for statement in self.statements:
-            statement.eval(compiler)
+            yield statement
 
 
 class WhenStatement(Node):
+    __slots__ = ("identifier", "cases")
 
     def __init__(self, identifier, cases):
         self.identifier = identifier
@@ -265,6 +329,8 @@ class WhenStatement(Node):
 
 
 class DefaultCaseStatement(Node):
+    __slots__ = ("statement",)
+
     def __init__(self, statement):
         self.statement = statement
 
@@ -273,6 +339,7 @@ class DefaultCaseStatement(Node):
 
 
 class CaseStatement(Node):
+    __slots__ = ("literal", "statement")
 
     def __init__(self, literal, statement):
         self.literal = literal
@@ -282,24 +349,88 @@ class CaseStatement(Node):
         pass
 
 
+# Binding power and node for every infix operator. Higher powers bind
+# tighter, all operators are left associative.
+BINARY_OPERATORS = {
+    TokenType.TOKEN_OR: (10, LogicalExpression),
+    TokenType.TOKEN_AND: (20, LogicalExpression),
+    TokenType.TOKEN_ISEQ: (30, CompareExpression),
+    TokenType.TOKEN_ISNEQ: (30, CompareExpression),
+    TokenType.TOKEN_ISG: (40, CompareExpression),
+    TokenType.TOKEN_ISGE: (40, CompareExpression),
+    TokenType.TOKEN_ISL: (40, CompareExpression),
+    TokenType.TOKEN_ISLE: (40, CompareExpression),
+    TokenType.TOKEN_PLUS: (50, BinaryExpression),
+    TokenType.TOKEN_DASH: (50, BinaryExpression),
+    TokenType.TOKEN_STAR: (60, BinaryExpression),
+    TokenType.TOKEN_SLASH: (60, BinaryExpression),
+}
+
+PREFIX_OPERATORS = {TokenType.TOKEN_NOT, TokenType.TOKEN_DASH}
+PREFIX_POWER = 70
+
+LITERALS = {TokenType.TOKEN_IDENTIFIER, TokenType.TOKEN_DIGIT, TokenType.TOKEN_STRING, TokenType.TOKEN_DECIMAL}
+
+# Entries on the pending stack of Parser.parse_expression. Unary and binary
+# entries carry a binding power in slot 1 and are folded by precedence.
+PENDING_UNARY = 0
+PENDING_BINARY = 1
+PENDING_GROUP = 2
+PENDING_CALL = 3
+PENDING_TERNARY = 4
+
+# Token kinds that open a block closed by end, and end itself, as a class
+# over the packed token kinds. An else block shares the end of its if. An
+# if statement is counted at its then, since a ternary starts with if as
+# well but has no then and no end.
+BLOCK_KINDS = re.compile(b"[%s]" % re.escape(bytes([TokenType.TOKEN_DEF, TokenType.TOKEN_THEN, TokenType.TOKEN_WHEN, TokenType.TOKEN_DO, TokenType.TOKEN_END])))
+
+VAR_TYPES = [TokenType.TOKEN_INT8, TokenType.TOKEN_INT16, TokenType.TOKEN_INT32, TokenType.TOKEN_INT64, TokenType.TOKEN_FLOAT64]
+
+
 class Parser:
 
     def __init__(self, lexer):
         self.lexer = lexer
+        self.tokens = lexer.tokenize()
+        self.packed_kinds = self.tokens.kinds.tobytes()
+        self.last = len(self.tokens) - 1
+        self.index = -1
         self.token = None
+        self.statement_parsers = {
+            TokenType.TOKEN_EXTERN: self.parse_extern_statement,
+            TokenType.TOKEN_DEF: self.parse_def_statement,
+            TokenType.TOKEN_PUB: self.parse_pub_statement,
+            TokenType.TOKEN_IDENTIFIER: self.parse_identifier_statement,
+            TokenType.TOKEN_IF: self.parse_if_statement,
+            TokenType.TOKEN_ELSE: self.parse_else_statement,
+            TokenType.TOKEN_INCLUDE: self.parse_include_statement,
+            TokenType.TOKEN_RETURN: self.parse_return_statement,
+            TokenType.TOKEN_WHEN: self.parse_when_statement,
+            TokenType.TOKEN_DO: self.parse_do_statement,
+        }
+        for var_type in VAR_TYPES:
+            self.statement_parsers[var_type] = self.parse_var_statement
 
     def parse_advance(self, expecting=None):
         current_tok = self.token
 
         if expecting is not None and current_tok.kind != expecting:
-            raise Exception("Expecting token type %s. Got %s instead." % (expecting.kind, current_tok.kind))
+            raise Exception("Expecting token type %s. Got %s instead." % (expecting.name, current_tok.kind.name))
 
-        self.token = self.lexer.next_token()
+        if self.index < self.last:
+            self.index += 1
+        self.token = self.tokens.token(self.index)
 
         if current_tok is None:
             current_tok = self.token
         return current_tok
 
+    # Returns the kind of the token k positions past the current one without
+    # consuming anything. Reads past the end keep returning TOKEN_EOF.
+    def peek(self, k=1):
+        return self.tokens.kind(min(self.index + k, self.last))
+
     def parse_accept(self, t):
         return True and self.parse_advance() if self.token.kind == t else False
 
@@ -309,14 +440,19 @@ class Parser:
     def parse_token_matches(self, types):
         return self.token.kind in types
 
+    # Statements that own a block are generators. A bare yield asks
+    # parse_statement for the next nested statement and receives it back,
+    # so nesting depth costs heap frames instead of Python stack.
     def parse_block_statement(self, endings):
         statements = []
         while not self.parse_token_matches(endings):
-            statement = self.parse_statement()
+            if self.parse_match(TokenType.TOKEN_EOF):
+                raise Exception("Unexpected end of file. Expecting %s." % " or ".join(t.name for t in endings))
+            statement = yield
             statements.append(statement)
         return statements
 
-    def parse_def_statement(self, pub):
+    def parse_def_statement(self, pub=False):
         self.parse_advance()
         name = self.parse_advance(TokenType.TOKEN_IDENTIFIER)
         self.parse_advance(TokenType.TOKEN_LEFT_PAREN)
@@ -327,7 +463,7 @@ class Parser:
         if self.parse_accept(TokenType.TOKEN_COLON):
             def_type = self.parse_advance()
 
-        block = self.parse_block_statement([TokenType.TOKEN_END])
+        block = yield from self.parse_block_statement([TokenType.TOKEN_END])
         self.parse_advance(TokenType.TOKEN_END)
         return self.new_ast(DefStatement(name, block, def_type, pub))
 
@@ -343,18 +479,18 @@ class Parser:
         self.parse_advance()
         condition = self.parse_expression()
         self.parse_advance(TokenType.TOKEN_THEN)
-        then_block = self.parse_block_statement([TokenType.TOKEN_ELIF, TokenType.TOKEN_ELSE, TokenType.TOKEN_END])
+        then_block = yield from self.parse_block_statement([TokenType.TOKEN_ELIF, TokenType.TOKEN_ELSE, TokenType.TOKEN_END])
         else_block = None
 
         if self.parse_match(TokenType.TOKEN_ELSE):
-            else_block = self.parse_statement()
+            else_block = yield
         else:
             self.parse_advance(TokenType.TOKEN_END)
         return self.new_ast(IfStatement(condition, then_block, else_block))
 
     def parse_else_statement(self):
         self.parse_advance(TokenType.TOKEN_ELSE)
-        block = self.parse_block_statement([TokenType.TOKEN_END])
+        block = yield from self.parse_block_statement([TokenType.TOKEN_END])
         self.parse_advance(TokenType.TOKEN_END)
         return self.new_ast(ElseStatement(block))
 
@@ -374,7 +510,7 @@ class Parser:
         while not self.parse_match(TokenType.TOKEN_END):
             literal = self.parse_literal()
             self.parse_advance(TokenType.TOKEN_EQGT)
-            statement = self.parse_statement()
+            statement = yield
 
             if literal.token.kind == TokenType.TOKEN_IDENTIFIER and literal.token.data == '_':
                 cases.append(DefaultCaseStatement(statement))
@@ -392,46 +528,134 @@ class Parser:
     def parse_return_statement(self):
         self.parse_advance()
         expression = None
-        if not self.parse_match(TokenType.TOKEN_END):
+        if not self.parse_token_matches([TokenType.TOKEN_END, TokenType.TOKEN_ELSE, TokenType.TOKEN_ELIF]):
             expression = self.parse_expression()
         return self.new_ast(ReturnStatement(expression))
 
     def parse_do_statement(self):
         self.parse_advance()
-        block = self.parse_block_statement([TokenType.TOKEN_END])
+        block = yield from self.parse_block_statement([TokenType.TOKEN_END])
         self.parse_advance(TokenType.TOKEN_END)
         return self.new_ast(BlockStatement(block))
 
+    def parse_pub_statement(self):
+        self.parse_advance()
+        if self.parse_match(TokenType.TOKEN_DEF):
+            return self.parse_def_statement(True)
+        raise Exception("Error. pub can only be used with a def token.")
+
     def parse_statement(self):
         if not self.token or self.token.kind == TokenType.TOKEN_EOF:
             return None
-        if self.parse_match(TokenType.TOKEN_EXTERN):
-            return self.parse_extern_statement()
-        elif self.parse_match(TokenType.TOKEN_DEF):
-            return self.parse_def_statement(False)
-        elif self.parse_match(TokenType.TOKEN_PUB):
-            self.parse_advance()
-            if self.parse_match(TokenType.TOKEN_DEF):
-                return self.parse_def_statement(True)
-            raise Exception("Error. pub can only be used with a def token.")
-        elif self.parse_match(TokenType.TOKEN_IDENTIFIER):
-            return self.parse_identifier_statement()
-        elif self.parse_token_matches([TokenType.TOKEN_INT8, TokenType.TOKEN_INT16, TokenType.TOKEN_INT32, TokenType.TOKEN_INT64, TokenType.TOKEN_FLOAT64]):
-            return self.parse_var_statement()
-        elif self.parse_match(TokenType.TOKEN_IF):
-            return self.parse_if_statement()
-        elif self.parse_match(TokenType.TOKEN_ELSE):
-            return self.parse_else_statement()
-        elif self.parse_match(TokenType.TOKEN_INCLUDE):
-            return self.parse_include_statement()
-        elif self.parse_match(TokenType.TOKEN_RETURN):
-            return self.parse_return_statement()
-        elif self.parse_match(TokenType.TOKEN_WHEN):
-            return self.parse_when_statement()
-        elif self.parse_match(TokenType.TOKEN_DO):
-            return self.parse_do_statement()
+
+        frames = []
+        result = self.start_statement()
+        while True:
+            if isinstance(result, GeneratorType):
+                frames.append(result)
+                result = None
+            elif not frames:
+                return result
+            try:
+                frames[-1].send(result)
+                result = self.start_statement()
+            except StopIteration as stop:
+                frames.pop()
+                result = stop.value
+
+    # Returns either a finished node or the generator of a statement that
+    # still needs its nested statements.
+    def start_statement(self):
+        parse = self.statement_parsers.get(self.token.kind)
+        if parse is None:
+            raise Exception("Unexpected token %s '%s' at the start of a statement." % (self.token.kind.name, self.token.data))
+        return parse()
+
+    # Yields the top level statements one at a time, so callers can be done
+    # with each one before the next is parsed.
+    def statements(self):
+        while True:
+            statement = self.parse_statement()
+            if statement is None:
+                return
+            yield statement
+
+    # Maps the name of every function in the token stream to its return type,
+    # or None, without parsing the bodies. public_only keeps the pub ones,
+    # i.e. what the module offers to those that include it.
+    def function_signatures(self, public_only=False):
+        tokens = self.tokens
+        kinds = tokens.kinds
+        packed = self.packed_kinds
+        marker = bytes([TokenType.TOKEN_DEF])
+        signatures = {}
+        i = packed.find(marker)
+        while i != -1:
+            public = i > 0 and kinds[i - 1] == TokenType.TOKEN_PUB
+            if i + 1 < len(kinds) and kinds[i + 1] == TokenType.TOKEN_IDENTIFIER and (public or not public_only):
+                def_type = None
+                if i + 5 < len(kinds) and kinds[i + 4] == TokenType.TOKEN_COLON:
+                    def_type = TOKEN_TYPES[kinds[i + 5]]
+                signatures[tokens.data(i + 1)] = def_type
+            i = packed.find(marker, i + 1)
+        return signatures
+
+    # The module names of the include statements, in order.
+    def include_names(self):
+        tokens = self.tokens
+        packed = self.packed_kinds
+        marker = bytes([TokenType.TOKEN_INCLUDE])
+        names = []
+        i = packed.find(marker)
+        while i != -1:
+            if i + 1 < len(packed) and packed[i + 1] == TokenType.TOKEN_STRING:
+                names.append(tokens.data(i + 1))
+            i = packed.find(marker, i + 1)
+        return names
+
+    # Returns the indices of the first and last token of the function that
+    # starts at the current token, or None if no function starts here. Only
+    # the block keywords are looked at, the body is not parsed.
+    def function_span(self):
+        if self.token is None:
+            return None
+        first = self.index
+        start = first + 1 if self.token.kind == TokenType.TOKEN_PUB else first
+        if self.tokens.kind(start) != TokenType.TOKEN_DEF:
+            return None
+        depth = 0
+        for match in BLOCK_KINDS.finditer(self.packed_kinds, start):
+            if match.group()[0] == TokenType.TOKEN_END:
+                depth -= 1
+                if depth == 0:
+                    return first, match.start()
+            else:
+                depth += 1
         return None
 
+    def source_span(self, first, last):
+        tokens = self.tokens
+        return tokens.source[tokens.starts[first]:tokens.starts[last] + tokens.lengths[last]]
+
+    # Names called between the two token indices, i.e. identifiers followed
+    # by an opening parenthesis.
+    def called_names(self, first, last):
+        tokens = self.tokens
+        packed = self.packed_kinds
+        marker = bytes([TokenType.TOKEN_LEFT_PAREN])
+        names = set()
+        i = packed.find(marker, first, last)
+        while i != -1:
+            if packed[i - 1] == TokenType.TOKEN_IDENTIFIER:
+                names.add(tokens.data(i - 1))
+            i = packed.find(marker, i + 1, last)
+        return names
+
+    # Moves to the token after last, e.g. past a function taken from a cache.
+    def skip_past(self, last):
+        self.index = last
+        self.parse_advance()
+
     def parse_literal(self):
         return self.new_ast(LiteralExpression(self.parse_advance()))
 
@@ -456,102 +680,100 @@ class Parser:
         args = self.parse_args_expression()
         return self.new_ast(CallProcStatement(name, args))
 
-    def parse_identifier_statement(self):
-        name = self.parse_advance()
-        if self.token.kind == TokenType.TOKEN_LEFT_PAREN:
-            return self.parse_proc_call_statement(name)
-        return None
-
-    def parse_identifier_literal(self):
-        name = self.parse_advance()
-        if self.parse_match(TokenType.TOKEN_LEFT_PAREN):
-            args = self.parse_args_expression()
-            return self.new_ast(CallProcExpression(name, args))
-        return self.new_ast(LiteralExpression(name))
-
-    def parse_primary(self):
-        if self.parse_match(TokenType.TOKEN_LEFT_PAREN):
-            self.parse_advance()
-            exp = self.parse_expression()
-            self.parse_advance(TokenType.TOKEN_RIGHT_PAREN)
-            return exp
-        elif self.parse_match(TokenType.TOKEN_IDENTIFIER):
-            return self.parse_identifier_literal()
-        elif self.parse_token_matches([TokenType.TOKEN_DIGIT, TokenType.TOKEN_STRING, TokenType.TOKEN_DECIMAL]):
-            return self.parse_literal()
-        return None
-
-    def parse_unary(self):
-        while self.parse_match(TokenType.TOKEN_NOT) or self.parse_match(TokenType.TOKEN_DASH):
-            operator = self.parse_advance()
-            right = self.parse_unary()
-            return self.new_ast(UnaryExpression(right, operator))
-        return self.parse_primary()
-
-    def parse_factor(self):
-        exp = self.parse_unary()
-        while self.parse_match(TokenType.TOKEN_SLASH) or self.parse_match(TokenType.TOKEN_STAR):
-            operator = self.parse_advance()
-            right = self.parse_unary()
-            exp = self.new_ast(BinaryExpression(exp, right, operator))
-        return exp
-
-    def parse_term(self):
-        exp = self.parse_factor()
-        while self.parse_match(TokenType.TOKEN_DASH) or self.parse_match(TokenType.TOKEN_PLUS):
-            operator = self.parse_advance()
-            right = self.parse_factor()
-            exp = self.new_ast(BinaryExpression(exp, right, operator))
-        return exp
-
-    def parse_comparison(self):
-        exp = self.parse_term()
-        while self.parse_match(TokenType.TOKEN_ISG) or self.parse_match(TokenType.TOKEN_ISGE) or self.parse_match(
-                TokenType.TOKEN_ISL) or self.parse_match(TokenType.TOKEN_ISLE):
-            operator = self.parse_advance()
-            right = self.parse_term()
-            exp = self.new_ast(CompareExpression(exp, right, operator))
-        return exp
-
-    def parse_equality(self):
-        exp = self.parse_comparison()
-        while self.parse_match(TokenType.TOKEN_ISNEQ) or self.parse_match(TokenType.TOKEN_ISEQ):
-            operator = self.parse_advance()
-            right = self.parse_comparison()
-            exp = self.new_ast(CompareExpression(exp, right, operator))
-        return exp
-
-    def parse_and_expression(self):
-        exp = self.parse_equality()
-
-        while self.parse_match(TokenType.TOKEN_AND):
-            operator = self.parse_advance()
-            right = self.parse_equality()
-            exp = self.new_ast(LogicalExpression(exp, right, operator))
-        return exp
-
-    def parse_or_expression(self):
-        exp = self.parse_and_expression()
-
-        while self.parse_match(TokenType.TOKEN_OR):
-            operator = self.parse_advance()
-            right = self.parse_and_expression()
-            exp = self.new_ast(LogicalExpression(exp, right, operator))
-        return exp
-
-    def parse_ternary_if_expression(self):
-        condition = self.parse_expression()
-        self.parse_advance(TokenType.TOKEN_QUESTION)
-        then_expression = self.parse_expression()
-        self.parse_advance(TokenType.TOKEN_COLON)
-        else_expression = self.parse_expression()
-        return self.new_ast(TernaryExpression(condition, then_expression, else_expression))
+    def parse_assign_statement(self):
+        name = self.parse_advance(TokenType.TOKEN_IDENTIFIER)
+        self.parse_advance(TokenType.TOKEN_EQ)
+        return self.new_ast(AssignStatement(name, self.parse_expression()))
 
+    def parse_identifier_statement(self):
+        following = self.peek()
+        if following == TokenType.TOKEN_LEFT_PAREN:
+            return self.parse_proc_call_statement(self.parse_advance())
+        elif following == TokenType.TOKEN_EQ:
+            return self.parse_assign_statement()
+        raise Exception("Unexpected token %s after identifier '%s'." % (TokenType(following).name, self.token.data))
+
+    # Operator precedence parsing with explicit operand and pending stacks.
+    # Groups, calls and ternaries are pending entries closed by their
+    # terminating token, so nesting depth is bounded only by memory.
     def parse_expression(self):
-        if self.parse_match(TokenType.TOKEN_IF):
-            self.parse_advance()
-            return self.parse_ternary_if_expression()
-        return self.parse_or_expression()
+        operands = []
+        pending = []
+        at_start = True
+
+        while True:
+            kind = self.token.kind
+            if kind == TokenType.TOKEN_IF and at_start:
+                self.parse_advance()
+                pending.append([PENDING_TERNARY, 0])
+                continue
+            elif kind in PREFIX_OPERATORS:
+                pending.append([PENDING_UNARY, PREFIX_POWER, self.parse_advance()])
+                at_start = False
+                continue
+            elif kind == TokenType.TOKEN_LEFT_PAREN:
+                self.parse_advance()
+                pending.append([PENDING_GROUP])
+                at_start = True
+                continue
+            elif kind == TokenType.TOKEN_IDENTIFIER and self.peek() == TokenType.TOKEN_LEFT_PAREN:
+                name = self.parse_advance()
+                self.parse_advance()
+                if not self.parse_match(TokenType.TOKEN_RIGHT_PAREN):
+                    pending.append([PENDING_CALL, name, []])
+                    at_start = True
+                    continue
+                self.parse_advance()
+                operands.append(self.new_ast(CallProcExpression(name, [])))
+            elif kind in LITERALS:
+                operands.append(self.parse_literal())
+            else:
+                raise Exception("Expecting an expression. Got %s '%s' instead." % (kind.name, self.token.data))
+
+            # An operand is complete, fold pending operators into it until
+            # the next token continues the expression with a new operand.
+            while True:
+                entry = BINARY_OPERATORS.get(self.token.kind)
+                power = entry[0] if entry is not None else 0
+                while pending and pending[-1][0] <= PENDING_BINARY and pending[-1][1] >= power:
+                    self.reduce_pending(pending.pop(), operands)
+
+                if entry is not None:
+                    pending.append([PENDING_BINARY, power, entry[1], self.parse_advance()])
+                    at_start = False
+                    break
+                if not pending:
+                    return operands.pop()
+
+                top = pending[-1]
+                if top[0] == PENDING_GROUP:
+                    self.parse_advance(TokenType.TOKEN_RIGHT_PAREN)
+                    pending.pop()
+                elif top[0] == PENDING_CALL:
+                    top[2].append(operands.pop())
+                    if self.parse_accept(TokenType.TOKEN_COMMA) and not self.parse_match(TokenType.TOKEN_RIGHT_PAREN):
+                        at_start = True
+                        break
+                    self.parse_advance(TokenType.TOKEN_RIGHT_PAREN)
+                    pending.pop()
+                    operands.append(self.new_ast(CallProcExpression(top[1], top[2])))
+                elif top[1] < 2:
+                    self.parse_advance(TokenType.TOKEN_QUESTION if top[1] == 0 else TokenType.TOKEN_COLON)
+                    top[1] += 1
+                    at_start = True
+                    break
+                else:
+                    pending.pop()
+                    else_expression = operands.pop()
+                    then_expression = operands.pop()
+                    operands.append(self.new_ast(TernaryExpression(operands.pop(), then_expression, else_expression)))
+
+    def reduce_pending(self, entry, operands):
+        if entry[0] == PENDING_UNARY:
+            operands.append(self.new_ast(UnaryExpression(operands.pop(), entry[2])))
+        else:
+            right = operands.pop()
+            operands.append(self.new_ast(entry[2](operands.pop(), right, entry[3])))
 
     def new_ast(self, clazz):
         # print("Node: %s" % clazz.__str__)
@@ -0,0 +1,233 @@
+from collections import Counter
+import re
+
+from src.assembly import EPILOGUE, RETURN
+
+PATTERNS = ["load-store", "jump-to-next", "jump-threading", "zero-xor", "dead-move"]
+
+# General purpose registers by name, as (family, bits).
+REGISTERS = {}
+for family in "abcd":
+    REGISTERS.update({"r%sx" % family: (family, 64), "e%sx" % family: (family, 32), "%sx" % family: (family, 16), "%sl" % family: (family, 8)})
+for family in ("si", "di", "bp", "sp"):
+    REGISTERS.update({"r" + family: (family, 64), "e" + family: (family, 32), family: (family, 16), family + "l": (family, 8)})
+for number in range(8, 16):
+    family = "r%s" % number
+    REGISTERS.update({family: (family, 64), family + "d": (family, 32), family + "w": (family, 16), family + "b": (family, 8)})
+NAMES = {entry: name for name, entry in REGISTERS.items()}
+# ah and friends share the family of the accumulator, but not its low byte.
+REGISTERS.update({"%sh" % family: (family, 8) for family in "abcd"})
+
+IMMEDIATE = re.compile(r"-?\d+$")
+WORD = re.compile(r"\w+")
+
+# Instructions that fully define their first operand without reading it.
+DEFINES = {"mov", "movzx", "movsx", "movsxd", "lea"}
+# Instructions that leave the flags set for whatever comes after them.
+FLAG_WRITERS = {"cmp", "test", "add", "sub", "and", "or", "xor", "imul", "mul", "idiv", "div", "neg", "inc", "dec", "call"}
+
+
+# One line of a fragment, split into the mnemonic and its operands, or a
+# label. Lines that are not rewritten keep their original text.
+class AsmLine:
+    __slots__ = ("op", "operands", "label", "text")
+
+    def __init__(self, op, operands, label=None, text=None):
+        self.op = op
+        self.operands = operands
+        self.label = label
+        self.text = text
+
+    @classmethod
+    def parse(cls, line):
+        if not line.startswith(" "):
+            return cls(None, (), line[:-2], line)
+        op, _, rest = line[1:-1].partition(" ")
+        return cls(op, rest.split(", ") if rest else [], None, line)
+
+    def render(self):
+        if self.text is None:
+            self.text = " %s %s\n" % (self.op, ", ".join(self.operands)) if self.operands else " %s\n" % self.op
+        return self.text
+
+    @property
+    def is_jump(self):
+        return self.op is not None and self.op[0] == "j"
+
+    def retarget(self, label):
+        self.operands = [label]
+        self.text = None
+
+
+def register(operand):
+    return REGISTERS.get(operand)
+
+
+def families_read(operands):
+    families = set()
+    for operand in operands:
+        for word in WORD.findall(operand):
+            entry = REGISTERS.get(word)
+            if entry is not None:
+                families.add(entry[0])
+    return families
+
+
+# Rewrites the code of a function through a window of patterns until none
+# applies. patterns picks which of PATTERNS run, all of them by default.
+# Hits are counted per pattern over every function optimized.
+class Peephole:
+
+    def __init__(self, patterns=None):
+        self.patterns = list(PATTERNS if patterns is None else patterns)
+        for name in self.patterns:
+            if name not in PATTERNS:
+                raise Exception("Unknown peephole pattern %s, expected one of %s." % (name, ", ".join(PATTERNS)))
+        self.window = [getattr(self, name.replace("-", "_")) for name in self.patterns if name != "jump-threading"]
+        self.hits = Counter()
+
+    # Identifies the patterns in cache keys, since they change the code.
+    def options(self):
+        return "peephole=%s" % ",".join(self.patterns)
+
+    def optimize(self, fragment):
+        code = [line if line.__class__ is not str else AsmLine.parse(line) for line in fragment.lines]
+        threading = "jump-threading" in self.patterns
+        changed = True
+        while changed:
+            changed = threading and self.jump_threading(code)
+            index = 0
+            while index < len(code):
+                for pattern in self.window:
+                    if pattern(code, index):
+                        self.hits[pattern.__name__.replace("_", "-")] += 1
+                        changed = True
+                        # What was rewritten may complete a pattern with the
+                        # line before it.
+                        index = max(index - 1, 0)
+                        break
+                else:
+                    index += 1
+        fragment.replace_lines([line if line.__class__ is not AsmLine else line.render() for line in code])
+
+    # mov m, r then mov r2, m loads what was just stored, take it from r.
+    # mov r, m then mov m, r stores back what was just loaded.
+    def load_store(self, code, index):
+        if index + 1 >= len(code):
+            return False
+        first, second = code[index], code[index + 1]
+        if first.__class__ is not AsmLine or second.__class__ is not AsmLine or first.op != "mov" or second.op != "mov":
+            return False
+        destination, source = first.operands
+        if second.operands == [source, destination]:
+            del code[index + 1]
+            return True
+        if "[" not in destination or second.operands[1] != destination:
+            return False
+        entry = register(source)
+        if entry is None and not IMMEDIATE.match(source):
+            return False
+        # The address must not use the register that was stored.
+        if entry is not None and entry[0] in families_read([destination]):
+            return False
+        if second.operands[0] == source:
+            del code[index + 1]
+        else:
+            code[index + 1] = AsmLine("mov", [second.operands[0], source])
+        return True
+
+    # A jump to a label that directly follows it.
+    def jump_to_next(self, code, index):
+        jump = code[index]
+        if jump.__class__ is not AsmLine or not jump.is_jump:
+            return False
+        following = index + 1
+        while following < len(code) and code[following].__class__ is AsmLine and code[following].label is not None:
+            if code[following].label == jump.operands[0]:
+                del code[index]
+                return True
+            following += 1
+        return False
+
+    # mov r, 0 becomes xor r, r when nothing reads the flags it clobbers.
+    def zero_xor(self, code, index):
+        line = code[index]
+        if line.__class__ is not AsmLine or line.op != "mov" or line.operands[1] != "0":
+            return False
+        entry = register(line.operands[0])
+        if entry is None or entry[1] < 32 or not self.flags_dead(code, index + 1):
+            return False
+        # The 32 bit form clears the upper half as well and is shorter.
+        name = NAMES[(entry[0], 32)]
+        code[index] = AsmLine("xor", [name, name])
+        return True
+
+    def flags_dead(self, code, index):
+        for position in range(index, len(code)):
+            line = code[position]
+            if line is EPILOGUE or line is RETURN:
+                return True
+            if line.__class__ is not AsmLine or line.label is not None or line.is_jump:
+                return False
+            if line.op in FLAG_WRITERS:
+                return True
+            if line.op.startswith(("set", "cmov", "adc", "sbb")):
+                return False
+        return False
+
+    # A move into a register overwritten by the next line, which does not
+    # read it.
+    def dead_move(self, code, index):
+        if index + 1 >= len(code):
+            return False
+        first, second = code[index], code[index + 1]
+        if first.__class__ is not AsmLine or second.__class__ is not AsmLine or first.op not in DEFINES or second.op not in DEFINES:
+            return False
+        written = register(first.operands[0])
+        overwritten = register(second.operands[0])
+        if written is None or overwritten is None or written[0] != overwritten[0]:
+            return False
+        # Byte registers only cover themselves, al and ah are different bytes.
+        if first.operands[0] != second.operands[0] and overwritten[1] < max(written[1], 16):
+            return False
+        if written[0] in families_read(second.operands[1:]):
+            return False
+        del code[index]
+        return True
+
+    # Points jumps to a label that is followed by another jump straight at
+    # the final target.
+    def jump_threading(self, code):
+        targets = {}
+        labels = []
+        for line in code:
+            if line.__class__ is AsmLine and line.label is not None:
+                labels.append(line.label)
+                continue
+            if line.__class__ is AsmLine and line.op == "jmp":
+                for label in labels:
+                    targets[label] = line.operands[0]
+            labels = []
+        changed = False
+        for line in code:
+            if line.__class__ is not AsmLine or not line.is_jump:
+                continue
+            target = line.operands[0]
+            seen = {target}
+            while target in targets and targets[target] not in seen:
+                target = targets[target]
+                seen.add(target)
+            if target != line.operands[0]:
+                line.retarget(target)
+                self.hits["jump-threading"] += 1
+                changed = True
+        return changed
+
+
+# Reads the --peephole option: all, none, or a comma separated list.
+def parse_patterns(text):
+    if text == "none":
+        return None
+    if text == "all":
+        return Peephole()
+    return Peephole(name.strip() for name in text.split(","))
@@ -0,0 +1,188 @@
+from bisect import bisect_right
+
+from src.compiler import Opcode
+from src.token import TokenType
+
+# Registers a local may live in, in order of preference. Calls may clobber
+# r10 and r11, so they only hold variables not live across a call; the
+# callee saved ones are pushed in the prologue of a function using them.
+VOLATILE = ["r10", "r11"]
+CALLEE_SAVED = ["rsi", "rdi", "r12", "r13", "r14", "r15"]
+
+# The name of each register for a variable of each width. Byte variables
+# stay in memory, since the i8 arithmetic goes through ah and dh, which
+# cannot be used along with sil, dil or r8b-r15b.
+NAMES = {
+    "rsi": {16: "si", 32: "esi", 64: "rsi"},
+    "rdi": {16: "di", 32: "edi", 64: "rdi"},
+}
+for register in VOLATILE + CALLEE_SAVED[2:]:
+    NAMES[register] = {16: register + "w", 32: register + "d", 64: register}
+
+# What each opcode does to the variables and to the stack of the compiler,
+# as (values popped, effect), indexed by opcode.
+NOTHING, STORE, MEMORY_STORE, LOAD, PUSH, CALL, RETURN, START, END = range(9)
+EFFECTS = [(0, NOTHING)] * len(Opcode)
+for opcode, effect in {
+    # Declarations of variables that can live in a register, and of ones
+    # that cannot.
+    Opcode.STORE_INT16: (1, STORE), Opcode.STORE_INT32: (1, STORE), Opcode.STORE_INT64: (1, STORE), Opcode.STORE_VAR: (1, STORE),
+    Opcode.STORE_INT8: (1, MEMORY_STORE), Opcode.STORE_FLOAT64: (1, MEMORY_STORE),
+    Opcode.LOAD_VAR: (0, LOAD),
+    Opcode.MOV_INT_CONST: (0, PUSH), Opcode.MOV_UNSIGNED_INT_CONST: (0, PUSH), Opcode.MOV_FLOAT_CONST: (0, PUSH), Opcode.LOAD_STRING: (0, PUSH),
+    Opcode.ADD: (2, PUSH), Opcode.SUB: (2, PUSH), Opcode.MUL: (2, PUSH), Opcode.DIV: (2, PUSH),
+    Opcode.NEGATE: (1, PUSH), Opcode.NOT: (1, PUSH),
+    Opcode.CMP: (2, PUSH), Opcode.SET: (2, PUSH), Opcode.SELECT: (3, PUSH),
+    Opcode.CHOOSE: (1, NOTHING), Opcode.CHOSEN: (0, PUSH),
+    Opcode.PUSH_ARGUMENT: (1, NOTHING), Opcode.JMPFALSE: (1, NOTHING),
+    Opcode.CALL: (0, CALL), Opcode.RETURN: (0, RETURN),
+    Opcode.START_PROC: (0, START), Opcode.START_PUB_PROC: (0, START), Opcode.END_PROC: (0, END),
+}.items():
+    EFFECTS[opcode] = effect
+INTEGER_KINDS = {TokenType.TOKEN_INT8, TokenType.TOKEN_INT16, TokenType.TOKEN_INT32, TokenType.TOKEN_INT64}
+
+
+# The instructions over which a variable holds a value, from its first
+# store to the last instruction reading it.
+class LiveRange:
+    __slots__ = ("name", "start", "end", "across_call", "register")
+
+    def __init__(self, name, start):
+        self.name = name
+        self.start = start
+        self.end = start
+        self.across_call = False
+        self.register = None
+
+
+# Where the variables of one function live: the register of each variable
+# that got one, and the callee saved registers to preserve.
+class Allocation:
+    __slots__ = ("registers", "saved")
+
+    def __init__(self, registers, saved):
+        self.registers = registers
+        self.saved = saved
+
+    # The register of a variable of the given width, or None if it lives on
+    # the stack.
+    def register(self, name, bits):
+        register = self.registers.get(name)
+        return None if register is None else NAMES[register][bits]
+
+
+NO_ALLOCATION = Allocation({}, [])
+
+
+# Linear scan over the live ranges of the integer locals of each function.
+# The language has no loops, so a range from the first store to the last
+# read covers every path through the function. When the registers run out,
+# the range ending last is spilled to the stack.
+class RegisterAllocator:
+
+    def __init__(self, functions):
+        # The functions of the program, for which calls leave a value.
+        self.functions = functions
+        self.allocations = {}
+        self.allocated = 0
+        self.spilled = 0
+
+    # Where the variables of the named function live, once allocate went
+    # over its instructions.
+    def allocation(self, name):
+        return self.allocations.get(name, NO_ALLOCATION)
+
+    # Allocates the functions defined in instructions, in place of the ones
+    # allocated before.
+    def allocate(self, instructions):
+        allocations = {}
+        index = 0
+        while index < len(instructions):
+            instr = instructions[index]
+            if EFFECTS[instr.opcode][1] == START:
+                ranges, index = self.live_ranges(instructions, index + 1)
+                allocations[instr.value] = self.allocate_function(ranges) if ranges else NO_ALLOCATION
+            else:
+                index += 1
+        self.allocations = allocations
+
+    def allocate_function(self, ranges):
+        active = []
+        registers = {}
+        saved = []
+        for live in ranges:
+            for other in list(active):
+                if other.end < live.start:
+                    active.remove(other)
+            choices = CALLEE_SAVED if live.across_call else VOLATILE + CALLEE_SAVED
+            used = {other.register for other in active}
+            register = next((choice for choice in choices if choice not in used), None)
+            if register is None:
+                # Spill whichever of the ranges that could give up a fitting
+                # register ends last, this one included.
+                victim = max((other for other in active if other.register in choices), key=lambda other: other.end, default=None)
+                if victim is None or victim.end <= live.end:
+                    self.spilled += 1
+                    continue
+                register = victim.register
+                active.remove(victim)
+                del registers[victim.name]
+                self.spilled += 1
+                self.allocated -= 1
+            live.register = register
+            active.append(live)
+            registers[live.name] = register
+            self.allocated += 1
+            if register in CALLEE_SAVED and register not in saved:
+                saved.append(register)
+        return Allocation(registers, saved)
+
+    # Follows the stack of the compiler through the function starting at
+    # first, so a variable counts as read where its loaded value is consumed,
+    # which can be after a call in between, e.g. in x + f(). Returns the
+    # ranges and the index after the end of the function.
+    def live_ranges(self, instructions, first):
+        ranges = {}
+        excluded = set()
+        calls = []
+        stack = []
+        pop = stack.pop
+        push = stack.append
+        index = first
+        for index in range(first, len(instructions)):
+            instr = instructions[index]
+            pops, effect = EFFECTS[instr.opcode]
+            if effect == RETURN:
+                pops = 1 if stack else 0
+            while pops and stack:
+                pops -= 1
+                name = pop()
+                if name is not None:
+                    ranges[name].end = index
+            if effect == PUSH:
+                push(None)
+            elif effect == LOAD:
+                push(instr.value if instr.value in ranges else None)
+            elif effect == STORE or effect == MEMORY_STORE:
+                live = ranges.get(instr.value)
+                if live is None:
+                    ranges[instr.value] = LiveRange(instr.value, index)
+                else:
+                    live.end = index
+                if effect == MEMORY_STORE:
+                    excluded.add(instr.value)
+            elif effect == CALL:
+                calls.append(index)
+                function = self.functions.get(instr.value)
+                if function is not None and function.kind in INTEGER_KINDS:
+                    push(None)
+            elif effect == END:
+                break
+        live_ranges = []
+        for live in ranges.values():
+            if live.name in excluded:
+                continue
+            following = bisect_right(calls, live.start)
+            live.across_call = following < len(calls) and calls[following] < live.end
+            live_ranges.append(live)
+        return live_ranges, index + 1
@@ -0,0 +1,746 @@
+from collections import Counter
+
+from src.compiler import CONDITION_TESTS, Instruction, Opcode
+from src.token import TokenType
+
+PASSES = ["constant-branches", "unreachable", "dead-stores"]
+# Passes that only check the code, run when named.
+CHECKS = ["verify"]
+
+# The three-address operation of each opcode found in a block. Labels,
+# jumps and returns make up the blocks instead, and the frame setup and
+# teardown stay around them.
+OPERATIONS = {
+    Opcode.MOV_INT_CONST: "const",
+    Opcode.MOV_UNSIGNED_INT_CONST: "const",
+    Opcode.MOV_FLOAT_CONST: "const",
+    Opcode.LOAD_STRING: "const",
+    Opcode.LOAD_VAR: "load",
+    Opcode.STORE_INT8: "declare",
+    Opcode.STORE_INT16: "declare",
+    Opcode.STORE_INT32: "declare",
+    Opcode.STORE_INT64: "declare",
+    Opcode.STORE_FLOAT64: "declare",
+    Opcode.STORE_VAR: "store",
+    Opcode.ADD: "add",
+    Opcode.SUB: "sub",
+    Opcode.MUL: "mul",
+    Opcode.DIV: "div",
+    Opcode.NEGATE: "neg",
+    Opcode.NOT: "not",
+    Opcode.PUSH_ARGUMENT: "arg",
+    Opcode.CALL: "call",
+    Opcode.CMP: "cmp",
+    Opcode.SET: "set",
+    Opcode.SELECT: "select",
+    Opcode.CHOOSE: "choose",
+    Opcode.CHOSEN: "chosen",
+}
+
+# Values each operation takes off the stack of the compiler, and whether it
+# leaves one. Calls leave one only for functions returning an integer.
+POPS = {"declare": 1, "store": 1, "arg": 1, "cmp": 2, "set": 2, "select": 3, "choose": 1, "add": 2, "sub": 2, "mul": 2, "div": 2, "neg": 1, "not": 1}
+PUSHES = {"const", "load", "cmp", "set", "select", "chosen", "add", "sub", "mul", "div", "neg", "not"}
+DEFINITIONS = {"declare", "store"}
+# Operations with no effect but the value they leave.
+PURE = {"const", "load", "add", "sub", "mul", "div", "neg", "not", "cmp", "set", "select", "chosen"}
+WIDTHS = {Opcode.STORE_INT8: 8, Opcode.STORE_INT16: 16, Opcode.STORE_INT32: 32, Opcode.STORE_INT64: 64}
+# (operation, values popped, leaves a value) by opcode, None for the ones
+# that are not operations.
+SHAPES = [None] * len(Opcode)
+for opcode, op in OPERATIONS.items():
+    SHAPES[opcode] = (op, POPS.get(op, 0), op in PUSHES)
+LABELS = {Opcode.IF, Opcode.ELSE, Opcode.ENDIF}
+INTEGER_KINDS = {TokenType.TOKEN_INT8, TokenType.TOKEN_INT16, TokenType.TOKEN_INT32, TokenType.TOKEN_INT64}
+
+
+# A value in SSA form: a temporary the compiler keeps on its stack, or a
+# version of a local variable. The versions of a variable never overlap, as
+# long as passes do not move definitions, so leaving SSA form only drops the
+# phis: every version lives where the variable does.
+class Value:
+    __slots__ = ("name", "version")
+
+    def __init__(self, name, version):
+        self.name = name
+        self.version = version
+
+    def __repr__(self):
+        return "%%%s" % self.version if self.name is None else "%s.%s" % (self.name, self.version)
+
+
+# dest = op args. value is the constant, variable or function the operation
+# refers to, and origin the instruction it came from and lowers back to.
+# Phis have an argument for every predecessor of their block, None where
+# the variable has no value.
+class Operation:
+    __slots__ = ("op", "dest", "args", "value", "origin")
+
+    def __init__(self, op, dest, args, value, origin):
+        self.op = op
+        self.dest = dest
+        self.args = args
+        self.value = value
+        self.origin = origin
+
+    def __repr__(self):
+        text = "%s %s" % (self.op, ", ".join(repr(arg) for arg in self.args)) if self.args else self.op
+        if self.value not in (None, "") and self.op != "phi":
+            text += " %s" % self.value
+        return text if self.dest is None else "%r = %s" % (self.dest, text)
+
+
+# Ends a block: a jump, a branch on a condition to its then target, which
+# it falls through to, and its else target, or a return. A target of None
+# leaves the function, as does a block without a terminator. origins are
+# the instructions it lowers back to, none for a block falling through to
+# the next one.
+class Terminator:
+    __slots__ = ("op", "args", "targets", "origins")
+
+    def __init__(self, op, args, targets, origins):
+        self.op = op
+        self.args = args
+        self.targets = targets
+        self.origins = origins
+
+    def __repr__(self):
+        targets = ", ".join("exit" if target is None else target.name for target in self.targets)
+        args = ", ".join(repr(arg) for arg in self.args)
+        return " ".join(part for part in (self.op, args, targets) if part)
+
+
+class Block:
+    __slots__ = ("index", "label", "phis", "operations", "terminator", "predecessors", "successors", "order", "idom", "children", "frontier", "first", "last")
+
+    def __init__(self, index, label):
+        self.index = index
+        # The label instruction the block starts with, if it is a target.
+        self.label = label
+        self.phis = []
+        self.operations = []
+        self.terminator = None
+        self.predecessors = []
+        self.successors = []
+        # Position in reverse postorder, -1 when unreachable.
+        self.order = -1
+        self.idom = None
+        self.children = []
+        self.frontier = set()
+        # The span of the dominator tree numbering of the blocks it
+        # dominates.
+        self.first = self.last = -1
+
+    @property
+    def name(self):
+        return "b%s" % self.index if self.label is None else self.label.value
+
+    @property
+    def reachable(self):
+        return self.order >= 0
+
+
+# The body of one function as basic blocks, in the order they are laid out.
+# header and footer are the instructions setting up and closing its frame.
+class SSAFunction:
+
+    def __init__(self, name, header):
+        self.name = name
+        self.header = header
+        self.footer = []
+        self.blocks = []
+        self.order = []
+        self.temporaries = 0
+        self.versions = Counter()
+        # The number of instructions it was built from.
+        self.size = 0
+
+    @property
+    def entry(self):
+        return self.blocks[0]
+
+    def add_block(self, label=None):
+        block = Block(len(self.blocks), label)
+        self.blocks.append(block)
+        return block
+
+    def version(self, name):
+        self.versions[name] += 1
+        return Value(name, self.versions[name])
+
+    # Links the blocks along their terminators and finds the ones reachable
+    # from the entry, in reverse postorder.
+    def compute_cfg(self):
+        for block in self.blocks:
+            block.predecessors = []
+        for block in self.blocks:
+            block.successors = []
+            if block.terminator is not None:
+                # A branch around an empty then block has the same target
+                # twice.
+                for target in block.terminator.targets:
+                    if target is not None and target not in block.successors:
+                        block.successors.append(target)
+            for successor in block.successors:
+                successor.predecessors.append(block)
+        self.compute_order()
+
+    def compute_order(self):
+        for block in self.blocks:
+            block.order = -1
+        postorder = []
+        visited = {self.entry.index}
+        stack = [(self.entry, iter(self.entry.successors))]
+        while stack:
+            block, successors = stack[-1]
+            successor = next(successors, None)
+            if successor is None:
+                stack.pop()
+                postorder.append(block)
+            elif successor.index not in visited:
+                visited.add(successor.index)
+                stack.append((successor, iter(successor.successors)))
+        postorder.reverse()
+        self.order = postorder
+        for position, block in enumerate(postorder):
+            block.order = position
+
+    # Immediate dominators by the iterative algorithm of Cooper, Harvey and
+    # Kennedy, then the dominator tree and the dominance frontiers.
+    def compute_dominators(self):
+        for block in self.blocks:
+            block.idom = None
+            block.children = []
+            block.frontier = set()
+            block.first = block.last = -1
+        entry = self.entry
+        entry.idom = entry
+        changed = True
+        while changed:
+            changed = False
+            for block in self.order[1:]:
+                idom = None
+                for predecessor in block.predecessors:
+                    if predecessor.idom is None:
+                        continue
+                    idom = predecessor if idom is None else intersect(predecessor, idom)
+                if block.idom is not idom:
+                    block.idom = idom
+                    changed = True
+        for block in self.order[1:]:
+            block.idom.children.append(block)
+            predecessors = [predecessor for predecessor in block.predecessors if predecessor.reachable]
+            if len(predecessors) < 2:
+                continue
+            for runner in predecessors:
+                while runner is not block.idom:
+                    runner.frontier.add(block)
+                    runner = runner.idom
+        number = 0
+        stack = [entry]
+        while stack:
+            block = stack.pop()
+            if block.first < 0:
+                block.first = number
+                number += 1
+                stack.append(block)
+                stack.extend(block.children)
+            else:
+                block.last = number
+
+    # Drops the edge from block to successor, with the arguments the phis
+    # of successor took along it.
+    def remove_edge(self, block, successor):
+        position = successor.predecessors.index(block)
+        del successor.predecessors[position]
+        for phi in successor.phis:
+            del phi.args[position]
+        block.successors.remove(successor)
+
+    def dominates(self, a, b):
+        return a.first <= b.first and b.last <= a.last and b.reachable
+
+    # Places phis at the iterated dominance frontiers of the definitions of
+    # each variable and renames every use to the version reaching it.
+    def construct_ssa(self):
+        definitions = {}
+        for block in self.order:
+            for operation in block.operations:
+                if operation.op in DEFINITIONS:
+                    definitions.setdefault(operation.value, []).append(block)
+        for name, blocks in definitions.items():
+            placed = set()
+            work = list(blocks)
+            while work:
+                for frontier in work.pop().frontier:
+                    if frontier.index not in placed:
+                        placed.add(frontier.index)
+                        frontier.phis.append(Operation("phi", None, [None] * len(frontier.predecessors), name, None))
+                        work.append(frontier)
+        current = {}
+        stack = [(self.entry, None)]
+        while stack:
+            block, defined = stack.pop()
+            if defined is not None:
+                # Leaving the subtree of the block, its versions go out of
+                # scope.
+                for name in defined:
+                    current[name].pop()
+                continue
+            defined = []
+            self.rename_block(block, current, defined)
+            stack.append((block, defined))
+            stack.extend((child, None) for child in reversed(block.children))
+        # Code nothing reaches sees only what it defines itself.
+        for block in self.blocks:
+            if not block.reachable:
+                self.rename_block(block, {}, [])
+
+    def rename_block(self, block, current, defined):
+        for phi in block.phis:
+            phi.dest = self.version(phi.value)
+            current.setdefault(phi.value, []).append(phi.dest)
+            defined.append(phi.value)
+        for operation in block.operations:
+            if operation.op == "load":
+                versions = current.get(operation.value)
+                operation.args[0] = versions[-1] if versions else None
+            elif operation.op in DEFINITIONS:
+                operation.dest = self.version(operation.value)
+                current.setdefault(operation.value, []).append(operation.dest)
+                defined.append(operation.value)
+        for successor in block.successors:
+            for phi in successor.phis:
+                versions = current.get(phi.value)
+                phi.args[successor.predecessors.index(block)] = versions[-1] if versions else None
+
+    # Appends the instructions of the stack machine for the function to out.
+    # A jump without instructions falls through, unless passes took away
+    # the blocks that were in between.
+    def lower(self, out):
+        out.extend(self.header)
+        start = len(out)
+        blocks = self.blocks
+        for position, block in enumerate(blocks):
+            if block.label is not None:
+                out.append(block.label)
+            for operation in block.operations:
+                out.append(operation.origin)
+            terminator = block.terminator
+            if terminator is None:
+                continue
+            if terminator.op != "jump":
+                out.extend(terminator.origins)
+                continue
+            # A jump to the next block goes, e.g. over an else pruned
+            # after it.
+            target = terminator.targets[0]
+            if position + 1 < len(blocks) and blocks[position + 1] is target:
+                continue
+            if terminator.origins:
+                out.extend(terminator.origins)
+                continue
+            if target.label is None:
+                raise Exception("No label to jump to %s in %s." % (target.name, self.name))
+            terminator.origins.append(Instruction(Opcode.JMP, None, target.label.value))
+            out.extend(terminator.origins)
+        # Drop the labels no jump is left to, e.g. the ones of a pruned
+        # branch.
+        targets = {instr.value for instr in out[start:] if instr.opcode == Opcode.JMP or instr.opcode == Opcode.JMPFALSE}
+        out[start:] = [instr for instr in out[start:] if instr.opcode not in LABELS or instr.value in targets]
+        out.extend(self.footer)
+
+    def format(self):
+        lines = ["%s:" % self.name]
+        for block in self.blocks:
+            predecessors = ", ".join(predecessor.name for predecessor in block.predecessors)
+            lines.append("  %s:%s%s" % (block.name, "" if block.reachable else " unreachable", " <- " + predecessors if predecessors else ""))
+            for operation in block.phis + block.operations:
+                lines.append("    %r" % operation)
+            if block.terminator is not None:
+                lines.append("    %r" % block.terminator)
+        return "\n".join(lines)
+
+
+def intersect(a, b):
+    while a is not b:
+        while a.order > b.order:
+            a = a.idom
+        while b.order > a.order:
+            b = b.idom
+    return a
+
+
+# Builds the blocks of the function starting at instructions[first] and
+# returns it with the index after its END_PROC. The stack of the compiler is
+# followed through the body, so every operation knows the temporaries it
+# takes, even those left on the stack by an earlier statement.
+def build_function(instructions, first, functions):
+    function = SSAFunction(instructions[first].value, [instructions[first]])
+    index = first + 1
+    if instructions[index].opcode == Opcode.SETUP_STACK:
+        function.header.append(instructions[index])
+        index += 1
+    block = function.add_block()
+    # A branch without a jump after it goes on to the next block.
+    falls_through = None
+    labels = {}
+    stack = []
+    pop = stack.pop
+    push = stack.append
+    temporaries = 0
+    while True:
+        instr = instructions[index]
+        opcode = instr.opcode
+        index += 1
+        shape = SHAPES[opcode]
+        if shape is not None and block is not None:
+            op, pops, pushes = shape
+            if op == "load":
+                args = [None]
+            elif pops == 0:
+                args = []
+            elif pops == 1:
+                args = [pop() if stack else None]
+            elif pops == 2:
+                right = pop() if stack else None
+                args = [pop() if stack else None, right]
+            else:
+                args = [pop() if stack else None for _ in range(pops)]
+                args.reverse()
+            operation = Operation(op, None, args, instr.value, instr)
+            if pushes or (op == "call" and getattr(functions.get(instr.value), "kind", None) in INTEGER_KINDS):
+                temporaries += 1
+                operation.dest = Value(None, temporaries)
+                push(operation.dest)
+            block.operations.append(operation)
+            continue
+        if opcode == Opcode.CLOSE_STACK or opcode == Opcode.END_PROC:
+            index -= 1
+            break
+        if opcode in LABELS:
+            previous = block
+            block = function.add_block(instr)
+            labels[instr.value] = block
+            if previous is not None and previous.terminator is None:
+                previous.terminator = Terminator("jump", [], [block], [])
+            if falls_through is not None:
+                falls_through.targets[0] = block
+                falls_through = None
+            continue
+        if block is None:
+            # Code after a jump or return that no label leads to.
+            block = function.add_block()
+            if falls_through is not None:
+                falls_through.targets[0] = block
+                falls_through = None
+        if opcode == Opcode.JMPFALSE:
+            falls_through = Terminator("branch", [pop() if stack else None], [None, instr.value], [instr])
+            block.terminator = falls_through
+            block = None
+            continue
+        if opcode == Opcode.JMP:
+            block.terminator = Terminator("jump", [], [instr.value], [instr])
+            block = None
+            continue
+        if opcode == Opcode.RETURN:
+            block.terminator = Terminator("return", [stack.pop()] if stack else [], [], [instr])
+            block = None
+            continue
+        if shape is not None:
+            # The first operation after a jump or return, in a block of its
+            # own now, is taken as any other.
+            index -= 1
+            continue
+        # Anything else is kept in place, without touching the stack.
+        block.operations.append(Operation(opcode.name.lower(), None, [], instr.value, instr))
+    function.temporaries = temporaries
+    while instructions[index].opcode != Opcode.END_PROC:
+        function.footer.append(instructions[index])
+        index += 1
+    function.footer.append(instructions[index])
+    function.size = index + 1 - first
+    for block in function.blocks:
+        terminator = block.terminator
+        if terminator is not None:
+            terminator.targets = [labels[target] if target.__class__ is str else target for target in terminator.targets]
+    function.compute_cfg()
+    function.compute_dominators()
+    function.construct_ssa()
+    return function, index + 1
+
+
+# The operation defining each value of the function, by id.
+def definitions(function):
+    defined = {}
+    for block in function.blocks:
+        for operation in block.phis:
+            defined[id(operation.dest)] = operation
+        for operation in block.operations:
+            if operation.dest is not None:
+                defined[id(operation.dest)] = operation
+    return defined
+
+
+# The integers the values of the function are known to hold, by id, as
+# (value, width). Literals and comparisons have no width of their own. A
+# variable is known where every definition reaching it stores a literal.
+# Going through the blocks in reverse postorder sees the definitions of a
+# phi before it, since the language has no loops.
+def known_integers(function):
+    known = {}
+    widths = {}
+    for block in function.order:
+        for phi in block.phis:
+            # Arguments along edges from pruned code do not count.
+            values = [known.get(id(arg)) for arg, predecessor in zip(phi.args, block.predecessors) if predecessor.reachable]
+            if values and values[0] is not None and all(value == values[0] for value in values):
+                known[id(phi.dest)] = values[0]
+        for operation in block.operations:
+            op = operation.op
+            if op == "const":
+                opcode = operation.origin.opcode
+                if opcode == Opcode.MOV_INT_CONST:
+                    known[id(operation.dest)] = (int(operation.value), None)
+                elif opcode == Opcode.MOV_UNSIGNED_INT_CONST:
+                    known[id(operation.dest)] = (2 ** 32 - int(operation.value), None)
+            elif op == "load":
+                value = known.get(id(operation.args[0]))
+                if value is not None:
+                    known[id(operation.dest)] = value
+            elif op in DEFINITIONS:
+                bits = WIDTHS.get(operation.origin.opcode) if op == "declare" else widths.get(operation.value)
+                if op == "declare":
+                    widths[operation.value] = bits
+                value = known.get(id(operation.args[0]))
+                if value is not None and bits is not None:
+                    known[id(operation.dest)] = (wrap(value[0], bits), bits)
+            elif op == "cmp" or op == "set":
+                left, right = (known.get(id(arg)) for arg in operation.args)
+                if left is None or right is None or (left[1] is not None and right[1] is not None and left[1] != right[1]):
+                    continue
+                bits = left[1] or right[1] or 64
+                known[id(operation.dest)] = (int(CONDITION_TESTS[operation.value](wrap(left[0], bits), wrap(right[0], bits))), None)
+            elif op == "select":
+                condition = known.get(id(operation.args[0]))
+                if condition is not None:
+                    value = known.get(id(operation.args[1 if condition[0] != 0 else 2]))
+                    if value is not None:
+                        known[id(operation.dest)] = value
+    return known
+
+
+def wrap(value, bits):
+    value &= (1 << bits) - 1
+    return value - (1 << bits) if value >> (bits - 1) else value
+
+
+# Removes operation and what computed its operands, as far as it has no
+# other effect. Every temporary is taken by exactly one operation, so
+# nothing else needs them.
+def remove_tree(block, operation, defined):
+    removed = set()
+    work = [operation]
+    while work:
+        operation = work.pop()
+        removed.add(id(operation))
+        for arg in operation.args:
+            if arg is not None and arg.name is None:
+                definition = defined.get(id(arg))
+                if definition is not None and definition.op in PURE:
+                    work.append(definition)
+    block.operations = [operation for operation in block.operations if id(operation) not in removed]
+    return len(removed)
+
+
+# Turns a branch on a condition known to hold, or known not to, into a
+# jump to the target it always takes. Pruning an arm can make more values
+# known, e.g. a variable only the arm assigned, so this goes on until no
+# branch is left to fold.
+def constant_branches(function, counts):
+    folded = True
+    while folded:
+        folded = False
+        defined = None
+        known = None
+        for block in function.order:
+            terminator = block.terminator
+            if terminator is None or terminator.op != "branch" or terminator.args[0] is None:
+                continue
+            if known is None:
+                defined = definitions(function)
+                known = known_integers(function)
+            condition = known.get(id(terminator.args[0]))
+            if condition is None:
+                continue
+            taken, other = terminator.targets if condition[0] != 0 else reversed(terminator.targets)
+            if taken is None:
+                continue
+            if other is not None and other is not taken:
+                function.remove_edge(block, other)
+            block.terminator = Terminator("jump", [], [taken], [])
+            # The condition is computed in the block, right before the branch.
+            remove_tree(block, defined[id(terminator.args[0])], defined)
+            counts["branches folded"] += 1
+            folded = True
+        if folded:
+            function.compute_order()
+
+
+# Removes the blocks nothing jumps or falls through to, e.g. the statements
+# after a return. A block declaring a variable that reachable code uses is
+# kept, the compiler needs the declaration.
+def unreachable(function, counts):
+    used = set()
+    for block in function.order:
+        for operation in block.operations:
+            if operation.op == "load" or operation.op == "store":
+                used.add(operation.value)
+    kept = []
+    for block in function.blocks:
+        if block.reachable or any(operation.op == "declare" and operation.value in used for operation in block.operations):
+            kept.append(block)
+            continue
+        for successor in list(block.successors):
+            function.remove_edge(block, successor)
+        counts["unreachable blocks removed"] += 1
+    function.blocks = kept
+
+
+# Removes stores whose value no load reads, along with what computed the
+# value, as far as it has no effect. Every other operation is kept when it
+# has an effect, takes part in a branch or return, or computes a value a
+# kept operation takes. A variable keeps its declaration as long as any
+# of its stores stays.
+def dead_stores(function, counts):
+    defined = definitions(function)
+    consumers = {}
+    variables = {}
+    for block in function.blocks:
+        for operation in block.operations:
+            for arg in operation.args:
+                if arg is not None and arg.name is None:
+                    consumers[id(arg)] = operation
+            if operation.op in DEFINITIONS:
+                variables.setdefault(operation.value, []).append(operation)
+    live = set()
+    work = []
+
+    def mark(operation):
+        if id(operation) not in live:
+            live.add(id(operation))
+            work.append(operation)
+
+    for block in function.blocks:
+        for operation in block.operations:
+            if operation.op not in PURE and operation.op not in DEFINITIONS:
+                mark(operation)
+        if block.terminator is not None:
+            for arg in block.terminator.args:
+                if arg is not None and id(arg) in defined:
+                    mark(defined[id(arg)])
+    changed = True
+    while changed:
+        while work:
+            operation = work.pop()
+            for arg in operation.args:
+                if arg is not None and id(arg) in defined:
+                    mark(defined[id(arg)])
+            # The value an operation leaves must still be taken off the
+            # stack by whatever took it.
+            dest = operation.dest
+            if dest is not None and dest.name is None and id(dest) in consumers:
+                mark(consumers[id(dest)])
+        changed = False
+        for stores in variables.values():
+            if any(id(store) in live for store in stores):
+                for store in stores:
+                    if store.op == "declare" and id(store) not in live:
+                        mark(store)
+                        changed = True
+    for block in function.blocks:
+        operations = [operation for operation in block.operations if id(operation) in live]
+        if len(operations) != len(block.operations):
+            counts["dead stores removed"] += sum(1 for operation in block.operations if operation.op in DEFINITIONS and id(operation) not in live)
+            block.operations = operations
+        block.phis = [phi for phi in block.phis if id(phi) in live]
+
+
+# Checks that the function is in SSA form: every value is defined once,
+# each version of a variable dominates its uses, and the edges agree.
+def verify(function, counts):
+    function.compute_order()
+    function.compute_dominators()
+    defined = {}
+    for block in function.blocks:
+        for operation in block.phis + block.operations:
+            if operation.dest is not None:
+                if id(operation.dest) in defined:
+                    raise Exception("SSA check failed in %s: %r is defined twice." % (function.name, operation.dest))
+                defined[id(operation.dest)] = block
+    for block in function.order:
+        for successor in block.successors:
+            if block not in successor.predecessors:
+                raise Exception("SSA check failed in %s: %s is missing from the predecessors of %s." % (function.name, block.name, successor.name))
+        for phi in block.phis:
+            for predecessor, arg in zip(block.predecessors, phi.args):
+                if arg is not None and predecessor.reachable and not function.dominates(defined[id(arg)], predecessor):
+                    raise Exception("SSA check failed in %s: %r does not reach %s." % (function.name, arg, block.name))
+        for operation in block.operations:
+            for arg in operation.args:
+                if arg is not None and arg.name is not None and not function.dominates(defined[id(arg)], block):
+                    raise Exception("SSA check failed in %s: %r is used in %s, which it does not dominate." % (function.name, arg, block.name))
+    counts["ssa blocks"] += len(function.blocks)
+    counts["ssa phis"] += sum(len(block.phis) for block in function.blocks)
+
+
+# Runs the named passes over the SSA form of every function, in the order
+# given, and lowers the result back to instructions for the compiler.
+# Counts what the passes did over every function run.
+class PassManager:
+
+    def __init__(self, passes=None):
+        self.passes = list(PASSES if passes is None else passes)
+        for name in self.passes:
+            if name not in FUNCTION_PASSES:
+                raise Exception("Unknown pass %s, expected one of %s." % (name, ", ".join(PASSES + CHECKS)))
+        self.functions = [FUNCTION_PASSES[name] for name in self.passes]
+        self.counts = Counter()
+
+    # Identifies the passes in cache keys, since they change the code.
+    def options(self):
+        return "passes=%s" % ",".join(self.passes)
+
+    def run(self, instructions, functions):
+        out = []
+        index = 0
+        while index < len(instructions):
+            instr = instructions[index]
+            if instr.opcode != Opcode.START_PROC and instr.opcode != Opcode.START_PUB_PROC:
+                out.append(instr)
+                index += 1
+                continue
+            first = len(out)
+            function, index = build_function(instructions, index, functions)
+            for run in self.functions:
+                run(function, self.counts)
+            function.lower(out)
+            self.counts["instructions removed"] += function.size - (len(out) - first)
+        return out
+
+
+FUNCTION_PASSES = {
+    "constant-branches": constant_branches,
+    "unreachable": unreachable,
+    "dead-stores": dead_stores,
+    "verify": verify,
+}
+
+
+# Reads the --passes option: none, all, or a comma separated list.
+def parse_passes(text):
+    if text == "none":
+        return None
+    if text == "all":
+        return PassManager()
+    return PassManager(name.strip() for name in text.split(","))
@@ -0,0 +1,167 @@
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+import json
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+PHASES = ["scan", "lex", "parse", "eval", "passes", "lower", "write", "assemble", "link"]
+
+
+# Wall and CPU time per phase of the pipeline, plus counters. The pipeline
+# switches phase as it goes, so time is charged to exactly one phase at a
+# time and a switch costs two clock reads. Tracing memory with tracemalloc
+# slows every allocation down, so it is only done when asked for, and so is
+# measuring the bytes of asm the passes removed, which lowers each function
+# twice more. Tables hold figures by row, e.g. per function.
+class Stats:
+
+    def __init__(self, memory=False, sizes=False):
+        self.wall = {}
+        self.cpu = {}
+        self.counters = {}
+        self.tables = {}
+        self.opcodes = Counter()
+        self.memory = memory
+        self.sizes = sizes
+        self.peak_traced = None
+        self.peak_rss = None
+        self.current = None
+        self.started = time.perf_counter()
+        self.wall_mark = self.started
+        self.cpu_mark = time.process_time()
+        self.total = None
+        if memory:
+            tracemalloc.start()
+
+    # A copy unpickled in another process starts its own clock there.
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.current = None
+        self.wall_mark = time.perf_counter()
+        self.cpu_mark = time.process_time()
+
+    # Charges the time since the last switch to the current phase and makes
+    # phase the current one. Returns the phase that was current, to switch
+    # back to.
+    def switch(self, phase):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        current = self.current
+        if current is not None:
+            self.wall[current] = self.wall.get(current, 0.0) + wall - self.wall_mark
+            self.cpu[current] = self.cpu.get(current, 0.0) + cpu - self.cpu_mark
+        self.current = phase
+        self.wall_mark = wall
+        self.cpu_mark = cpu
+        return current
+
+    @contextmanager
+    def phase(self, name):
+        previous = self.switch(name)
+        try:
+            yield
+        finally:
+            self.switch(previous)
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def count_opcodes(self, instructions):
+        self.opcodes.update(instr.opcode for instr in instructions)
+
+    # Sets the row of a table to values, a dict of figures by column.
+    def record(self, table, row, values):
+        self.tables.setdefault(table, {})[row] = values
+
+    # Adds what a copy of these stats recorded in another process.
+    def merge(self, other):
+        for phase, seconds in other.wall.items():
+            self.wall[phase] = self.wall.get(phase, 0.0) + seconds
+        for phase, seconds in other.cpu.items():
+            self.cpu[phase] = self.cpu.get(phase, 0.0) + seconds
+        for name, amount in other.counters.items():
+            self.count(name, amount)
+        for table, rows in other.tables.items():
+            self.tables.setdefault(table, {}).update(rows)
+        self.opcodes.update(other.opcodes)
+
+    def finish(self):
+        self.switch(None)
+        self.total = time.perf_counter() - self.started
+        if self.memory:
+            self.peak_traced = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        if resource is not None:
+            # Kilobytes on Linux, bytes on macOS.
+            self.peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def phases(self):
+        return [phase for phase in PHASES if phase in self.wall] + sorted(phase for phase in self.wall if phase not in PHASES)
+
+    def as_dict(self):
+        return {
+            "total_seconds": self.total,
+            "phases": {phase: {"wall_seconds": self.wall[phase], "cpu_seconds": self.cpu.get(phase, 0.0)} for phase in self.phases()},
+            "counters": dict(sorted(self.counters.items())),
+            "tables": {table: dict(sorted(rows.items())) for table, rows in sorted(self.tables.items())},
+            "opcodes": {opcode.name: amount for opcode, amount in self.opcodes.most_common()},
+            "peak_traced_bytes": self.peak_traced,
+            "peak_rss_bytes": self.peak_rss,
+        }
+
+    def json(self):
+        return json.dumps(self.as_dict(), indent=1)
+
+    def report(self):
+        lines = ["%-10s %10s %10s" % ("phase", "wall ms", "cpu ms")]
+        for phase in self.phases():
+            lines.append("%-10s %10.2f %10.2f" % (phase, self.wall[phase] * 1000, self.cpu.get(phase, 0.0) * 1000))
+        lines.append("%-10s %10.2f" % ("total", (self.total or 0.0) * 1000))
+        lines.append("")
+        for name, amount in sorted(self.counters.items()):
+            lines.append("%-20s %10s" % (name, amount))
+        if self.opcodes:
+            lines.append("%-20s %10s" % ("instructions", sum(self.opcodes.values())))
+            for opcode, amount in self.opcodes.most_common():
+                lines.append("  %-18s %10s" % (opcode.name, amount))
+        for table, rows in sorted(self.tables.items()):
+            columns = list(next(iter(rows.values())))
+            lines.append("")
+            lines.append("%-20s" % table + "".join(" %12s" % column for column in columns))
+            for row, values in sorted(rows.items()):
+                lines.append("  %-18s" % row + "".join(" %12s" % values[column] for column in columns))
+        if self.peak_traced is not None:
+            lines.append("%-20s %7.1f MiB" % ("peak traced", self.peak_traced / 2 ** 20))
+        if self.peak_rss is not None:
+            lines.append("%-20s %7.1f MiB" % ("peak rss", self.peak_rss / 2 ** 20))
+        return "\n".join(lines)
+
+
+# Stands in for Stats when nothing is being measured.
+class NullStats:
+
+    def switch(self, phase):
+        return None
+
+    def phase(self, name):
+        return nullcontext()
+
+    def count(self, name, amount=1):
+        pass
+
+    def count_opcodes(self, instructions):
+        pass
+
+    def record(self, table, row, values):
+        pass
+
+    def merge(self, other):
+        pass
+
+
+NULL_STATS = NullStats()
@@ -1,4 +1,5 @@
 import enum
+from array import array
 from enum import Enum
 
 
@@ -53,8 +54,107 @@ class TokenType(enum.IntEnum):
     TOKEN_DO = 48
 
 
+TOKEN_TYPES = {kind.value: kind for kind in TokenType}
+
+
 class Token:
+    __slots__ = ("kind", "data")
 
     def __init__(self, _type, _data):
         self.kind = _type
         self.data = _data
+
+
+KEYWORDS = {
+    "def": TokenType.TOKEN_DEF,
+    "else": TokenType.TOKEN_ELSE,
+    "elif": TokenType.TOKEN_ELIF,
+    "if": TokenType.TOKEN_IF,
+    "then": TokenType.TOKEN_THEN,
+    "end": TokenType.TOKEN_END,
+    "i8": TokenType.TOKEN_INT8,
+    "i16": TokenType.TOKEN_INT16,
+    "i32": TokenType.TOKEN_INT32,
+    "i64": TokenType.TOKEN_INT64,
+    "f64": TokenType.TOKEN_FLOAT64,
+    "double": TokenType.TOKEN_DOUBLE,
+    "float": TokenType.TOKEN_FLOAT,
+    "extern": TokenType.TOKEN_EXTERN,
+    "include": TokenType.TOKEN_INCLUDE,
+    "return": TokenType.TOKEN_RETURN,
+    "pub": TokenType.TOKEN_PUB,
+    "when": TokenType.TOKEN_WHEN,
+    "do": TokenType.TOKEN_DO,
+}
+
+OPERATORS = {
+    "(": TokenType.TOKEN_LEFT_PAREN,
+    ")": TokenType.TOKEN_RIGHT_PAREN,
+    "*": TokenType.TOKEN_STAR,
+    "/": TokenType.TOKEN_SLASH,
+    "-": TokenType.TOKEN_DASH,
+    "+": TokenType.TOKEN_PLUS,
+    ",": TokenType.TOKEN_COMMA,
+    ".": TokenType.TOKEN_DOT,
+    "=": TokenType.TOKEN_EQ,
+    "==": TokenType.TOKEN_ISEQ,
+    "=>": TokenType.TOKEN_EQGT,
+    "!": TokenType.TOKEN_NOT,
+    "!=": TokenType.TOKEN_ISNEQ,
+    ">": TokenType.TOKEN_ISG,
+    ">=": TokenType.TOKEN_ISGE,
+    "<": TokenType.TOKEN_ISL,
+    "<=": TokenType.TOKEN_ISLE,
+    "|": TokenType.TOKEN_BITWISE_OR,
+    "||": TokenType.TOKEN_OR,
+    "&": TokenType.TOKEN_BITWISE_AND,
+    "&&": TokenType.TOKEN_AND,
+    ":": TokenType.TOKEN_COLON,
+    "?": TokenType.TOKEN_QUESTION,
+}
+
+
+# Keywords and operators always have the same lexeme, so one shared Token
+# per kind is handed out for them.
+SHARED_TOKENS = {kind: Token(kind, data) for data, kind in list(KEYWORDS.items()) + list(OPERATORS.items())}
+SHARED_TOKENS[TokenType.TOKEN_EOF] = Token(TokenType.TOKEN_EOF, "")
+
+
+# Struct-of-arrays token stream. Each token costs one kind byte plus a start
+# offset and a length into the source, the lexeme is only sliced out when
+# a Token is requested.
+class TokenBuffer:
+
+    def __init__(self, source):
+        self.source = source
+        self.kinds = array("b")
+        self.starts = array("i")
+        self.lengths = array("i")
+        self.names = {}
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def append(self, kind, start, length):
+        self.kinds.append(kind)
+        self.starts.append(start)
+        self.lengths.append(length)
+
+    def kind(self, index):
+        return self.kinds[index]
+
+    def data(self, index):
+        start = self.starts[index]
+        return self.source[start:start + self.lengths[index]]
+
+    def token(self, index):
+        kind = self.kinds[index]
+        shared = SHARED_TOKENS.get(kind)
+        if shared is not None:
+            return shared
+        start = self.starts[index]
+        data = self.source[start:start + self.lengths[index]]
+        return Token(TOKEN_TYPES[kind], self.names.setdefault(data, data))
+
+    def nbytes(self):
+        return sum(len(a) * a.itemsize for a in (self.kinds, self.starts, self.lengths))
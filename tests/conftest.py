@@ -0,0 +1,40 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from src.compiler import Compiler
+from src.lexer import Lexer
+from src.parser import Parser
+
+SAMPLES = [os.path.join(ROOT, "test", "test.myl")] + sorted(
+    os.path.join(ROOT, "test", "impl", name) for name in os.listdir(os.path.join(ROOT, "test", "impl")) if name.endswith(".myl"))
+
+
+def parse(source, path="<test>"):
+    parser = Parser(Lexer(path, source))
+    parser.parse_advance()
+    return parser
+
+
+# Compiles source to asm and returns the asm. Options go to Compiler.
+@pytest.fixture
+def compile_source(tmp_path):
+    def compile_source(source, jobs=1, **options):
+        output = tmp_path / "out.asm"
+        Compiler(parse(source), **options).compile(str(output), jobs)
+        return output.read_text()
+    return compile_source
+
+
+# The code of one function in the asm, from its label to the next function.
+def function_code(asm, name):
+    lines = asm.splitlines()
+    start = lines.index("%s:" % name)
+    end = start + 1
+    while end < len(lines) and not lines[end].startswith(("global ", "SECTION")) and not (lines[end].endswith(":") and not lines[end].startswith(".")):
+        end += 1
+    return lines[start + 1:end]
@@ -0,0 +1,63 @@
+import pytest
+
+from bench.generate import generate_program
+from conftest import SAMPLES, parse
+from src.bytecode import IRReader, save_ir
+from src.compiler import Compiler
+
+# print.myl returns a value from main, which has no return type.
+COMPILING = [path for path in SAMPLES if not path.endswith("print.myl")]
+
+
+def front_end(source):
+    parser = parse(source)
+    compiler = Compiler(parser)
+    compiler.load_signatures()
+    units = []
+    for node in parser.statements():
+        compiler.evaluate(node)
+        units.append([(instr.opcode, instr.value) for instr in compiler.instructions])
+        compiler.instructions = []
+    return units
+
+
+def read(path):
+    with open(path) as file:
+        return file.read()
+
+
+@pytest.mark.parametrize("source", [read(path) for path in COMPILING] + [generate_program(12)])
+def test_saved_stream_round_trips(tmp_path, source):
+    ir = str(tmp_path / "program.mylir")
+    save_ir(parse(source), ir)
+    reader = IRReader(ir)
+    assert [[(instr.opcode, instr.value) for instr in reader.unit(index)] for index in range(len(reader))] == front_end(source)
+
+
+@pytest.mark.parametrize("source", [read(path) for path in COMPILING] + [generate_program(12)])
+def test_saved_stream_lowers_like_source(tmp_path, compile_source, source):
+    ir = str(tmp_path / "program.mylir")
+    save_ir(parse(source), ir)
+    output = tmp_path / "saved.asm"
+    Compiler(IRReader(ir)).compile(str(output))
+    assert output.read_text() == compile_source(source)
+
+
+def test_saved_stream_keeps_signatures(tmp_path):
+    ir = str(tmp_path / "program.mylir")
+    save_ir(parse(generate_program(4)), ir)
+    reader = IRReader(ir)
+    signatures = reader.function_signatures()
+    assert set(signatures) >= {"f0_i8", "f1_i16", "f2_i32", "f3_i64", "main"}
+    assert signatures["main"] is None
+    assert set(reader.function_index()) == {"f0_i8", "f1_i16", "f2_i32", "f3_i64", "main"}
+
+
+def test_other_versions_are_rejected(tmp_path):
+    ir = tmp_path / "program.mylir"
+    save_ir(parse(generate_program(1)), str(ir))
+    data = bytearray(ir.read_bytes())
+    data[7] ^= 0xff
+    ir.write_bytes(bytes(data))
+    with pytest.raises(Exception, match="not a saved instruction stream"):
+        IRReader(str(ir))
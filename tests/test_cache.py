@@ -0,0 +1,70 @@
+from conftest import parse
+from src.cache import FunctionCache
+from src.compiler import Compiler
+
+PROGRAM = """extern printf
+
+def f() : i64
+  i64 a = 3
+  i64 b = if a > 2 ? 10 : 20
+  return b
+end
+
+def g() : i64
+  return 4
+end
+
+pub def main()
+  i64 x = f()
+  printf("%d\\n", x)
+end
+"""
+
+
+def build(tmp_path, source, cache):
+    output = tmp_path / "out.asm"
+    Compiler(parse(source), cache=cache).compile(str(output))
+    return output.read_text()
+
+
+def test_entries_are_stored_and_found(tmp_path):
+    cache = FunctionCache(str(tmp_path / "cache"))
+    key = cache.key("def f()\nend", {"printf": "extern"})
+    assert cache.get(key) is None
+    cache.put(key, {"code": " ret\n"})
+    assert cache.get(key) == {"code": " ret\n"}
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_key_depends_on_callees_and_options(tmp_path):
+    cache = FunctionCache(str(tmp_path / "cache"))
+    key = cache.key("def f()\nend", {"g": "extern"})
+    assert key != cache.key("def f()\nend", {"g": None})
+    assert key != cache.key("def f()\nend", {"g": "extern"}, "passes=verify")
+    assert key != cache.key("def f() \nend", {"g": "extern"})
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = FunctionCache(str(tmp_path / "cache"), max_bytes=2000)
+    for i in range(20):
+        cache.put(cache.key(str(i), {}), {"code": "x" * 200})
+    assert cache.evictions > 0
+    assert cache.size <= 2000
+
+
+# Every function, the ones with a ternary too, is looked up once and found
+# on the second build, which gives the same code.
+def test_second_build_reuses_every_function(tmp_path):
+    first_cache = FunctionCache(str(tmp_path / "cache"))
+    first = build(tmp_path, PROGRAM, first_cache)
+    assert (first_cache.hits, first_cache.misses) == (0, 3)
+    second_cache = FunctionCache(str(tmp_path / "cache"))
+    assert build(tmp_path, PROGRAM, second_cache) == first
+    assert (second_cache.hits, second_cache.misses) == (3, 0)
+
+
+def test_changed_function_is_compiled_again(tmp_path):
+    build(tmp_path, PROGRAM, FunctionCache(str(tmp_path / "cache")))
+    cache = FunctionCache(str(tmp_path / "cache"))
+    build(tmp_path, PROGRAM.replace("return 4", "return 5"), cache)
+    assert (cache.hits, cache.misses) == (2, 1)
@@ -0,0 +1,83 @@
+import pytest
+
+from conftest import function_code
+
+CONDITION = """extern puts
+
+pub def main()
+  i64 a = 5
+  if a %s 3 then
+    puts("x")
+  end
+end
+"""
+
+
+# Each comparison branches past the then block on the inverse condition.
+@pytest.mark.parametrize("operator, jump", [("==", "jne"), ("!=", "je"), ("<", "jge"), ("<=", "jg"), (">", "jle"), (">=", "jl")])
+def test_branch_on_inverse_condition(compile_source, operator, jump):
+    code = function_code(compile_source(CONDITION % operator), "main")
+    assert " cmp r10, 3" in code
+    assert [line for line in code if line.startswith(" j")] == [" %s .L0" % jump]
+
+
+# A constant on the left is compared on the right, with the condition swapped.
+def test_constant_on_the_left_is_swapped(compile_source):
+    code = function_code(compile_source(CONDITION.replace("a %s 3", "3 %s a") % "<"), "main")
+    assert " cmp r10, 3" in code
+    assert " jle .L0" in code
+
+
+def test_comparison_value_uses_setcc(compile_source):
+    source = "def f() : i64\n  i64 a = 5\n  i64 b = a < 7\n  return b\nend\n"
+    code = function_code(compile_source(source), "f")
+    assert " setl al" in code
+    assert " movzx eax, al" in code
+
+
+def test_ternary_uses_cmov(compile_source):
+    source = "def f() : i64\n  i64 a = 5\n  i64 b = if a > 2 ? a : 20\n  return b\nend\n"
+    code = function_code(compile_source(source), "f")
+    assert [line for line in code if line.startswith(" cmov")]
+    assert not [line for line in code if line.startswith(" j")]
+
+
+# An arm that takes code to compute is only computed on its branch.
+def test_ternary_with_computed_arm_branches(compile_source):
+    source = "def f() : i64\n  i64 a = 5\n  i64 b = if a > 2 ? a + 1 : 20\n  return b\nend\n"
+    code = function_code(compile_source(source), "f")
+    assert not [line for line in code if line.startswith(" cmov")]
+    assert [line for line in code if line.startswith(" j")] == [" jle .L0", " jmp .L1"]
+    assert code[code.index(".L0:") + 1] == " mov rax, 20"
+
+
+@pytest.mark.parametrize("source, store", [
+    ("def f() : i64\n  i64 a = 5\n  i8 b = if a > 2 ? 1 : 2\n  return a\nend\n", " mov byte [rsp - 1], al"),
+    ("def f() : i64\n  i64 a = 5\n  i32 b = 0\n  b = if a > 2 ? 1 : 2\n  return b\nend\n", " mov r11d, eax"),
+    ("def f() : i16\n  i64 a = 5\n  return if a > 2 ? 1 : 2\nend\n", " cmovg ax, bx"),
+])
+def test_two_constants_are_picked_in_the_width_taken(compile_source, source, store):
+    assert store in function_code(compile_source(source), "f")
+
+
+def test_arms_of_different_widths_are_rejected(compile_source):
+    source = "def f() : i64\n  i32 a = 5\n  i64 c = 1\n  i64 b = if a > 2 ? a + 1 : c\n  return b\nend\n"
+    with pytest.raises(Exception, match="An I32 and an I64 cannot be selected"):
+        compile_source(source)
+
+
+def test_constant_conditions_are_decided_at_compile_time(compile_source):
+    code = function_code(compile_source(CONDITION.replace("a %s 3", "1")), "main")
+    assert not [line for line in code if line.startswith((" cmp", " test", " j"))]
+
+
+@pytest.mark.parametrize("expression", ["if a == 1 && a < 2 then", "if a || 0 then", "i64 b = a && 1"])
+def test_logical_operators_are_rejected(compile_source, expression):
+    source = "pub def main()\n  i64 a = 1\n  %s\n%s" % (expression, "  end\nend\n" if expression.endswith("then") else "end\n")
+    with pytest.raises(Exception, match="Logical operators are not supported"):
+        compile_source(source)
+
+
+def test_logical_operators_between_literals_are_folded(compile_source):
+    code = function_code(compile_source("def f() : i64\n  return 1 && 0 || 1\nend\n"), "f")
+    assert " mov rax, 1" in code
@@ -0,0 +1,13 @@
+import pytest
+
+from bench.generate import generate_program
+from src.peephole import Peephole
+from src.ssa import PassManager
+
+
+@pytest.mark.parametrize("options", [{}, {"passes": None}, {"peephole": None, "passes": None}])
+def test_parallel_lowering_matches_serial(compile_source, options):
+    source = generate_program(40)
+    def make():
+        return {"peephole": Peephole(), "passes": PassManager(), **options}
+    assert compile_source(source, jobs=3, **make()) == compile_source(source, **make())
@@ -0,0 +1,63 @@
+import pytest
+
+from conftest import function_code, parse
+from src.compiler import Compiler
+from src.regalloc import CALLEE_SAVED, RegisterAllocator
+
+
+def allocation(source, name):
+    parser = parse(source)
+    compiler = Compiler(parser)
+    compiler.load_signatures()
+    for node in parser.statements():
+        compiler.evaluate(node)
+    allocator = RegisterAllocator(compiler.functions)
+    allocator.allocate(compiler.instructions)
+    return allocator, allocator.allocation(name)
+
+
+def test_locals_not_live_across_calls_use_volatile_registers():
+    _, result = allocation("def f() : i64\n  i64 a = 1\n  i64 b = a + 2\n  return b\nend\n", "f")
+    assert set(result.registers.values()) <= {"r10", "r11"}
+    assert result.saved == []
+
+
+def test_locals_live_across_calls_use_callee_saved_registers():
+    source = "extern puts\n\ndef f() : i32\n  i32 a = 1\n  puts(\"x\")\n  return a\nend\n"
+    _, result = allocation(source, "f")
+    assert result.registers["a"] in CALLEE_SAVED
+    assert result.saved == [result.registers["a"]]
+
+
+def test_bytes_and_floats_stay_in_memory():
+    _, result = allocation("def f() : i8\n  i8 a = 1\n  f64 b = 1.5\n  return a\nend\n", "f")
+    assert result.registers == {}
+
+
+def test_locals_beyond_the_registers_are_spilled():
+    names = ["v%s" % i for i in range(8)]
+    lines = ["extern puts", "", "def f() : i64"] + ["  i64 %s = %s" % (name, i) for i, name in enumerate(names)]
+    lines += ["  puts(\"x\")", "  return %s" % " + ".join(names), "end", ""]
+    allocator, result = allocation("\n".join(lines), "f")
+    assert len(result.registers) == len(CALLEE_SAVED)
+    assert allocator.spilled == len(names) - len(CALLEE_SAVED)
+
+
+def test_registers_are_used_in_the_code(compile_source):
+    asm = compile_source("extern puts\n\npub def main()\n  i32 a = 7\n  puts(\"x\")\n  i32 b = a + 1\nend\n", passes=None)
+    code = function_code(asm, "main")
+    assert " push rsi" in code
+    assert " mov esi, 7" in code
+    assert " pop rsi" in code
+
+
+# The check holds whether the variables got registers or stayed in memory.
+@pytest.mark.parametrize("source", ["i32 a = 5\n  i64 b = a", "i8 a = 5\n  i64 b = a", "i64 a = 5\n  i16 b = a"])
+def test_variable_of_another_width_is_rejected(compile_source, source):
+    with pytest.raises(Exception, match="Cannot initialize the I\\d+ variable b with a value of a different width"):
+        compile_source("def f() : i64\n  %s\n  return b\nend\n" % source)
+
+
+def test_variable_of_the_same_width_is_copied(compile_source):
+    code = function_code(compile_source("def f() : i32\n  i32 a = 5\n  i32 b = a\n  return b\nend\n"), "f")
+    assert " mov r11d, r10d" in code
@@ -0,0 +1,195 @@
+import os
+
+import pytest
+
+from bench.generate import generate_program
+from bench.stress_nesting import nested_ifs
+from conftest import SAMPLES, function_code, parse
+from src.compiler import Compiler
+from src.peephole import Peephole
+from src.ssa import PassManager, parse_passes
+from src.stats import NULL_STATS, Stats
+
+DEAD_BRANCH = """extern puts
+
+pub def main()
+  if 0 then
+    puts("dead")
+  end
+  puts("live")
+end
+"""
+
+DEAD_STORES = """extern puts
+
+pub def main()
+  i64 a = 1
+  a = 2
+  a = 3
+  puts("x")
+end
+"""
+
+AFTER_RETURN = """def f() : i64
+  return 1
+  i64 a = 2
+  return a
+end
+"""
+
+
+def read(path):
+    with open(path) as file:
+        return file.read()
+
+
+@pytest.mark.parametrize("source", [read(path) for path in SAMPLES if not path.endswith("print.myl")] + [generate_program(12)])
+def test_verify_pass_keeps_the_code(compile_source, source):
+    assert compile_source(source, passes=PassManager(["verify"])) == compile_source(source)
+
+
+def test_constant_branch_is_removed_with_its_strings(compile_source):
+    asm = compile_source(DEAD_BRANCH, passes=PassManager())
+    assert "dead" not in asm
+    assert "jmp" not in "\n".join(function_code(asm, "main"))
+    assert "dead" in compile_source(DEAD_BRANCH)
+
+
+def test_overwritten_stores_are_removed(compile_source):
+    code = function_code(compile_source(DEAD_STORES, passes=PassManager()), "main")
+    assert not [line for line in code if line.endswith((", 1", ", 2", ", 3"))]
+    assert len(function_code(compile_source(DEAD_STORES), "main")) > len(code)
+
+
+def test_code_after_return_is_removed(compile_source):
+    code = function_code(compile_source(AFTER_RETURN, passes=PassManager(["unreachable"])), "f")
+    assert " mov rax, 1" in code
+    assert not [line for line in code if ", 2" in line]
+
+
+def test_passes_handle_deep_nesting(compile_source):
+    source = nested_ifs(300)
+    assert compile_source(source, passes=PassManager(["verify"])) == compile_source(source)
+
+
+def test_pass_option_is_read():
+    assert parse_passes("none") is None
+    assert parse_passes("all").passes == ["constant-branches", "unreachable", "dead-stores"]
+    assert parse_passes("verify, dead-stores").passes == ["verify", "dead-stores"]
+    with pytest.raises(Exception, match="Unknown pass"):
+        parse_passes("inline")
+
+
+# The variable goes with the dead store, but main still calls, so it keeps
+# its frame with the shadow space and rsp stays aligned at the call.
+def test_function_without_variables_keeps_its_frame_for_calls(compile_source):
+    source = "extern puts\n\npub def main()\n  i64 a = 1\n  puts(\"x\")\nend\n"
+    code = function_code(compile_source(source, passes=PassManager()), "main")
+    assert code[:3] == [" push rbp", " mov rbp, rsp", " sub rsp, 0x20"]
+
+
+def test_leaf_function_with_register_variables_has_no_frame(compile_source):
+    code = function_code(compile_source("def f() : i64\n  i64 a = 1\n  return a + 2\nend\n"), "f")
+    assert not [line for line in code if "rsp" in line or "rbp" in line]
+
+
+PRUNED_RETURN = """def f() : i64
+  if 0 then
+    return 1
+  end
+end
+"""
+
+
+# The requirement is checked on the source, so removing the only return,
+# or measuring the code on the side for stats, does not change it.
+@pytest.mark.parametrize("passes", [None, PassManager()])
+@pytest.mark.parametrize("stats", [NULL_STATS, Stats()])
+def test_return_in_pruned_branch_satisfies_requirement(compile_source, passes, stats):
+    assert "f:" in compile_source(PRUNED_RETURN, passes=passes, stats=stats)
+
+
+@pytest.mark.parametrize("stats", [NULL_STATS, Stats()])
+def test_missing_return_value_is_reported(compile_source, stats):
+    with pytest.raises(Exception, match="Function f requires a return value"):
+        compile_source("def f() : i64\n  i64 a = 1\nend\n", passes=PassManager(), stats=stats)
+
+
+CONDITION_ON_VARIABLE = """extern puts
+
+def g() : i64
+  return 2
+end
+
+pub def main()
+  i64 a = g()
+  if a == 2 then
+    puts("a")
+  else
+    puts("b")
+  end
+end
+"""
+
+
+PRUNED_ARMS = """extern puts
+
+pub def main()
+  if 0 then
+    puts("a")
+  else
+    if 1 then
+      puts("b")
+    end
+  end
+  if 1 then
+    puts("c")
+  else
+    puts("d")
+  end
+  puts("e")
+end
+"""
+
+
+# The jump over the pruned else goes too, since it leads to the next block.
+@pytest.mark.parametrize("peephole", [None, Peephole()])
+def test_labels_of_pruned_branches_are_dropped(compile_source, peephole):
+    code = function_code(compile_source(PRUNED_ARMS, passes=PassManager(), peephole=peephole), "main")
+    assert not [line for line in code if line.startswith((".L", " j"))]
+    assert [line for line in code if line.startswith(" mov rcx")] == [" mov rcx, str@0", " mov rcx, str@1", " mov rcx, str@2"]
+
+
+def test_labels_still_jumped_to_are_kept(compile_source):
+    code = function_code(compile_source(CONDITION_ON_VARIABLE, passes=PassManager()), "main")
+    labels = [line[:-1] for line in code if line.startswith(".L")]
+    assert labels
+    assert all([line for line in code if line.startswith(" j") and line.endswith(" " + label)] for label in labels)
+
+
+
+# The second condition is only known once the first branch is pruned.
+def test_branches_known_after_pruning_are_folded(compile_source):
+    source = "extern puts\n\npub def main()\n  i64 a = 1\n  if 0 then\n    a = 2\n  end\n  if a == 1 then\n    puts(\"x\")\n  end\nend\n"
+    code = function_code(compile_source(source, passes=PassManager()), "main")
+    assert not [line for line in code if line.startswith((" cmp", " j", ".L"))]
+    assert " call puts" in code
+
+
+def passes_removed(source, stats):
+    parser = parse(source)
+    Compiler(parser, passes=PassManager(), stats=stats).compile(os.devnull)
+    return stats.tables["dead code removed"]
+
+
+def test_removed_bytes_are_only_measured_when_asked_for():
+    assert passes_removed(DEAD_BRANCH, Stats()) == {"main": {"instructions": 6}}
+    removed = passes_removed(DEAD_BRANCH, Stats(sizes=True))["main"]
+    assert removed["instructions"] == 6
+    assert removed["bytes"] > 0
+
+
+# The dead branch does not compile, so its size is not known.
+def test_removed_code_that_does_not_compile_has_no_size():
+    source = "pub def main()\n  i32 a = 1\n  if 0 then\n    i64 b = a\n  end\nend\n"
+    assert passes_removed(source, Stats(sizes=True))["main"]["bytes"] is None